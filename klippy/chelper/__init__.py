@@ -152,9 +152,14 @@ defs_kin_shaper = """
         struct stepper_kinematics *sk);
     int input_shaper_set_shaper_params(struct stepper_kinematics *sk, char axis
         , int n, double a[], double t[]);
+    int input_shaper_schedule_shaper_params(struct stepper_kinematics *sk
+        , char axis, int n, double a[], double t[], double print_time);
+    int input_shaper_cleanup_params(struct stepper_kinematics *sk);
+    int input_shaper_check_shaper_params(int n, double a[], double t[]);
     int input_shaper_set_sk(struct stepper_kinematics *sk
         , struct stepper_kinematics *orig_sk);
     struct stepper_kinematics * input_shaper_alloc(void);
+    void input_shaper_free(struct stepper_kinematics *sk);
 """
 
 defs_kin_idex = """
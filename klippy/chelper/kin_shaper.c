@@ -11,6 +11,7 @@
 #include <string.h> // memset
 #include "compiler.h" // __visible
 #include "itersolve.h" // struct stepper_kinematics
+#include "list.h" // list_node
 #include "trapq.h" // struct move
 
 
@@ -109,22 +110,84 @@ calc_position(struct move *m, int axis, double move_time
 
 #define DUMMY_T 500.0
 
+struct shaper_params {
+    struct shaper_pulses sx, sy;
+    double active_print_time, blend_time;
+    struct list_node node;
+};
+
 struct input_shaper {
     struct stepper_kinematics sk;
     struct stepper_kinematics *orig_sk;
     struct move m;
-    struct shaper_pulses sx, sy;
+    struct list_head params_list;
 };
 
+static inline struct shaper_params *
+get_last_params(struct input_shaper *is)
+{
+    return list_last_entry(&is->params_list, struct shaper_params, node);
+}
+
+static inline int
+has_scheduled_params(struct input_shaper *is)
+{
+    return !list_is_first(&get_last_params(is)->node, &is->params_list);
+}
+
+static inline double
+calc_shaped_position(struct move *m, int axis, double move_time
+                     , struct shaper_pulses *sp)
+{
+    if (!sp->num_pulses)
+        return get_axis_position(m, axis, move_time);
+    return calc_position(m, axis, move_time, sp);
+}
+
+// Calculate the position using the given shaper parameters, blending
+// from the preceding parameters while a parameter change takes effect
+static double
+calc_params_position(struct input_shaper *is, struct shaper_params *sp
+                     , struct move *m, int axis, double move_time)
+{
+    double pos = calc_shaped_position(m, axis, move_time
+                                      , axis == 'x' ? &sp->sx : &sp->sy);
+    double blend_t = m->print_time + move_time - sp->active_print_time;
+    if (blend_t >= sp->blend_time
+        || list_is_first(&sp->node, &is->params_list))
+        return pos;
+    struct shaper_params *prev = list_prev_entry(sp, node);
+    double prev_pos = calc_params_position(is, prev, m, axis, move_time);
+    return prev_pos + (pos - prev_pos) * (blend_t / sp->blend_time);
+}
+
+// Calculate the position when shaper parameter changes are scheduled
+static double
+calc_scheduled_position(struct input_shaper *is, struct move *m, int axis
+                        , double move_time)
+{
+    double print_time = m->print_time + move_time;
+    struct shaper_params *sp = get_last_params(is);
+    while (unlikely(sp->active_print_time > print_time) &&
+           !list_is_first(&sp->node, &is->params_list))
+        sp = list_prev_entry(sp, node);
+    return calc_params_position(is, sp, m, axis, move_time);
+}
+
 // Optimized calc_position when only x axis is needed
 static double
 shaper_x_calc_position(struct stepper_kinematics *sk, struct move *m
                        , double move_time)
 {
     struct input_shaper *is = container_of(sk, struct input_shaper, sk);
-    if (!is->sx.num_pulses)
+    if (unlikely(has_scheduled_params(is))) {
+        is->m.start_pos.x = calc_scheduled_position(is, m, 'x', move_time);
+        return is->orig_sk->calc_position_cb(is->orig_sk, &is->m, DUMMY_T);
+    }
+    struct shaper_params *sp = get_last_params(is);
+    if (!sp->sx.num_pulses)
         return is->orig_sk->calc_position_cb(is->orig_sk, m, move_time);
-    is->m.start_pos.x = calc_position(m, 'x', move_time, &is->sx);
+    is->m.start_pos.x = calc_position(m, 'x', move_time, &sp->sx);
     return is->orig_sk->calc_position_cb(is->orig_sk, &is->m, DUMMY_T);
 }
 
@@ -134,9 +197,14 @@ shaper_y_calc_position(struct stepper_kinematics *sk, struct move *m
                        , double move_time)
 {
     struct input_shaper *is = container_of(sk, struct input_shaper, sk);
-    if (!is->sy.num_pulses)
+    if (unlikely(has_scheduled_params(is))) {
+        is->m.start_pos.y = calc_scheduled_position(is, m, 'y', move_time);
+        return is->orig_sk->calc_position_cb(is->orig_sk, &is->m, DUMMY_T);
+    }
+    struct shaper_params *sp = get_last_params(is);
+    if (!sp->sy.num_pulses)
         return is->orig_sk->calc_position_cb(is->orig_sk, m, move_time);
-    is->m.start_pos.y = calc_position(m, 'y', move_time, &is->sy);
+    is->m.start_pos.y = calc_position(m, 'y', move_time, &sp->sy);
     return is->orig_sk->calc_position_cb(is->orig_sk, &is->m, DUMMY_T);
 }
 
@@ -146,13 +214,20 @@ shaper_xy_calc_position(struct stepper_kinematics *sk, struct move *m
                         , double move_time)
 {
     struct input_shaper *is = container_of(sk, struct input_shaper, sk);
-    if (!is->sx.num_pulses && !is->sy.num_pulses)
+    if (unlikely(has_scheduled_params(is))) {
+        is->m.start_pos = move_get_coord(m, move_time);
+        is->m.start_pos.x = calc_scheduled_position(is, m, 'x', move_time);
+        is->m.start_pos.y = calc_scheduled_position(is, m, 'y', move_time);
+        return is->orig_sk->calc_position_cb(is->orig_sk, &is->m, DUMMY_T);
+    }
+    struct shaper_params *sp = get_last_params(is);
+    if (!sp->sx.num_pulses && !sp->sy.num_pulses)
         return is->orig_sk->calc_position_cb(is->orig_sk, m, move_time);
     is->m.start_pos = move_get_coord(m, move_time);
-    if (is->sx.num_pulses)
-        is->m.start_pos.x = calc_position(m, 'x', move_time, &is->sx);
-    if (is->sy.num_pulses)
-        is->m.start_pos.y = calc_position(m, 'y', move_time, &is->sy);
+    if (sp->sx.num_pulses)
+        is->m.start_pos.x = calc_position(m, 'x', move_time, &sp->sx);
+    if (sp->sy.num_pulses)
+        is->m.start_pos.y = calc_position(m, 'y', move_time, &sp->sy);
     return is->orig_sk->calc_position_cb(is->orig_sk, &is->m, DUMMY_T);
 }
 
@@ -177,24 +252,87 @@ input_shaper_set_sk(struct stepper_kinematics *sk
     return 0;
 }
 
+static void
+note_pulses_window(struct shaper_pulses *sp, double *pre_active
+                   , double *post_active)
+{
+    if (!sp->num_pulses)
+        return;
+    if (sp->pulses[sp->num_pulses-1].t > *pre_active)
+        *pre_active = sp->pulses[sp->num_pulses-1].t;
+    if (-sp->pulses[0].t > *post_active)
+        *post_active = -sp->pulses[0].t;
+}
+
 static void
 shaper_note_generation_time(struct input_shaper *is)
 {
     double pre_active = 0., post_active = 0.;
-    if ((is->sk.active_flags & AF_X) && is->sx.num_pulses) {
-        pre_active = is->sx.pulses[is->sx.num_pulses-1].t;
-        post_active = -is->sx.pulses[0].t;
-    }
-    if ((is->sk.active_flags & AF_Y) && is->sy.num_pulses) {
-        pre_active = is->sy.pulses[is->sy.num_pulses-1].t > pre_active
-            ? is->sy.pulses[is->sy.num_pulses-1].t : pre_active;
-        post_active = -is->sy.pulses[0].t > post_active
-            ? -is->sy.pulses[0].t : post_active;
+    struct shaper_params *sp;
+    list_for_each_entry(sp, &is->params_list, node) {
+        if (is->sk.active_flags & AF_X)
+            note_pulses_window(&sp->sx, &pre_active, &post_active);
+        if (is->sk.active_flags & AF_Y)
+            note_pulses_window(&sp->sy, &pre_active, &post_active);
     }
     is->sk.gen_steps_pre_active = pre_active;
     is->sk.gen_steps_post_active = post_active;
 }
 
+static double
+get_pulses_duration(struct shaper_pulses *sp)
+{
+    if (!sp->num_pulses)
+        return 0.;
+    return sp->pulses[sp->num_pulses-1].t - sp->pulses[0].t;
+}
+
+// Blend a parameter change over the longest of the involved shapers
+static void
+shaper_note_blend_time(struct input_shaper *is, struct shaper_params *sp)
+{
+    sp->blend_time = 0.;
+    if (list_is_first(&sp->node, &is->params_list))
+        return;
+    struct shaper_params *prev = list_prev_entry(sp, node);
+    struct shaper_pulses *pulses[] = { &prev->sx, &prev->sy, &sp->sx, &sp->sy };
+    int i;
+    for (i = 0; i < ARRAY_SIZE(pulses); ++i) {
+        double duration = get_pulses_duration(pulses[i]);
+        if (duration > sp->blend_time)
+            sp->blend_time = duration;
+    }
+}
+
+// Free parameters that no longer affect steps yet to be generated
+static void
+shaper_cleanup_params(struct input_shaper *is, double cleanup_time)
+{
+    struct shaper_params *first = list_first_entry(
+            &is->params_list, struct shaper_params, node);
+    while (!list_is_last(&first->node, &is->params_list)) {
+        struct shaper_params *next = list_next_entry(first, node);
+        if (next->active_print_time + next->blend_time >= cleanup_time)
+            break;
+        list_del(&first->node);
+        free(first);
+        first = next;
+    }
+}
+
+static int
+shaper_update_axis(struct input_shaper *is, struct shaper_params *sp
+                   , char axis, int n, double a[], double t[])
+{
+    int status = 0;
+    // Ignore input shaper update if the axis is not active
+    if (is->orig_sk->active_flags & (axis == 'x' ? AF_X : AF_Y))
+        status = init_shaper(n, a, t, axis == 'x' ? &sp->sx : &sp->sy);
+    shaper_note_blend_time(is, sp);
+    shaper_note_generation_time(is);
+    return status;
+}
+
 int __visible
 input_shaper_set_shaper_params(struct stepper_kinematics *sk, char axis
                                , int n, double a[], double t[])
@@ -202,14 +340,56 @@ input_shaper_set_shaper_params(struct stepper_kinematics *sk, char axis
     if (axis != 'x' && axis != 'y')
         return -1;
     struct input_shaper *is = container_of(sk, struct input_shaper, sk);
-    struct shaper_pulses *sp = axis == 'x' ? &is->sx : &is->sy;
-    int status = 0;
-    // Ignore input shaper update if the axis is not active
-    if (is->orig_sk->active_flags & (axis == 'x' ? AF_X : AF_Y)) {
-        status = init_shaper(n, a, t, sp);
-        shaper_note_generation_time(is);
+    // Apply immediately, replacing any scheduled parameter changes
+    while (has_scheduled_params(is)) {
+        struct shaper_params *first = list_first_entry(
+                &is->params_list, struct shaper_params, node);
+        list_del(&first->node);
+        free(first);
     }
-    return status;
+    return shaper_update_axis(is, get_last_params(is), axis, n, a, t);
+}
+
+int __visible
+input_shaper_schedule_shaper_params(struct stepper_kinematics *sk, char axis
+                                    , int n, double a[], double t[]
+                                    , double print_time)
+{
+    if (axis != 'x' && axis != 'y')
+        return -1;
+    struct input_shaper *is = container_of(sk, struct input_shaper, sk);
+    struct shaper_params *sp = get_last_params(is);
+    if (sp->active_print_time != print_time) {
+        // Add new shaper parameters, initially matching the current ones
+        struct shaper_params *new_sp = malloc(sizeof(*new_sp));
+        memcpy(new_sp, sp, sizeof(*new_sp));
+        new_sp->active_print_time = print_time;
+        list_add_tail(&new_sp->node, &is->params_list);
+        sp = new_sp;
+    }
+    return shaper_update_axis(is, sp, axis, n, a, t);
+}
+
+// Free scheduled parameter changes that are fully in effect before the
+// last step generation flush. Returns non-zero if changes remain pending.
+int __visible
+input_shaper_cleanup_params(struct stepper_kinematics *sk)
+{
+    struct input_shaper *is = container_of(sk, struct input_shaper, sk);
+    if (!has_scheduled_params(is))
+        return 0;
+    double window = (is->sk.gen_steps_pre_active
+                     + is->sk.gen_steps_post_active);
+    shaper_cleanup_params(is, sk->last_flush_time - window);
+    shaper_note_generation_time(is);
+    return has_scheduled_params(is);
+}
+
+int __visible
+input_shaper_check_shaper_params(int n, double a[], double t[])
+{
+    struct shaper_pulses sp;
+    return init_shaper(n, a, t, &sp);
 }
 
 double __visible
@@ -226,5 +406,22 @@ input_shaper_alloc(void)
     struct input_shaper *is = malloc(sizeof(*is));
     memset(is, 0, sizeof(*is));
     is->m.move_t = 2. * DUMMY_T;
+    list_init(&is->params_list);
+    struct shaper_params *sp = malloc(sizeof(*sp));
+    memset(sp, 0, sizeof(*sp));
+    list_add_tail(&sp->node, &is->params_list);
     return &is->sk;
 }
+
+void __visible
+input_shaper_free(struct stepper_kinematics *sk)
+{
+    struct input_shaper *is = container_of(sk, struct input_shaper, sk);
+    while (!list_empty(&is->params_list)) {
+        struct shaper_params *sp = list_first_entry(
+                &is->params_list, struct shaper_params, node);
+        list_del(&sp->node);
+        free(sp);
+    }
+    free(sk);
+}
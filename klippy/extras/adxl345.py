@@ -3,8 +3,8 @@
 # Copyright (C) 2020-2023  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, time, collections, multiprocessing, os
-from . import bus, bulk_sensor
+import logging, time, collections, multiprocessing, os, sys, array
+from . import bus, bulk_sensor, shaper_calibrate
 
 # ADXL345 registers
 REG_DEVID = 0x00
@@ -30,6 +30,13 @@ SCALE_Z  = 0.003906 * FREEFALL_ACCEL # 1 / 256 (at 3.3V) mg/LSB
 Accel_Measurement = collections.namedtuple(
     'Accel_Measurement', ('time', 'accel_x', 'accel_y', 'accel_z'))
 
+# Number of samples by which the sample storage grows
+SAMPLES_CHUNK = 16384
+# Maximum number of sample batches to store
+MAX_STORED_BATCHES = 10000
+# File extensions of the supported raw data formats
+RAW_DATA_EXTENSIONS = {'csv': 'csv', 'binary': 'bin'}
+
 # Helper class to obtain measurements
 class AccelQueryHelper:
     def __init__(self, printer):
@@ -37,68 +44,88 @@ class AccelQueryHelper:
         self.is_finished = False
         print_time = printer.lookup_object('toolhead').get_last_move_time()
         self.request_start_time = self.request_end_time = print_time
-        self.msgs = []
+        self.is_finishing = False
+        # Samples are stored as flat (time, x, y, z) double values
+        self.sample_data = array.array('d')
+        self.sample_count = 0
+        self.stored_batches = 0
+        self.valid_samples = 0
         self.samples = []
+        self.stream_handlers = []
+        self.keep_samples = True
+    def add_stream_handler(self, handler, keep_samples=True):
+        # Handler is invoked with each batch of samples as they arrive
+        self.stream_handlers.append(handler)
+        self.keep_samples = self.keep_samples and keep_samples
     def finish_measurements(self):
         toolhead = self.printer.lookup_object('toolhead')
         self.request_end_time = toolhead.get_last_move_time()
+        self.is_finishing = True
         toolhead.wait_moves()
         self.is_finished = True
+    def _filter_samples(self, data):
+        # Samples received before finish_measurements() can not be past
+        # the end of the measurements
+        start_time = self.request_start_time
+        if self.is_finishing:
+            end_time = self.request_end_time
+            return [s for s in data if start_time <= s[0] <= end_time]
+        return [s for s in data if s[0] >= start_time]
+    def _store_samples(self, samples):
+        count = self.sample_count + len(samples)
+        if 4 * count > len(self.sample_data):
+            grow = max(count - len(self.sample_data) // 4, SAMPLES_CHUNK)
+            self.sample_data.extend(array.array('d', bytes(32 * grow)))
+        self.sample_data[4*self.sample_count:4*count] = array.array(
+            'd', [v for s in samples for v in s])
+        self.sample_count = count
+        self.samples = []
     def handle_batch(self, msg):
         if self.is_finished:
             return False
-        if len(self.msgs) >= 10000:
+        samples = self._filter_samples(msg['data'])
+        self.valid_samples += len(samples)
+        if samples:
+            for handler in self.stream_handlers:
+                handler(samples)
+        if not self.keep_samples:
+            return True
+        if self.stored_batches >= MAX_STORED_BATCHES:
             # Avoid filling up memory with too many samples
             return False
-        self.msgs.append(msg)
+        self.stored_batches += 1
+        if samples:
+            self._store_samples(samples)
         return True
     def has_valid_samples(self):
-        for msg in self.msgs:
-            data = msg['data']
-            first_sample_time = data[0][0]
-            last_sample_time = data[-1][0]
-            if (first_sample_time > self.request_end_time
-                    or last_sample_time < self.request_start_time):
-                continue
-            # The time intervals [first_sample_time, last_sample_time]
-            # and [request_start_time, request_end_time] have non-zero
-            # intersection. It is still theoretically possible that none
-            # of the samples from msgs fall into the time interval
-            # [request_start_time, request_end_time] if it is too narrow
-            # or on very heavy data losses. In practice, that interval
-            # is at least 1 second, so this possibility is negligible.
-            return True
-        return False
+        return self.valid_samples > 0
+    def get_sample_data(self):
+        return self.sample_data[:4*self.sample_count]
     def get_samples(self):
-        if not self.msgs:
-            return self.samples
-        total = sum([len(m['data']) for m in self.msgs])
-        count = 0
-        self.samples = samples = [None] * total
-        for msg in self.msgs:
-            for samp_time, x, y, z in msg['data']:
-                if samp_time < self.request_start_time:
-                    continue
-                if samp_time > self.request_end_time:
-                    break
-                samples[count] = Accel_Measurement(samp_time, x, y, z)
-                count += 1
-        del samples[count:]
+        if len(self.samples) != self.sample_count:
+            data = self.sample_data
+            self.samples = [Accel_Measurement(*data[i:i+4])
+                            for i in range(0, 4*self.sample_count, 4)]
         return self.samples
-    def write_to_file(self, filename):
+    def write_to_file(self, filename, binary=False):
         def write_impl():
             try:
                 # Try to re-nice writing process
                 os.nice(20)
             except:
                 pass
-            f = open(filename, "w")
-            f.write("#time,accel_x,accel_y,accel_z\n")
-            samples = self.samples or self.get_samples()
-            for t, accel_x, accel_y, accel_z in samples:
-                f.write("%.6f,%.6f,%.6f,%.6f\n" % (
-                    t, accel_x, accel_y, accel_z))
-            f.close()
+            data = self.get_sample_data()
+            if binary:
+                if sys.byteorder != 'little':
+                    data.byteswap()
+                with open(filename, "wb") as f:
+                    f.write(shaper_calibrate.RAW_DATA_MAGIC)
+                    data.tofile(f)
+                return
+            with open(filename, "w") as f:
+                f.write("#time,accel_x,accel_y,accel_z\n")
+                for i in range(0, len(data), 4):
+                    f.write("%.6f,%.6f,%.6f,%.6f\n" % tuple(data[i:i+4]))
         write_proc = multiprocessing.Process(target=write_impl)
         write_proc.daemon = True
         write_proc.start()
@@ -142,15 +169,20 @@ class AccelCommandHelper:
         name = gcmd.get("NAME", time.strftime("%Y%m%d_%H%M%S"))
         if not name.replace('-', '').replace('_', '').isalnum():
             raise gcmd.error("Invalid NAME parameter")
+        file_format = gcmd.get("FORMAT", "csv").lower()
+        if file_format not in RAW_DATA_EXTENSIONS:
+            raise gcmd.error("Invalid FORMAT parameter")
         bg_client = self.bg_client
         self.bg_client = None
         bg_client.finish_measurements()
         # Write data to file
+        ext = RAW_DATA_EXTENSIONS[file_format]
         if self.base_name == self.name:
-            filename = "/tmp/%s-%s.csv" % (self.base_name, name)
+            filename = "/tmp/%s-%s.%s" % (self.base_name, name, ext)
         else:
-            filename = "/tmp/%s-%s-%s.csv" % (self.base_name, self.name, name)
-        bg_client.write_to_file(filename)
+            filename = "/tmp/%s-%s-%s.%s" % (self.base_name, self.name,
+                                             name, ext)
+        bg_client.write_to_file(filename, binary=(file_format == 'binary'))
         gcmd.respond_info("Writing raw accelerometer data to %s file"
                           % (filename,))
     cmd_ACCELEROMETER_QUERY_help = "Query accelerometer for the current values"
@@ -3,7 +3,7 @@
 # Copyright (C) 2018-2019 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, math, json, collections
+import logging, math, json, collections, os, struct, zlib
 from . import probe
 
 PROFILE_VERSION = 1
@@ -13,6 +13,14 @@ PROFILE_OPTIONS = {
     'algo': str, 'tension': float
 }
 
+# Binary profile data file layout (little endian): a header with the
+# format version and counts, the probed z values in row order (float32)
+# and one record for each stored probe result.
+PROFILE_FILE_MAGIC = b'KBMP'
+PROFILE_FILE_VERSION = 1
+PROFILE_FILE_HEADER = struct.Struct('<4sHHHI')
+PROFILE_FILE_RESULT = struct.Struct('<fffdff')
+
 class BedMeshError(Exception):
     pass
 
@@ -82,6 +90,78 @@ def parse_gcmd_coord(gcmd, name):
         raise gcmd.error("Unable to parse parameter '%s'" % (name,))
     return v1, v2
 
+def pack_profile_data(probed_matrix, probe_results):
+    y_cnt = len(probed_matrix)
+    x_cnt = len(probed_matrix[0])
+    probe_results = probe_results or []
+    data = [PROFILE_FILE_HEADER.pack(PROFILE_FILE_MAGIC, PROFILE_FILE_VERSION,
+                                     x_cnt, y_cnt, len(probe_results))]
+    zvals = [z for row in probed_matrix for z in row]
+    data.append(struct.pack('<%df' % (len(zvals),), *zvals))
+    for res in probe_results:
+        data.append(PROFILE_FILE_RESULT.pack(*res))
+    return b''.join(data)
+
+def write_profile_file(filename, data):
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    # Replace the file atomically so a partial write is never loaded
+    temp_name = "%s.%d.tmp" % (filename, os.getpid())
+    with open(temp_name, 'wb') as f:
+        f.write(data)
+    os.rename(temp_name, filename)
+
+def read_profile_file(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    hdr_size = PROFILE_FILE_HEADER.size
+    if len(data) < hdr_size:
+        raise BedMeshError("bed_mesh: Profile file %s is truncated"
+                           % (filename,))
+    magic, version, x_cnt, y_cnt, res_cnt = \
+        PROFILE_FILE_HEADER.unpack_from(data)
+    if magic != PROFILE_FILE_MAGIC or version != PROFILE_FILE_VERSION:
+        raise BedMeshError("bed_mesh: Profile file %s has an unknown format"
+                           % (filename,))
+    res_size = PROFILE_FILE_RESULT.size
+    expected = hdr_size + 4 * x_cnt * y_cnt + res_size * res_cnt
+    if len(data) != expected:
+        raise BedMeshError("bed_mesh: Profile file %s is truncated"
+                           % (filename,))
+    zvals = struct.unpack_from('<%df' % (x_cnt * y_cnt,), data, hdr_size)
+    zvals = [round(z, 6) for z in zvals]
+    probed_matrix = [zvals[i*x_cnt:(i+1)*x_cnt] for i in range(y_cnt)]
+    pos = hdr_size + 4 * x_cnt * y_cnt
+    probe_results = []
+    for i in range(res_cnt):
+        probe_results.append(PROFILE_FILE_RESULT.unpack_from(data, pos))
+        pos += res_size
+    return probed_matrix, (probe_results or None)
+
+# Least squares fit of the plane z = a + b*x + c*y to a list of (x, y, z)
+# points.  Returns a function that evaluates the plane.
+def fit_plane(points):
+    count = len(points)
+    mx = sum([p[0] for p in points]) / count
+    my = sum([p[1] for p in points]) / count
+    mz = sum([p[2] for p in points]) / count
+    sxx = sum([(p[0] - mx)**2 for p in points])
+    syy = sum([(p[1] - my)**2 for p in points])
+    sxy = sum([(p[0] - mx) * (p[1] - my) for p in points])
+    sxz = sum([(p[0] - mx) * (p[2] - mz) for p in points])
+    syz = sum([(p[1] - my) * (p[2] - mz) for p in points])
+    det = sxx * syy - sxy * sxy
+    if abs(det) < 1e-9:
+        # Points are collinear, only correct the average offset
+        slope_x = slope_y = 0.
+    else:
+        slope_x = (syy * sxz - sxy * syz) / det
+        slope_y = (sxx * syz - sxy * sxz) / det
+    def calc_z(x, y):
+        return mz + slope_x * (x - mx) + slope_y * (y - my)
+    return calc_z
+
 
 class BedMesh:
     FADE_DISABLE = 0x7FFFFFFF
@@ -341,6 +421,7 @@ class BedMeshCalibrate:
             )
         except BedMeshError as e:
             raise config.error(str(e))
+        self.recal_helper = RecalibrateHelper(config, self)
         self._profile_name = "default"
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command(
@@ -448,12 +529,21 @@ class BedMeshCalibrate:
     def set_adaptive_mesh(self, gcmd):
         if not gcmd.get_int('ADAPTIVE', 0):
             return False
+        objects = []
         exclude_objects = self.printer.lookup_object("exclude_object", None)
-        if exclude_objects is None:
-            gcmd.respond_info("Exclude objects not enabled. Using full mesh...")
-            return False
-        objects = exclude_objects.get_status().get("objects", [])
+        if exclude_objects is not None:
+            objects = exclude_objects.get_status().get("objects", [])
+        if not objects:
+            # Fall back to the object bounds found by file analysis
+            file_analysis = self.printer.lookup_object("file_analysis", None)
+            if file_analysis is not None:
+                objects = file_analysis.get_current_objects()
+                if objects:
+                    gcmd.respond_info("Using objects from file analysis")
         if not objects:
+            if exclude_objects is None:
+                gcmd.respond_info(
+                    "Exclude objects not enabled. Using full mesh...")
             return False
         margin = gcmd.get_float('ADAPTIVE_MARGIN', self.adaptive_margin)
 
@@ -647,13 +737,27 @@ class BedMeshCalibrate:
             self.update_config(gcmd)
         except BedMeshError as e:
             raise gcmd.error(str(e))
+        if gcmd.get_int('RECALIBRATE', 0, minval=0, maxval=1):
+            if self._profile_name is None:
+                raise gcmd.error(
+                    "bed_mesh: RECALIBRATE is not available for adaptive"
+                    " meshes")
+            results = self.bedmesh.pmgr.get_probe_results(self._profile_name)
+            self.recal_helper.start_recalibrate(
+                gcmd, self._profile_name, results)
+            return
         self.probe_mgr.start_probe(gcmd)
-    def probe_finalize(self, offsets, positions):
+    def probe_finalize(self, offsets, positions, probe_info=None):
+        # probe_info holds the time and temperatures of each position
+        if probe_info is None:
+            probe_info = self.probe_mgr.get_point_info()
+        probe_info = list(probe_info)
         z_offset = offsets[2]
         positions = [[round(p[0], 2), round(p[1], 2), p[2]]
                      for p in positions]
         if self.probe_mgr.get_zero_ref_mode() == ZrefMode.PROBE:
             ref_pos = positions.pop()
+            probe_info.pop()
             logging.info(
                 "bed_mesh: z-offset replaced with probed z value at "
                 "position (%.2f, %.2f, %.6f)"
@@ -676,6 +780,7 @@ class BedMeshCalibrate:
             # point.  Its Z Value is the average probed Z of the
             # substituted points.
             corrected_pts = []
+            corrected_info = []
             idx_offset = 0
             start_idx = 0
             for i, pts in substitutes.items():
@@ -684,6 +789,7 @@ class BedMeshCalibrate:
                 idx = i + idx_offset
                 # Add "normal" points
                 corrected_pts.extend(positions[start_idx:idx])
+                corrected_info.extend(probe_info[start_idx:idx])
                 avg_z = sum([p[2] for p in positions[idx:idx+len(pts)]]) \
                     / len(pts)
                 idx_offset += len(pts) - 1
@@ -694,17 +800,24 @@ class BedMeshCalibrate:
                     " (%.4f, %.4f): avg value = %.6f, avg w/ z_offset = %.6f"
                     % (i, fpt[0], fpt[1], avg_z, avg_z - z_offset))
                 corrected_pts.append(fpt)
+                # Use the time and temperatures of the last substitute
+                corrected_info.extend(probe_info[start_idx-1:start_idx])
             corrected_pts.extend(positions[start_idx:])
+            corrected_info.extend(probe_info[start_idx:])
             positions = corrected_pts
+            probe_info = corrected_info
 
         # validate length of result
-        if len(base_points) != len(positions):
+        if len(base_points) != len(positions) or \
+                len(positions) != len(probe_info):
             self._dump_points(probed_pts, positions, offsets)
             raise self.gcode.error(
                 "bed_mesh: invalid position list size, "
                 "generated count: %d, probed count: %d"
                 % (len(base_points), len(positions))
             )
+        probe_results = [tuple(pos) + tuple(info)
+                         for pos, info in zip(positions, probe_info)]
 
         probed_matrix = []
         row = []
@@ -773,6 +886,7 @@ class BedMeshCalibrate:
             z_mesh.build_mesh(probed_matrix)
         except BedMeshError as e:
             raise self.gcode.error(str(e))
+        z_mesh.set_probe_results(probe_results)
         if self.probe_mgr.get_zero_ref_mode() == ZrefMode.IN_MESH:
             # The reference can be anywhere in the mesh, therefore
             # it is necessary to set the reference after the initial mesh
@@ -881,6 +995,9 @@ class ProbeManager:
     def get_substitutes(self):
         return self.substitutes
 
+    def get_point_info(self):
+        return self.probe_helper.get_point_info()
+
     def generate_points(
         self, mesh_config, mesh_min, mesh_max, radius, origin,
         probe_method="automatic"
@@ -1208,6 +1325,7 @@ class RapidScanHelper:
         probe_session = pprobe.start_probe_session(gcmd)
         offsets = pprobe.get_offsets()
         initial_move = True
+        probe_info = []
         for pos, is_probe_pt in self.probe_manager.iter_rapid_path():
             pos = self._apply_offsets(pos[:2], offsets)
             toolhead.manual_move(pos, speed)
@@ -1216,9 +1334,10 @@ class RapidScanHelper:
                 self._move_to_scan_height(gcmd, scan_height)
             if is_probe_pt:
                 probe_session.run_probe(gcmd)
+                probe_info.append(probe.get_point_info(self.printer))
         results = probe_session.pull_probed_results()
         toolhead.get_last_move_time()
-        self.finalize_callback(offsets, results)
+        self.finalize_callback(offsets, results, probe_info)
         probe_session.end_probe_session()
 
     def _raise_tool(self, gcmd, scan_height):
@@ -1251,6 +1370,183 @@ class RapidScanHelper:
         return [(pos - ofs) for pos, ofs in zip(point, offsets)]
 
 
+# Fast recalibration of a mesh from the probe results stored with a
+# profile.  A sparse subset of the points is probed and a plane is fit
+# to the change in height.  Points near a sparse sample that deviates
+# from the plane by more than the threshold are probed again, all other
+# points are estimated from their stored value and the fitted plane.
+class RecalibrateHelper:
+    def __init__(self, config, bmc):
+        self.printer = config.get_printer()
+        self.bmc = bmc
+        self.probe_count = parse_config_pair(
+            config, 'recalibrate_probe_count', 3, minval=2)
+        self.threshold = config.getfloat('recalibrate_threshold', .02,
+                                         above=0.)
+        self.probe_helper = probe.ProbePointsHelper(
+            config, self._probe_finalize, [])
+        self.probe_helper.use_xy_offsets(True)
+        self.results = []
+        self.sparse = []
+        self.reprobe = []
+        self.new_z = {}
+        self.new_info = {}
+        self.correction = None
+        self.zero_ref_result = None
+        self.zero_ref_info = None
+        self.max_residual = 0.
+        self.active_threshold = self.threshold
+
+    def start_recalibrate(self, gcmd, prof_name, results):
+        probe_mgr = self.bmc.probe_mgr
+        method = gcmd.get("METHOD", "automatic").lower()
+        pprobe = self.printer.lookup_object("probe", None)
+        if pprobe is None or method != "automatic":
+            raise gcmd.error(
+                "bed_mesh: RECALIBRATE requires automatic probing")
+        offsets = pprobe.get_offsets()
+        base_points = probe_mgr.get_base_points()
+        matched = results is not None and len(results) == len(base_points)
+        for pt, res in zip(base_points, results or []):
+            if (not isclose(pt[0] - offsets[0], res[0], abs_tol=.5) or
+                    not isclose(pt[1] - offsets[1], res[1], abs_tol=.5)):
+                matched = False
+                break
+        if not matched:
+            raise gcmd.error(
+                "bed_mesh: No stored probe results for profile [%s] match"
+                " the current mesh, a full BED_MESH_CALIBRATE is required"
+                % (prof_name,))
+        self.active_threshold = gcmd.get_float(
+            'THRESHOLD', self.threshold, above=0.)
+        x_cnt, y_cnt = self.probe_count
+        if "RECALIBRATE_COUNT" in gcmd.get_command_parameters():
+            x_cnt, y_cnt = parse_gcmd_pair(gcmd, 'RECALIBRATE_COUNT',
+                                           minval=2)
+        self.results = results
+        self.sparse = self._select_sparse(x_cnt, y_cnt)
+        self.reprobe = []
+        self.new_z = {}
+        self.new_info = {}
+        self.max_residual = 0.
+        points = [base_points[i] for i in self.sparse]
+        if probe_mgr.get_zero_ref_mode() == ZrefMode.PROBE:
+            points.append(probe_mgr.get_zero_ref_pos())
+        self.probe_helper.update_probe_points(points, 3)
+        self.probe_helper.start_probe(gcmd)
+
+    def _select_sparse(self, x_cnt, y_cnt):
+        # Choose the stored points closest to an evenly spaced grid
+        substitutes = self.bmc.probe_mgr.get_substitutes()
+        candidates = [i for i in range(len(self.results))
+                      if i not in substitutes]
+        min_x = min([self.results[i][0] for i in candidates])
+        max_x = max([self.results[i][0] for i in candidates])
+        min_y = min([self.results[i][1] for i in candidates])
+        max_y = max([self.results[i][1] for i in candidates])
+        sparse = []
+        for yi in range(y_cnt):
+            ypos = lerp(yi / (y_cnt - 1.), min_y, max_y)
+            x_indices = list(range(x_cnt))
+            if yi & 1:
+                # Probe in a zig-zag pattern
+                x_indices.reverse()
+            for xi in x_indices:
+                xpos = lerp(xi / (x_cnt - 1.), min_x, max_x)
+                idx = min(candidates, key=lambda i: (
+                    (self.results[i][0] - xpos)**2
+                    + (self.results[i][1] - ypos)**2))
+                if idx not in sparse:
+                    sparse.append(idx)
+        if len(sparse) < 3:
+            raise self.printer.command_error(
+                "bed_mesh: Not enough points available for recalibration")
+        return sparse
+
+    def _nearest_sparse(self, idx):
+        res = self.results[idx]
+        return min(self.sparse, key=lambda i: (
+            (self.results[i][0] - res[0])**2
+            + (self.results[i][1] - res[1])**2))
+
+    def _probe_finalize(self, offsets, positions):
+        probe_mgr = self.bmc.probe_mgr
+        point_info = self.probe_helper.get_point_info()
+        if not self.reprobe:
+            # Sparse pass
+            if probe_mgr.get_zero_ref_mode() == ZrefMode.PROBE:
+                self.zero_ref_result = positions.pop()
+                self.zero_ref_info = point_info.pop()
+            for idx, pos, info in zip(self.sparse, positions, point_info):
+                self.new_z[idx] = pos[2]
+                self.new_info[idx] = info
+            deltas = [(self.results[i][0], self.results[i][1],
+                       self.new_z[i] - self.results[i][2])
+                      for i in self.sparse]
+            self.correction = fit_plane(deltas)
+            # Refit without samples that clearly don't lie on the plane
+            inliers = [d for d in deltas if abs(d[2] - self.correction(
+                d[0], d[1])) <= self.active_threshold]
+            if len(inliers) >= 3 and len(inliers) < len(deltas):
+                self.correction = fit_plane(inliers)
+            outliers = []
+            for idx, (x, y, delta) in zip(self.sparse, deltas):
+                residual = abs(delta - self.correction(x, y))
+                self.max_residual = max(self.max_residual, residual)
+                if residual > self.active_threshold:
+                    outliers.append(idx)
+            self.reprobe = [i for i in range(len(self.results))
+                            if i not in self.new_z
+                            and self._nearest_sparse(i) in outliers]
+            if self.reprobe:
+                # Probe the regions around the outliers
+                base_points = probe_mgr.get_base_points()
+                substitutes = probe_mgr.get_substitutes()
+                points = []
+                for idx in self.reprobe:
+                    points.extend(substitutes.get(idx, [base_points[idx]]))
+                self.probe_helper.update_probe_points(points, 1)
+                return "retry"
+        else:
+            # Re-probe pass (average the substitutes of faulty points)
+            substitutes = probe_mgr.get_substitutes()
+            pos_idx = 0
+            for idx in self.reprobe:
+                count = len(substitutes.get(idx, [None]))
+                z_vals = [p[2] for p in positions[pos_idx:pos_idx+count]]
+                pos_idx += count
+                self.new_z[idx] = sum(z_vals) / count
+                self.new_info[idx] = point_info[pos_idx - 1]
+        self._finalize_mesh(offsets)
+
+    def _finalize_mesh(self, offsets):
+        probe_mgr = self.bmc.probe_mgr
+        substitutes = probe_mgr.get_substitutes()
+        positions = []
+        probe_info = []
+        for idx, res in enumerate(self.results):
+            if idx in self.new_z:
+                z = self.new_z[idx]
+                info = self.new_info[idx]
+            else:
+                z = res[2] + self.correction(res[0], res[1])
+                info = tuple(res[3:])
+            # Report substituted points once for each substitute
+            for i in range(len(substitutes.get(idx, [None]))):
+                positions.append([res[0], res[1], z])
+                probe_info.append(info)
+        if probe_mgr.get_zero_ref_mode() == ZrefMode.PROBE:
+            positions.append(self.zero_ref_result)
+            probe_info.append(self.zero_ref_info)
+        probed = len(self.new_z)
+        self.bmc.gcode.respond_info(
+            "Mesh recalibration: probed %d of %d points (%d sparse,"
+            " %d re-probed), max residual %.4f"
+            % (probed, len(self.results), len(self.sparse),
+               probed - len(self.sparse), self.max_residual))
+        self.reprobe = []
+        self.bmc.probe_finalize(offsets, positions, probe_info)
+
 class MoveSplitter:
     def __init__(self, config, gcode):
         self.split_delta_z = config.getfloat(
@@ -1319,6 +1615,7 @@ class ZMesh:
     def __init__(self, params, name):
         self.profile_name = name or "adaptive-%X" % (id(self),)
         self.probed_matrix = self.mesh_matrix = None
+        self.probe_results = None
         self.mesh_params = params
         self.mesh_offsets = [0., 0.]
         logging.debug('bed_mesh: probe/mesh parameters:')
@@ -1366,6 +1663,12 @@ class ZMesh:
         return [[]]
     def get_mesh_params(self):
         return self.mesh_params
+    def set_probe_results(self, results):
+        # List of (x, y, z, time, bed_temp, extruder_temp) for each probe
+        # point, as reported by the probe (before any z offset is applied)
+        self.probe_results = results
+    def get_probe_results(self):
+        return self.probe_results
     def get_profile_name(self):
         return self.profile_name
     def print_probed_matrix(self, print_func):
@@ -1628,7 +1931,17 @@ class ProfileManager:
         self.gcode = self.printer.lookup_object('gcode')
         self.bedmesh = bedmesh
         self.profiles = {}
+        self.probe_results = {}
+        self.profile_files = {}
+        # Data files referenced by the printer config and those written
+        # since startup: {prof_name: filename}
+        self.saved_files = {}
+        self.pending_files = {}
         self.incompatible_profiles = []
+        self.profile_path = config.get('profile_path', None)
+        if self.profile_path is not None:
+            self.profile_path = os.path.normpath(
+                os.path.expanduser(self.profile_path))
         # Fetch stored profiles from Config
         stored_profs = config.get_prefix_sections(self.name)
         stored_profs = [s for s in stored_profs
@@ -1644,7 +1957,15 @@ class ProfileManager:
                 self.incompatible_profiles.append(name)
                 continue
             self.profiles[name] = {}
-            zvals = profile.getlists('points', seps=(',', '\n'), parser=float)
+            points_file = profile.get('points_file', None)
+            if points_file is not None:
+                # Points are read from the data file when first needed
+                self.profile_files[name] = points_file
+                self.saved_files[name] = points_file
+                zvals = []
+            else:
+                zvals = profile.getlists('points', seps=(',', '\n'),
+                                         parser=float)
             self.profiles[name]['points'] = zvals
             self.profiles[name]['mesh_params'] = params = \
                 collections.OrderedDict()
@@ -1661,6 +1982,55 @@ class ProfileManager:
             desc=self.cmd_BED_MESH_PROFILE_help)
     def get_profiles(self):
         return self.profiles
+    def get_probe_results(self, prof_name):
+        if prof_name in self.profiles:
+            self._load_profile_file(prof_name)
+        return self.probe_results.get(prof_name)
+    def _get_profile_filename(self, prof_name, data):
+        # The file name includes a checksum of its contents so that a
+        # profile saved without a SAVE_CONFIG never replaces the data
+        # file referenced by the printer config
+        fname = "".join([c if c.isalnum() or c in "-_" else "_"
+                         for c in prof_name])
+        return os.path.join(self.profile_path, "%s-%08x.mesh"
+                            % (fname, zlib.crc32(data) & 0xffffffff))
+    def _remove_pending_file(self, prof_name, keep_file=None):
+        # Remove a data file that isn't referenced by the printer config
+        filename = self.pending_files.pop(prof_name, None)
+        if filename is None or filename in (keep_file,
+                                            self.saved_files.get(prof_name)):
+            return
+        try:
+            os.remove(filename)
+        except OSError:
+            logging.exception("bed_mesh: Unable to remove profile file")
+    def _load_profile_file(self, prof_name):
+        filename = self.profile_files.pop(prof_name, None)
+        if filename is None:
+            return
+        try:
+            probed_matrix, probe_results = read_profile_file(filename)
+        except (IOError, OSError, BedMeshError) as e:
+            self.profile_files[prof_name] = filename
+            logging.exception("bed_mesh: Unable to read profile file")
+            raise self.gcode.error(
+                "bed_mesh: Unable to read data of profile [%s]: %s"
+                % (prof_name, str(e)))
+        params = self.profiles[prof_name]['mesh_params']
+        if (len(probed_matrix) != params['y_count']
+                or len(probed_matrix[0]) != params['x_count']):
+            self.profile_files[prof_name] = filename
+            raise self.gcode.error(
+                "bed_mesh: Data file %s does not match profile [%s]"
+                % (filename, prof_name))
+        # ensure any self.profiles returned as status remains immutable
+        profiles = dict(self.profiles)
+        profiles[prof_name] = profile = dict(profiles[prof_name])
+        profile['points'] = probed_matrix
+        self.profiles = profiles
+        if probe_results is not None:
+            self.probe_results[prof_name] = probe_results
+        self.bedmesh.update_status()
     def _check_incompatible_profiles(self):
         if self.incompatible_profiles:
             configfile = self.printer.lookup_object('configfile')
@@ -1681,17 +2051,41 @@ class ProfileManager:
             return
         probed_matrix = z_mesh.get_probed_matrix()
         mesh_params = z_mesh.get_mesh_params()
+        probe_results = z_mesh.get_probe_results()
         configfile = self.printer.lookup_object('configfile')
         cfg_name = self.name + " " + prof_name
-        # set params
-        z_values = ""
-        for line in probed_matrix:
-            z_values += "\n  "
-            for p in line:
-                z_values += "%.6f, " % p
-            z_values = z_values[:-2]
-        configfile.set(cfg_name, 'version', PROFILE_VERSION)
-        configfile.set(cfg_name, 'points', z_values)
+        if self.profile_path is not None:
+            # Store the points in a data file, the config only holds the
+            # mesh parameters and a reference to the file
+            data = pack_profile_data(probed_matrix, probe_results)
+            filename = self._get_profile_filename(prof_name, data)
+            try:
+                write_profile_file(filename, data)
+            except (IOError, OSError) as e:
+                logging.exception("bed_mesh: Unable to write profile file")
+                raise self.gcode.error(
+                    "bed_mesh: Unable to write profile file %s: %s"
+                    % (filename, str(e)))
+            self._remove_pending_file(prof_name, filename)
+            self.pending_files[prof_name] = filename
+            configfile.remove_section(cfg_name)
+            configfile.set(cfg_name, 'version', PROFILE_VERSION)
+            configfile.set(cfg_name, 'points_file', filename)
+        else:
+            if prof_name in self.profile_files:
+                # Don't keep a stale file reference
+                configfile.remove_section(cfg_name)
+            # set params
+            z_values = ""
+            for line in probed_matrix:
+                z_values += "\n  "
+                for p in line:
+                    z_values += "%.6f, " % p
+                z_values = z_values[:-2]
+            configfile.set(cfg_name, 'version', PROFILE_VERSION)
+            configfile.set(cfg_name, 'points', z_values)
+            # Probe results are only kept in memory, storing them as text
+            # would considerably grow the printer config
         for key, value in mesh_params.items():
             configfile.set(cfg_name, key, value)
         # save copy in local storage
@@ -1701,6 +2095,10 @@ class ProfileManager:
         profile['points'] = probed_matrix
         profile['mesh_params'] = collections.OrderedDict(mesh_params)
         self.profiles = profiles
+        self.profile_files.pop(prof_name, None)
+        self.probe_results.pop(prof_name, None)
+        if probe_results is not None:
+            self.probe_results[prof_name] = probe_results
         self.bedmesh.update_status()
         self.gcode.respond_info(
             "Bed Mesh state has been saved to profile [%s]\n"
@@ -1712,6 +2110,8 @@ class ProfileManager:
         if profile is None:
             raise self.gcode.error(
                 "bed_mesh: Unknown profile [%s]" % prof_name)
+        self._load_profile_file(prof_name)
+        profile = self.profiles[prof_name]
         probed_matrix = profile['points']
         mesh_params = profile['mesh_params']
         z_mesh = ZMesh(mesh_params, prof_name)
@@ -1719,6 +2119,7 @@ class ProfileManager:
             z_mesh.build_mesh(probed_matrix)
         except BedMeshError as e:
             raise self.gcode.error(str(e))
+        z_mesh.set_probe_results(self.probe_results.get(prof_name))
         self.bedmesh.set_mesh(z_mesh)
     def remove_profile(self, prof_name):
         if prof_name in self.profiles:
@@ -1727,6 +2128,9 @@ class ProfileManager:
             profiles = dict(self.profiles)
             del profiles[prof_name]
             self.profiles = profiles
+            self.probe_results.pop(prof_name, None)
+            self.profile_files.pop(prof_name, None)
+            self._remove_pending_file(prof_name)
             self.bedmesh.update_status()
             self.gcode.respond_info(
                 "Profile [%s] removed from storage for this session.\n"
@@ -5,9 +5,78 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
-import logging
+import logging, math, bisect
 import json
 
+# Grid of object outlines for fast point and region lookups
+class ObjectIndex:
+    def __init__(self, objects):
+        self.outlines = {}
+        self.cells = {}
+        self.cell_size = 1.
+        for obj in objects:
+            polygon = obj.get('polygon')
+            if not polygon:
+                continue
+            try:
+                points = [(float(p[0]), float(p[1])) for p in polygon]
+            except (TypeError, ValueError, IndexError):
+                continue
+            xs = [p[0] for p in points]
+            ys = [p[1] for p in points]
+            bbox = (min(xs), min(ys), max(xs), max(ys))
+            self.outlines[obj['name']] = (bbox, points)
+        if not self.outlines:
+            return
+        # Use cells roughly the size of an average object
+        sizes = [max(b[2] - b[0], b[3] - b[1])
+                 for b, points in self.outlines.values()]
+        self.cell_size = max(sum(sizes) / len(sizes), 1.)
+        for name, (bbox, points) in self.outlines.items():
+            x_range, y_range = self._get_cell_ranges(*bbox)
+            for cell in [(x, y) for x in x_range for y in y_range]:
+                self.cells.setdefault(cell, []).append(name)
+    def _get_cell_ranges(self, min_x, min_y, max_x, max_y):
+        cs = self.cell_size
+        return (range(int(math.floor(min_x / cs)),
+                      int(math.floor(max_x / cs)) + 1),
+                range(int(math.floor(min_y / cs)),
+                      int(math.floor(max_y / cs)) + 1))
+    def _point_in_polygon(self, x, y, points):
+        inside = False
+        px, py = points[-1]
+        for nx, ny in points:
+            if (ny > y) != (py > y):
+                if x < (px - nx) * (y - ny) / (py - ny) + nx:
+                    inside = not inside
+            px, py = nx, ny
+        return inside
+    def lookup_point(self, x, y):
+        cs = self.cell_size
+        cell = (int(math.floor(x / cs)), int(math.floor(y / cs)))
+        out = []
+        for name in self.cells.get(cell, []):
+            (min_x, min_y, max_x, max_y), points = self.outlines[name]
+            if (min_x <= x <= max_x and min_y <= y <= max_y
+                and self._point_in_polygon(x, y, points)):
+                out.append(name)
+        return sorted(out)
+    def lookup_region(self, min_x, min_y, max_x, max_y):
+        x_range, y_range = self._get_cell_ranges(min_x, min_y, max_x, max_y)
+        if len(x_range) * len(y_range) > len(self.cells):
+            # Large region - faster to check every occupied cell
+            cells = list(self.cells.keys())
+        else:
+            cells = [(x, y) for x in x_range for y in y_range]
+        out = set()
+        for cell in cells:
+            for name in self.cells.get(cell, []):
+                bbox = self.outlines[name][0]
+                if (bbox[0] <= max_x and bbox[2] >= min_x
+                    and bbox[1] <= max_y and bbox[3] >= min_y):
+                    out.add(name)
+        return sorted(out)
+
 class ExcludeObject:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -55,6 +124,7 @@ class ExcludeObject:
             self.get_position()
             self.last_position_extruded[:] = self.last_position
             self.last_position_excluded[:] = self.last_position
+            self._update_move_state()
 
     def _handle_connect(self):
         self.toolhead = self.printer.lookup_object('toolhead')
@@ -74,9 +144,47 @@ class ExcludeObject:
 
     def _reset_state(self):
         self.objects = []
+        self.object_map = {}
+        self.object_index = None
         self.excluded_objects = []
         self.current_object = None
+        self.current_excluded = False
         self.in_excluded_region = False
+        self.fast_move = False
+        self.status = {
+            "objects": self.objects,
+            "excluded_objects": self.excluded_objects,
+            "current_object": self.current_object
+        }
+
+    def _update_move_state(self):
+        # Note if moves can bypass the extrusion offset tracking
+        self.current_excluded = self.current_object in self.excluded_objects
+        self.fast_move = False
+        if self.next_transform is None or self.in_excluded_region \
+            or self.current_excluded or self.initial_extrusion_moves > 0 \
+            or self.extruder_adj != 0:
+            return
+        for offset in self.extrusion_offsets.values():
+            if any(offset):
+                return
+        self.fast_move = True
+
+    def _update_status(self, field, value):
+        # A new dict is created so that status subscribers detect the change
+        status = dict(self.status)
+        status[field] = value
+        self.status = status
+
+    def _set_current_object(self, name):
+        self.current_object = name
+        self._update_status("current_object", name)
+        self._update_move_state()
+
+    def _set_excluded_objects(self, excluded_objects):
+        self.excluded_objects = excluded_objects
+        self._update_status("excluded_objects", excluded_objects)
+        self._update_move_state()
 
     def _reset_file(self):
         self._reset_state()
@@ -166,20 +274,35 @@ class ExcludeObject:
 
     def _test_in_excluded_region(self):
         # Inside cancelled object
-        return self.current_object in self.excluded_objects \
-            and self.initial_extrusion_moves == 0
+        return self.current_excluded and self.initial_extrusion_moves == 0
 
     def get_status(self, eventtime=None):
-        status = {
-            "objects": self.objects,
-            "excluded_objects": self.excluded_objects,
-            "current_object": self.current_object
-        }
-        return status
+        return self.status
+
+    def get_objects_at(self, x, y):
+        # Return the names of the objects with an outline containing x, y
+        if self.object_index is None:
+            self.object_index = ObjectIndex(self.objects)
+        return self.object_index.lookup_point(x, y)
+
+    def get_objects_in_region(self, min_x, min_y, max_x, max_y):
+        # Return the names of the objects with an outline overlapping the
+        # given rectangle
+        if self.object_index is None:
+            self.object_index = ObjectIndex(self.objects)
+        return self.object_index.lookup_region(min_x, min_y, max_x, max_y)
 
     def move(self, newpos, speed):
-        move_in_excluded_region = self._test_in_excluded_region()
         self.last_speed = speed
+        if self.fast_move:
+            # No offsets to apply (equivalent to _normal_move)
+            self.last_position[:] = newpos
+            self.last_position_extruded[:] = newpos
+            if newpos[3] > self.max_position_extruded:
+                self.max_position_extruded = newpos[3]
+            self.next_transform.move(newpos, speed)
+            return
+        move_in_excluded_region = self._test_in_excluded_region()
 
         if move_in_excluded_region:
             if self.in_excluded_region:
@@ -191,14 +314,15 @@ class ExcludeObject:
                 self._move_from_excluded_region(newpos, speed)
             else:
                 self._normal_move(newpos, speed)
+        self._update_move_state()
 
     cmd_EXCLUDE_OBJECT_START_help = "Marks the beginning the current object" \
                                     " as labeled"
     def cmd_EXCLUDE_OBJECT_START(self, gcmd):
         name = gcmd.get('NAME').upper()
-        if not any(obj["name"] == name for obj in self.objects):
+        if name not in self.object_map:
             self._add_object_definition({"name": name})
-        self.current_object = name
+        self._set_current_object(name)
         self.was_excluded_at_start = self._test_in_excluded_region()
 
     cmd_EXCLUDE_OBJECT_END_help = "Marks the end the current object"
@@ -213,12 +337,13 @@ class ExcludeObject:
                               " current object NAME=%s" %
                               (name.upper(), self.current_object))
 
-        self.current_object = None
+        self._set_current_object(None)
 
     cmd_EXCLUDE_OBJECT_help = "Cancel moves inside a specified objects"
     def cmd_EXCLUDE_OBJECT(self, gcmd):
         reset = gcmd.get('RESET', None)
         current = gcmd.get('CURRENT', None)
+        point = gcmd.get('POINT', None)
         name = gcmd.get('NAME', '').upper()
 
         if reset:
@@ -226,7 +351,7 @@ class ExcludeObject:
                 self._unexclude_object(name)
 
             else:
-                self.excluded_objects = []
+                self._set_excluded_objects([])
 
         elif name:
             if name.upper() not in self.excluded_objects:
@@ -239,6 +364,19 @@ class ExcludeObject:
             else:
                 self._exclude_object(self.current_object)
 
+        elif point:
+            try:
+                x, y = json.loads('[%s]' % point)
+                x, y = float(x), float(y)
+            except (ValueError, TypeError):
+                raise gcmd.error("Invalid POINT '%s'" % (point,))
+            names = self.get_objects_at(x, y)
+            if not names:
+                raise gcmd.error('There is no object at %.3f,%.3f' % (x, y))
+            for name in names:
+                if name not in self.excluded_objects:
+                    self._exclude_object(name)
+
         else:
             self._list_excluded_objects(gcmd)
 
@@ -271,21 +409,30 @@ class ExcludeObject:
             self._list_objects(gcmd)
 
     def _add_object_definition(self, definition):
-        self.objects = sorted(self.objects + [definition],
-                              key=lambda o: o["name"])
+        # A new list is created so that status updates detect the change
+        name = definition["name"]
+        names = [obj["name"] for obj in self.objects]
+        objects = list(self.objects)
+        objects.insert(bisect.bisect_right(names, name), definition)
+        self.objects = objects
+        self.object_map[name] = definition
+        self.object_index = None
+        self._update_status("objects", objects)
 
     def _exclude_object(self, name):
         self._register_transform()
         self.gcode.respond_info('Excluding object {}'.format(name.upper()))
         if name not in self.excluded_objects:
-            self.excluded_objects = sorted(self.excluded_objects + [name])
+            excluded_objects = list(self.excluded_objects)
+            bisect.insort(excluded_objects, name)
+            self._set_excluded_objects(excluded_objects)
 
     def _unexclude_object(self, name):
         self.gcode.respond_info('Unexcluding object {}'.format(name.upper()))
         if name in self.excluded_objects:
             excluded_objects = list(self.excluded_objects)
             excluded_objects.remove(name)
-            self.excluded_objects = sorted(excluded_objects)
+            self._set_excluded_objects(excluded_objects)
 
     def _list_objects(self, gcmd):
         if gcmd.get('JSON', None) is not None:
@@ -0,0 +1,479 @@
+# Background analysis of virtual_sdcard g-code files
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, re, json, math, logging, multiprocessing, traceback
+
+CACHE_VERSION = 1
+POLL_TIME = .5
+
+######################################################################
+# G-Code file analysis
+######################################################################
+
+class Bounds:
+    def __init__(self):
+        self.min_x = self.min_y = self.max_x = self.max_y = None
+    def add(self, x, y):
+        if self.min_x is None:
+            self.min_x = self.max_x = x
+            self.min_y = self.max_y = y
+            return
+        self.min_x = min(self.min_x, x)
+        self.max_x = max(self.max_x, x)
+        self.min_y = min(self.min_y, y)
+        self.max_y = max(self.max_y, y)
+    def is_empty(self):
+        return self.min_x is None
+    def get_polygon(self):
+        return [[self.min_x, self.min_y], [self.max_x, self.min_y],
+                [self.max_x, self.max_y], [self.min_x, self.max_y]]
+    def get_center(self):
+        return [(self.min_x + self.max_x) * .5, (self.min_y + self.max_y) * .5]
+
+class FileAnalyzer:
+    args_r = re.compile('([A-Z_]+|[A-Z*])')
+    def __init__(self):
+        self.absolute_coord = self.absolute_extrude = True
+        self.base_position = [0., 0., 0., 0.]
+        self.last_position = [0., 0., 0., 0.]
+        self.bounds = Bounds()
+        self.filament_total = 0.
+        self.layer_heights = []
+        self.max_z = 0.
+        self.total_layers = None
+        # Object tracking
+        self.defined_objects = {}
+        self.object_bounds = {}
+        self.current_object = None
+    def _parse_line(self, line):
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        parts = self.args_r.split(line.strip().upper())
+        if ''.join(parts[:2]) == 'N':
+            parts = parts[2:]
+        cmd = ''.join(parts[:3]).strip()
+        params = { parts[i]: parts[i+1].strip()
+                   for i in range(1, len(parts), 2) }
+        return cmd, params
+    def _parse_extended(self, line):
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        eparams = re.findall(r'([a-z_]+[a-z0-9_]*)\s*=\s*(".*?"|\S+)',
+                             line, re.IGNORECASE)
+        return {k.upper(): v.strip('"') for k, v in eparams}
+    def _get_float(self, params, name):
+        try:
+            return float(params[name])
+        except (KeyError, ValueError):
+            return None
+    def _get_target(self, params):
+        pos = list(self.last_position)
+        for pos_index, axis in enumerate('XYZ'):
+            v = self._get_float(params, axis)
+            if v is not None:
+                if self.absolute_coord:
+                    pos[pos_index] = v + self.base_position[pos_index]
+                else:
+                    pos[pos_index] += v
+        v = self._get_float(params, 'E')
+        if v is not None:
+            if self.absolute_coord and self.absolute_extrude:
+                pos[3] = v + self.base_position[3]
+            else:
+                pos[3] += v
+        return pos
+    def _note_extrusion(self, points, newpos):
+        self.filament_total += newpos[3] - self.last_position[3]
+        z = newpos[2]
+        if not self.layer_heights or z > self.layer_heights[-1]:
+            self.layer_heights.append(z)
+        self.max_z = max(self.max_z, z)
+        bounds = [self.bounds]
+        if self.current_object is not None:
+            bounds.append(self.object_bounds.setdefault(self.current_object,
+                                                        Bounds()))
+        for b in bounds:
+            for x, y in points:
+                b.add(x, y)
+    def _move(self, newpos, points):
+        lpos = self.last_position
+        if newpos[3] > lpos[3] and (newpos[0] != lpos[0]
+                                    or newpos[1] != lpos[1]):
+            self._note_extrusion([(lpos[0], lpos[1])] + points, newpos)
+        self.last_position = newpos
+    def _arc_points(self, params, clockwise, newpos):
+        # Return the end point and any axis extremes crossed by the arc
+        lpos = self.last_position
+        offset_i = self._get_float(params, 'I') or 0.
+        offset_j = self._get_float(params, 'J') or 0.
+        cx, cy = lpos[0] + offset_i, lpos[1] + offset_j
+        radius = math.hypot(offset_i, offset_j)
+        angle_start = math.atan2(lpos[1] - cy, lpos[0] - cx)
+        angle_end = math.atan2(newpos[1] - cy, newpos[0] - cx)
+        travel = angle_end - angle_start
+        if clockwise:
+            if travel >= 0.:
+                travel -= 2. * math.pi
+        elif travel <= 0.:
+            travel += 2. * math.pi
+        points = []
+        for i in range(4):
+            angle = i * .5 * math.pi
+            rel = (angle - angle_start) % (2. * math.pi)
+            if clockwise:
+                rel = (angle_start - angle) % (2. * math.pi)
+            if rel <= abs(travel):
+                points.append((cx + radius * math.cos(angle),
+                               cy + radius * math.sin(angle)))
+        points.append((newpos[0], newpos[1]))
+        return points
+    def process_line(self, line):
+        cmd, params = self._parse_line(line)
+        if cmd in ('G1', 'G0'):
+            newpos = self._get_target(params)
+            self._move(newpos, [(newpos[0], newpos[1])])
+        elif cmd in ('G2', 'G3'):
+            newpos = self._get_target(params)
+            self._move(newpos, self._arc_points(params, cmd == 'G2', newpos))
+        elif cmd == 'G90':
+            self.absolute_coord = True
+        elif cmd == 'G91':
+            self.absolute_coord = False
+        elif cmd == 'M82':
+            self.absolute_extrude = True
+        elif cmd == 'M83':
+            self.absolute_extrude = False
+        elif cmd == 'G92':
+            for pos_index, axis in enumerate('XYZE'):
+                v = self._get_float(params, axis)
+                if v is not None:
+                    self.base_position[pos_index] = (
+                        self.last_position[pos_index] - v)
+        elif cmd == 'G28':
+            axes = [i for i, a in enumerate('XYZ') if a in params]
+            for pos_index in axes or [0, 1, 2]:
+                self.last_position[pos_index] = 0.
+        elif cmd.startswith('EXCLUDE_OBJECT'):
+            self._process_object_command(cmd, line)
+        elif cmd.startswith('SET_PRINT_STATS_INFO'):
+            eparams = self._parse_extended(line)
+            try:
+                self.total_layers = int(eparams['TOTAL_LAYER'])
+            except (KeyError, ValueError):
+                pass
+    def _process_object_command(self, cmd, line):
+        eparams = self._parse_extended(line)
+        name = eparams.get('NAME', '').upper()
+        if cmd.startswith('EXCLUDE_OBJECT_DEFINE'):
+            if not name:
+                return
+            obj = {'name': name}
+            try:
+                if 'CENTER' in eparams:
+                    obj['center'] = json.loads('[%s]' % eparams['CENTER'])
+                if 'POLYGON' in eparams:
+                    obj['polygon'] = json.loads(eparams['POLYGON'])
+            except ValueError:
+                pass
+            self.defined_objects[name] = obj
+        elif cmd.startswith('EXCLUDE_OBJECT_START'):
+            self.current_object = name or None
+        elif cmd.startswith('EXCLUDE_OBJECT_END'):
+            self.current_object = None
+    def _get_objects(self):
+        objects = {}
+        for name, bounds in self.object_bounds.items():
+            objects[name] = {'name': name, 'center': bounds.get_center(),
+                             'polygon': bounds.get_polygon()}
+        for name, obj in self.defined_objects.items():
+            # Prefer the slicer provided information when available
+            objects.setdefault(name, {}).update(obj)
+        return [objects[name] for name in sorted(objects)
+                if 'polygon' in objects[name]]
+    def get_result(self):
+        heights = self.layer_heights
+        res = {'layer_count': len(heights),
+               'total_layers': self.total_layers,
+               'first_layer_height': heights[0] if heights else None,
+               'object_height': self.max_z,
+               'filament_total': self.filament_total,
+               'extrusion_min': None, 'extrusion_max': None,
+               'objects': self._get_objects()}
+        if not self.bounds.is_empty():
+            b = self.bounds
+            res['extrusion_min'] = [b.min_x, b.min_y]
+            res['extrusion_max'] = [b.max_x, b.max_y]
+        return res
+
+def analyze_file(filename):
+    analyzer = FileAnalyzer()
+    with open(filename, 'rb') as f:
+        for line in f:
+            analyzer.process_line(line.decode(errors='replace'))
+    return analyzer.get_result()
+
+
+######################################################################
+# Analysis service
+######################################################################
+
+class FileAnalysis:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.filename = os.path.expanduser(config.get('filename'))
+        self.scan_interval = config.getfloat('scan_interval', 60., minval=0.)
+        self.sdcard = self.printer.load_object(config, 'virtual_sdcard')
+        self.sdcard_dirname = self.sdcard.sdcard_dirname
+        # Cache of analyzed files (keyed by path relative to sdcard dir)
+        self.files = {}
+        self._load_cache()
+        self.pending = []
+        self.calc_proc = self.parent_conn = None
+        self.worker_files = []
+        self.scan_timer = self.reactor.register_timer(self._scan_event)
+        self.poll_timer = None
+        self.printer.register_event_handler("klippy:ready",
+                                            self._handle_ready)
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self._stop_worker)
+        self.printer.register_event_handler("virtual_sdcard:load_file",
+                                            self._handle_load_file)
+        # Register webhooks
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("file_analysis/get_file",
+                                   self._handle_get_file)
+        webhooks.register_endpoint("file_analysis/list",
+                                   self._handle_list)
+        # Register commands
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command("ANALYZE_FILE", self.cmd_ANALYZE_FILE,
+                               desc=self.cmd_ANALYZE_FILE_help)
+    def _load_cache(self):
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != CACHE_VERSION:
+            return
+        self.files = data.get('files', {})
+    def _save_cache(self):
+        data = {'version': CACHE_VERSION, 'files': self.files}
+        try:
+            with open(self.filename, 'w') as f:
+                f.write(json.dumps(data, separators=(',', ':')))
+        except OSError:
+            logging.exception("file_analysis: unable to save cache")
+    def _get_relpath(self, filename):
+        return os.path.relpath(os.path.join(self.sdcard_dirname, filename),
+                               self.sdcard_dirname)
+    def _is_current(self, relpath, size, mtime):
+        entry = self.files.get(relpath)
+        return (entry is not None and entry['size'] == size
+                and entry['modified'] == mtime)
+    # File scanning
+    def _handle_ready(self):
+        self.reactor.update_timer(self.scan_timer, self.reactor.NOW)
+    def _scan_files(self):
+        found = {}
+        for relpath, size in self.sdcard.get_file_list(check_subdirs=True):
+            try:
+                mtime = os.path.getmtime(
+                    os.path.join(self.sdcard_dirname, relpath))
+            except OSError:
+                continue
+            found[relpath] = (size, mtime)
+        removed = [relpath for relpath in self.files if relpath not in found]
+        for relpath in removed:
+            del self.files[relpath]
+        if removed:
+            self._save_cache()
+        pending = [relpath for relpath, (size, mtime) in found.items()
+                   if not self._is_current(relpath, size, mtime)]
+        pending.sort(key=lambda p: -found[p][1])
+        for relpath in self.pending:
+            if relpath in found and relpath not in pending:
+                pending.insert(0, relpath)
+        self.pending = pending
+    def _scan_event(self, eventtime):
+        try:
+            self._scan_files()
+        except Exception:
+            logging.exception("file_analysis: unable to scan files")
+        if self.calc_proc is None:
+            self._start_worker()
+        if not self.scan_interval:
+            return self.reactor.NEVER
+        return eventtime + self.scan_interval
+    # Background worker
+    def _start_worker(self):
+        files = [p for p in self.pending if p not in self.worker_files]
+        if not files:
+            return
+        dirname = self.sdcard_dirname
+        parent_conn, child_conn = multiprocessing.Pipe()
+        def wrapper():
+            import queuelogger
+            queuelogger.clear_bg_logging()
+            try:
+                os.nice(10)
+            except OSError:
+                pass
+            for relpath in files:
+                fname = os.path.join(dirname, relpath)
+                try:
+                    st = os.stat(fname)
+                    res = analyze_file(fname)
+                except:
+                    child_conn.send((True, (relpath, traceback.format_exc())))
+                    continue
+                res.update({'size': st.st_size, 'modified': st.st_mtime})
+                child_conn.send((False, (relpath, res)))
+            child_conn.close()
+        self.calc_proc = multiprocessing.Process(target=wrapper)
+        self.calc_proc.daemon = True
+        self.calc_proc.start()
+        self.parent_conn = parent_conn
+        self.worker_files = files
+        self.poll_timer = self.reactor.register_timer(
+            self._poll_event, self.reactor.monotonic() + POLL_TIME)
+    def _stop_worker(self):
+        if self.poll_timer is not None:
+            self.reactor.unregister_timer(self.poll_timer)
+            self.poll_timer = None
+        if self.calc_proc is not None:
+            self.calc_proc.terminate()
+            self.calc_proc.join()
+            self.parent_conn.close()
+            self.calc_proc = self.parent_conn = None
+        self.worker_files = []
+    def _poll_worker(self):
+        updated = False
+        is_done = False
+        while 1:
+            try:
+                if not self.parent_conn.poll():
+                    break
+                is_err, (relpath, res) = self.parent_conn.recv()
+            except EOFError:
+                is_done = True
+                break
+            if relpath in self.pending:
+                self.pending.remove(relpath)
+            if is_err:
+                logging.error("file_analysis: unable to analyze %s: %s",
+                              relpath, res)
+                continue
+            self.files[relpath] = res
+            updated = True
+        if updated:
+            self._save_cache()
+        if is_done or not self.calc_proc.is_alive():
+            # Don't retry files that the worker did not complete
+            self.pending = [p for p in self.pending
+                            if p not in self.worker_files]
+            self._stop_worker()
+            self._start_worker()
+            return True
+        return False
+    def _poll_event(self, eventtime):
+        if self._poll_worker():
+            return self.reactor.NEVER
+        return eventtime + POLL_TIME
+    def _prioritize(self, relpath):
+        if relpath in self.pending:
+            self.pending.remove(relpath)
+        self.pending.insert(0, relpath)
+        if relpath not in self.worker_files:
+            # Restart the worker so that this file is analyzed first
+            if self.calc_proc is not None:
+                self._poll_worker()
+            self._stop_worker()
+            self._start_worker()
+    def _handle_load_file(self, filename):
+        relpath = self._get_relpath(filename)
+        try:
+            size = os.path.getsize(filename)
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            return
+        if not self._is_current(relpath, size, mtime):
+            self._prioritize(relpath)
+    # Query interface
+    def get_file_info(self, filename, wait=False):
+        relpath = self._get_relpath(filename)
+        fname = os.path.join(self.sdcard_dirname, relpath)
+        try:
+            size = os.path.getsize(fname)
+            mtime = os.path.getmtime(fname)
+        except OSError:
+            return None
+        if self._is_current(relpath, size, mtime):
+            return self.files[relpath]
+        if not wait:
+            return None
+        self._prioritize(relpath)
+        eventtime = self.reactor.monotonic()
+        while self.calc_proc is not None and relpath in self.pending:
+            eventtime = self.reactor.pause(eventtime + .1)
+            if self.calc_proc is not None:
+                self._poll_worker()
+        if self._is_current(relpath, size, mtime):
+            return self.files[relpath]
+        return None
+    def get_current_info(self, wait=False):
+        fname = self.sdcard.file_path()
+        if fname is None:
+            return None
+        return self.get_file_info(fname, wait)
+    def get_current_objects(self):
+        info = self.get_current_info(wait=True)
+        if info is None:
+            return []
+        return info['objects']
+    def get_status(self, eventtime):
+        return {'pending': len(self.pending), 'analyzed': len(self.files),
+                'current': self.get_current_info()}
+    def _handle_get_file(self, web_request):
+        filename = web_request.get_str('filename')
+        relpath = self._get_relpath(filename)
+        if not os.path.isfile(os.path.join(self.sdcard_dirname, relpath)):
+            raise web_request.error("File not found")
+        info = self.get_file_info(relpath)
+        if info is None:
+            if relpath not in self.pending:
+                self._prioritize(relpath)
+            web_request.send({'filename': relpath, 'state': 'pending'})
+            return
+        web_request.send({'filename': relpath, 'state': 'ready',
+                          'metadata': info})
+    def _handle_list(self, web_request):
+        web_request.send({'files': self.files, 'pending': self.pending})
+    cmd_ANALYZE_FILE_help = "Report the analysis of a virtual_sdcard file"
+    def cmd_ANALYZE_FILE(self, gcmd):
+        filename = gcmd.get('FILENAME', None)
+        if filename is None:
+            info = self.get_current_info(wait=True)
+        else:
+            if filename.startswith('/'):
+                filename = filename[1:]
+            info = self.get_file_info(filename, wait=True)
+        if info is None:
+            raise gcmd.error("Unable to analyze file")
+        msg = ["Layers: %d" % (info['layer_count'],),
+               "Object height: %.3f" % (info['object_height'],),
+               "Filament: %.1fmm" % (info['filament_total'],)]
+        if info['extrusion_min'] is not None:
+            msg.append("Extrusion area: (%.3f,%.3f) - (%.3f,%.3f)" % (
+                tuple(info['extrusion_min']) + tuple(info['extrusion_max'])))
+        for obj in info['objects']:
+            msg.append("Object %s: %s" % (obj['name'], obj['polygon']))
+        gcmd.respond_info("\n".join(msg))
+
+def load_config(config):
+    return FileAnalysis(config)
@@ -152,6 +152,7 @@ class ArcSupport:
                 e_base = currentPos[3]
             e_per_move = (asE - e_base) / segments
 
+        coords = []
         for i in range(1, int(segments) + 1):
             dist_Helical = i * linear_per_segment
             c_theta = i * theta_per_segment
@@ -168,16 +169,17 @@ class ArcSupport:
 
             if i == segments:
                 c = targetPos
-            # Convert coords into G1 commands
-            g1_params = {'X': c[0], 'Y': c[1], 'Z': c[2]}
+            e = None
             if e_per_move:
-                g1_params['E'] = e_base + e_per_move
+                e = e_base + e_per_move
                 if absolut_extrude:
                     e_base += e_per_move
-            if asF is not None:
-                g1_params['F'] = asF
-            g1_gcmd = self.gcode.create_gcode_command("G1", "G1", g1_params)
-            self.gcode_move.cmd_G1(g1_gcmd)
+            coords.append((c[0], c[1], c[2], e))
+        if asF is not None and asF <= 0.:
+            raise gcmd.error("Invalid speed in '%s'"
+                             % (gcmd.get_commandline(),))
+        # Queue all segments at once
+        self.gcode_move.move_batch(coords, asF)
 
 def load_config(config):
     return ArcSupport(config)
@@ -3,14 +3,75 @@
 # Copyright (C) 2018-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import traceback, logging, ast, copy, json
-import jinja2
+import traceback, logging, ast, copy, json, collections
+import jinja2, jinja2.meta, jinja2.nodes
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 
 ######################################################################
 # Template handling
 ######################################################################
 
+SIMPLE_TYPES = (str, int, float, bool, type(None))
+
+# Read-only view of a get_status() result. Nested dictionaries are
+# wrapped on access and other containers are copied, so templates can't
+# alter printer object state without the cost of a full deepcopy. The
+# converted children are kept, so each field is copied at most once per
+# view (views are created per template render).
+class StatusView(Mapping):
+    __slots__ = ('_status', '_children')
+    def __init__(self, status):
+        self._status = status
+        self._children = {}
+    def __getitem__(self, key):
+        val = self._status[key]
+        if isinstance(val, SIMPLE_TYPES):
+            return val
+        children = self._children
+        if key in children:
+            return children[key]
+        if type(val) is dict:
+            res = StatusView(val)
+        elif isinstance(val, tuple) and all([isinstance(v, SIMPLE_TYPES)
+                                             for v in val]):
+            res = val
+        else:
+            res = copy.deepcopy(val)
+        children[key] = res
+        return res
+    def __contains__(self, key):
+        return key in self._status
+    def __iter__(self):
+        return iter(self._status)
+    def __len__(self):
+        return len(self._status)
+    def __repr__(self):
+        return repr(self._status)
+    def copy(self):
+        return self.get_copy()
+    def get_copy(self):
+        return copy.deepcopy(self._status)
+
+# Convert status views in a value to regular (copied) objects
+def status_to_plain(obj):
+    if isinstance(obj, StatusView):
+        return obj.get_copy()
+    if isinstance(obj, dict):
+        return {k: status_to_plain(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)([status_to_plain(v) for v in obj])
+    return obj
+
+def status_to_json(obj):
+    if isinstance(obj, StatusView):
+        return obj.get_copy()
+    raise TypeError("Object of type %s is not JSON serializable"
+                    % (type(obj).__name__,))
+
 # Wrapper for access to printer object get_status() methods
 class GetStatusWrapper:
     def __init__(self, printer, eventtime=None):
@@ -26,7 +87,7 @@ class GetStatusWrapper:
             raise KeyError(val)
         if self.eventtime is None:
             self.eventtime = self.printer.get_reactor().monotonic()
-        self.cache[sval] = res = copy.deepcopy(po.get_status(self.eventtime))
+        self.cache[sval] = res = StatusView(po.get_status(self.eventtime))
         return res
     def __contains__(self, val):
         try:
@@ -43,10 +104,15 @@ class GetStatusWrapper:
 class TemplateWrapper:
     def __init__(self, printer, env, name, script):
         self.printer = printer
+        self.reactor = printer.get_reactor()
         self.name = name
+        self.stats_name = name.replace(' ', '_')
+        self.env = env
+        self.script = script
         self.gcode = self.printer.lookup_object('gcode')
         gcode_macro = self.printer.lookup_object('gcode_macro')
         self.create_template_context = gcode_macro.create_template_context
+        self.note_render = gcode_macro.note_render
         try:
             self.template = env.from_string(script)
         except Exception as e:
@@ -57,6 +123,7 @@ class TemplateWrapper:
     def render(self, context=None):
         if context is None:
             context = self.create_template_context()
+        start_time = self.reactor.monotonic()
         try:
             return str(self.template.render(context))
         except Exception as e:
@@ -64,14 +131,28 @@ class TemplateWrapper:
                 self.name, traceback.format_exception_only(type(e), e)[-1])
             logging.exception(msg)
             raise self.gcode.error(msg)
+        finally:
+            self.note_render(self.stats_name,
+                             self.reactor.monotonic() - start_time)
     def run_gcode_from_command(self, context=None):
         self.gcode.run_script_from_command(self.render(context))
+    def get_dependencies(self):
+        # Return the external names and the filters used by the template
+        template_ast = self.env.parse(self.script)
+        names = jinja2.meta.find_undeclared_variables(template_ast)
+        filters = set([f.name
+                       for f in template_ast.find_all(jinja2.nodes.Filter)])
+        return names, filters
 
 # Main gcode macro template tracking
 class PrinterGCodeMacro:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.env = jinja2.Environment('{%', '%}', '{', '}')
+        self.env.policies['json.dumps_kwargs'] = {
+            'sort_keys': True, 'default': status_to_json}
+        # Render statistics since last report: {stats_name: [count, time]}
+        self.render_stats = {}
     def load_template(self, config, option, default=None):
         name = "%s:%s" % (config.get_name(), option)
         if default is None:
@@ -79,6 +160,19 @@ class PrinterGCodeMacro:
         else:
             script = config.get(option, default)
         return TemplateWrapper(self.printer, self.env, name, script)
+    def note_render(self, stats_name, render_time):
+        rstats = self.render_stats.get(stats_name)
+        if rstats is None:
+            self.render_stats[stats_name] = rstats = [0, 0.]
+        rstats[0] += 1
+        rstats[1] += render_time
+    def stats(self, eventtime):
+        # Names contain no spaces, so the stats line stays parseable
+        render_stats = sorted(self.render_stats.items())
+        self.render_stats = {}
+        return False, " ".join(["%s: renders=%d render_time=%.6f"
+                                % (name, count, rtime)
+                                for name, (count, rtime) in render_stats])
     def _action_emergency_stop(self, msg="action_emergency_stop"):
         self.printer.invoke_shutdown("Shutdown due to %s" % (msg,))
         return ""
@@ -89,6 +183,7 @@ class PrinterGCodeMacro:
         raise self.printer.command_error(msg)
     def _action_call_remote_method(self, method, **kwargs):
         webhooks = self.printer.lookup_object('webhooks')
+        kwargs = status_to_plain(kwargs)
         try:
             webhooks.call_remote_method(method, **kwargs)
         except self.printer.command_error:
@@ -111,6 +206,10 @@ def load_config(config):
 # GCode macro
 ######################################################################
 
+# Names a template may reference and still only depend on its inputs
+CACHE_SAFE_NAMES = ['params', 'rawparams', 'range', 'dict', 'namespace']
+CACHE_UNSAFE_FILTERS = ['random']
+
 class GCodeMacro:
     def __init__(self, config):
         if len(config.get_name().split()) > 2:
@@ -151,6 +250,20 @@ class GCodeMacro:
                 raise config.error(
                     "Option '%s' in section '%s' is not a valid literal: %s" % (
                         option, config.get_name(), e))
+        # Memoization of rendered and parsed commands: {params_key: cmds}
+        self.cache_size = config.getint('cache_size', 0, minval=0)
+        self.cache = collections.OrderedDict()
+        self.cache_hits = self.cache_misses = 0
+        if self.cache_size:
+            names, filters = self.template.get_dependencies()
+            unsafe = (set(names) - set(CACHE_SAFE_NAMES) - set(self.variables)
+                      | set(filters) & set(CACHE_UNSAFE_FILTERS))
+            if unsafe:
+                raise config.error(
+                    "Option 'cache_size' in section '%s' requires a template"
+                    " that only depends on its parameters and variables"
+                    " (uses %s)" % (config.get_name(),
+                                    ", ".join(sorted(unsafe))))
     def handle_connect(self):
         prev_cmd = self.gcode.register_command(self.alias, None)
         if prev_cmd is None:
@@ -177,9 +290,40 @@ class GCodeMacro:
         v = dict(self.variables)
         v[variable] = literal
         self.variables = v
+        self.cache.clear()
+    def stats(self, eventtime):
+        if not self.cache_size:
+            return False, ""
+        return False, "gcode_macro %s: cache_hits=%d cache_misses=%d" % (
+            self.alias, self.cache_hits, self.cache_misses)
+    def _get_cached_commands(self, params, rawparams):
+        key = (rawparams, tuple(sorted(params.items())))
+        commands = self.cache.pop(key, None)
+        if commands is not None:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            kwparams = dict(self.variables)
+            kwparams['params'] = params
+            kwparams['rawparams'] = rawparams
+            commands = self.gcode.parse_script(self.template.render(kwparams))
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[key] = commands
+        return commands
     def cmd(self, gcmd):
         if self.in_script:
             raise gcmd.error("Macro %s called recursively" % (self.alias,))
+        if self.cache_size:
+            commands = self._get_cached_commands(
+                gcmd.get_command_parameters(),
+                gcmd.get_raw_command_parameters())
+            self.in_script = True
+            try:
+                self.gcode.run_parsed_script_from_command(commands)
+            finally:
+                self.in_script = False
+            return
         kwparams = dict(self.variables)
         kwparams.update(self.template.create_template_context())
         kwparams['params'] = gcmd.get_command_parameters()
@@ -5,6 +5,75 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
 
+IDENTITY_TRANSFORM = ((1., 0., 0., 0.), (0., 1., 0., 0.), (0., 0., 1., 0.))
+
+# Compose two affine transforms (3x4 matrices) so that the result
+# applies 'second' to the output of 'first'
+def compose_affine(second, first):
+    out = []
+    for r0, r1, r2, ro in second:
+        out.append(tuple([r0 * first[0][c] + r1 * first[1][c] + r2 * first[2][c]
+                          for c in range(3)])
+                   + (r0 * first[0][3] + r1 * first[1][3] + r2 * first[2][3]
+                      + ro,))
+    return tuple(out)
+
+def invert_affine(m):
+    (a, b, c, xo), (d, e, f, yo), (g, h, i, zo) = m
+    A, B, C = e*i - f*h, f*g - d*i, d*h - e*g
+    det = a*A + b*B + c*C
+    if not det:
+        raise ValueError("Move transform is not invertible")
+    inv_det = 1. / det
+    l = ((A * inv_det, (c*h - b*i) * inv_det, (b*f - c*e) * inv_det),
+         (B * inv_det, (a*i - c*g) * inv_det, (c*d - a*f) * inv_det),
+         (C * inv_det, (b*g - a*h) * inv_det, (a*e - b*d) * inv_det))
+    return tuple([r + (-(r[0]*xo + r[1]*yo + r[2]*zo),) for r in l])
+
+# Move transform seen by a registered transform (or by G-Code moves at
+# the top of the stack). Consecutive affine stages below it are merged
+# into a single matrix that is applied in one pass before forwarding
+# to the next non-affine transform (or the toolhead).
+class MoveTransformPipeline:
+    def __init__(self, depth):
+        self.depth = depth
+        self.matrix = self.inv_matrix = IDENTITY_TRANSFORM
+        self.next_move = self.next_get_position = None
+        self.move = self.get_position = None
+    def setup(self, matrix, next_transform):
+        self.next_move = next_transform.move
+        self.next_get_position = next_transform.get_position
+        self.matrix = matrix
+        if matrix == IDENTITY_TRANSFORM:
+            self.inv_matrix = matrix
+            self.move = self.next_move
+            self.get_position = self.next_get_position
+            return
+        self.inv_matrix = invert_affine(matrix)
+        self.move = self._affine_move
+        self.get_position = self._affine_get_position
+    def _affine_move(self, newpos, speed):
+        (xx, xy, xz, xo), (yx, yy, yz, yo), (zx, zy, zz, zo) = self.matrix
+        x, y, z, e = newpos
+        self.next_move([xx*x + xy*y + xz*z + xo, yx*x + yy*y + yz*z + yo,
+                        zx*x + zy*y + zz*z + zo, e], speed)
+    def move_batch(self, positions, speed):
+        # Transform a run of moves (eg, arc segments) in a single pass
+        next_move = self.next_move
+        if self.move is next_move:
+            for pos in positions:
+                next_move(pos, speed)
+            return
+        (xx, xy, xz, xo), (yx, yy, yz, yo), (zx, zy, zz, zo) = self.matrix
+        for x, y, z, e in positions:
+            next_move([xx*x + xy*y + xz*z + xo, yx*x + yy*y + yz*z + yo,
+                       zx*x + zy*y + zz*z + zo, e], speed)
+    def _affine_get_position(self):
+        (xx, xy, xz, xo), (yx, yy, yz, yo), (zx, zy, zz, zo) = self.inv_matrix
+        x, y, z, e = self.next_get_position()
+        return [xx*x + xy*y + xz*z + xo, yx*x + yy*y + yz*z + yo,
+                zx*x + zy*y + zz*z + zo, e]
+
 class GCodeMove:
     def __init__(self, config):
         self.printer = printer = config.get_printer()
@@ -47,14 +116,14 @@ class GCodeMove:
         self.extrude_factor = 1.
         # G-Code state
         self.saved_states = {}
-        self.move_transform = self.move_with_transform = None
+        # Registered move transforms (first entry is closest to toolhead)
+        self.move_transforms = []
+        self.pipelines = [MoveTransformPipeline(0)]
+        self.move_with_transform = self.move_batch_with_transform = None
         self.position_with_transform = (lambda: [0., 0., 0., 0.])
     def _handle_ready(self):
         self.is_printer_ready = True
-        if self.move_transform is None:
-            toolhead = self.printer.lookup_object('toolhead')
-            self.move_with_transform = toolhead.move
-            self.position_with_transform = toolhead.get_position
+        self.update_move_transform()
         self.reset_last_position()
     def _handle_shutdown(self):
         if not self.is_printer_ready:
@@ -76,16 +145,42 @@ class GCodeMove:
         for axis in homing_state.get_axes():
             self.base_position[axis] = self.homing_position[axis]
     def set_move_transform(self, transform, force=False):
-        if self.move_transform is not None and not force:
+        if self.move_transforms and not force:
             raise self.printer.config_error(
                 "G-Code move transform already specified")
-        old_transform = self.move_transform
-        if old_transform is None:
-            old_transform = self.printer.lookup_object('toolhead', None)
-        self.move_transform = transform
-        self.move_with_transform = transform.move
-        self.position_with_transform = transform.get_position
+        old_transform = self.pipelines[-1]
+        if isinstance(transform, MoveTransformPipeline):
+            # Restore a previous transform stack
+            del self.move_transforms[transform.depth:]
+            del self.pipelines[transform.depth + 1:]
+        else:
+            self.move_transforms.append(transform)
+            self.pipelines.append(
+                MoveTransformPipeline(len(self.move_transforms)))
+        self.update_move_transform()
         return old_transform
+    def update_move_transform(self):
+        # Rebuild the move pipelines - affine transforms must call this
+        # after changing their parameters
+        toolhead = self.printer.lookup_object('toolhead', None)
+        if toolhead is None:
+            return
+        next_transform = toolhead
+        matrix = IDENTITY_TRANSFORM
+        self.pipelines[0].setup(matrix, next_transform)
+        for pipeline, transform in zip(self.pipelines[1:],
+                                       self.move_transforms):
+            get_affine = getattr(transform, 'get_affine_transform', None)
+            if get_affine is not None:
+                matrix = compose_affine(matrix, get_affine())
+            else:
+                next_transform = transform
+                matrix = IDENTITY_TRANSFORM
+            pipeline.setup(matrix, next_transform)
+        top = self.pipelines[-1]
+        self.move_with_transform = top.move
+        self.move_batch_with_transform = top.move_batch
+        self.position_with_transform = top.get_position
     def _get_gcode_position(self):
         p = [lp - bp for lp, bp in zip(self.last_position, self.base_position)]
         p[3] /= self.extrude_factor
@@ -141,6 +236,29 @@ class GCodeMove:
             raise gcmd.error("Unable to parse move '%s'"
                              % (gcmd.get_commandline(),))
         self.move_with_transform(self.last_position, self.speed)
+    def move_batch(self, coords, gcode_speed=None):
+        # Queue a run of moves to absolute G-Code coordinates (eg, the
+        # segments of an arc). Each entry is an (x, y, z, e) tuple where
+        # 'e' follows the current extrude mode (or is None for no
+        # extrusion) and 'gcode_speed' is in mm/min as with G1 F.
+        base = self.base_position
+        last = self.last_position
+        extrude_factor = self.extrude_factor
+        absolute_extrude = self.absolute_coord and self.absolute_extrude
+        positions = []
+        for x, y, z, e in coords:
+            last[0] = x + base[0]
+            last[1] = y + base[1]
+            last[2] = z + base[2]
+            if e is not None:
+                if absolute_extrude:
+                    last[3] = e * extrude_factor + base[3]
+                else:
+                    last[3] += e * extrude_factor
+            positions.append(list(last))
+        if gcode_speed is not None:
+            self.speed = gcode_speed * self.speed_factor
+        self.move_batch_with_transform(positions, self.speed)
     # G-Code coordinate manipulation
     def cmd_G20(self, gcmd):
         # Set units to inches
@@ -206,10 +324,8 @@ class GCodeMove:
             for pos, delta in enumerate(move_delta):
                 self.last_position[pos] += delta
             self.move_with_transform(self.last_position, speed)
-    cmd_SAVE_GCODE_STATE_help = "Save G-Code coordinate state"
-    def cmd_SAVE_GCODE_STATE(self, gcmd):
-        state_name = gcmd.get('NAME', 'default')
-        self.saved_states[state_name] = {
+    def get_gcode_state(self):
+        return {
             'absolute_coord': self.absolute_coord,
             'absolute_extrude': self.absolute_extrude,
             'base_position': list(self.base_position),
@@ -218,13 +334,7 @@ class GCodeMove:
             'speed': self.speed, 'speed_factor': self.speed_factor,
             'extrude_factor': self.extrude_factor,
         }
-    cmd_RESTORE_GCODE_STATE_help = "Restore a previously saved G-Code state"
-    def cmd_RESTORE_GCODE_STATE(self, gcmd):
-        state_name = gcmd.get('NAME', 'default')
-        state = self.saved_states.get(state_name)
-        if state is None:
-            raise gcmd.error("Unknown g-code state: %s" % (state_name,))
-        # Restore state
+    def restore_gcode_state(self, state, move=False, move_speed=None):
         self.absolute_coord = state['absolute_coord']
         self.absolute_extrude = state['absolute_extrude']
         self.base_position = list(state['base_position'])
@@ -236,10 +346,24 @@ class GCodeMove:
         e_diff = self.last_position[3] - state['last_position'][3]
         self.base_position[3] += e_diff
         # Move the toolhead back if requested
-        if gcmd.get_int('MOVE', 0):
-            speed = gcmd.get_float('MOVE_SPEED', self.speed, above=0.)
+        if move:
+            if move_speed is None:
+                move_speed = self.speed
             self.last_position[:3] = state['last_position'][:3]
-            self.move_with_transform(self.last_position, speed)
+            self.move_with_transform(self.last_position, move_speed)
+    cmd_SAVE_GCODE_STATE_help = "Save G-Code coordinate state"
+    def cmd_SAVE_GCODE_STATE(self, gcmd):
+        state_name = gcmd.get('NAME', 'default')
+        self.saved_states[state_name] = self.get_gcode_state()
+    cmd_RESTORE_GCODE_STATE_help = "Restore a previously saved G-Code state"
+    def cmd_RESTORE_GCODE_STATE(self, gcmd):
+        state_name = gcmd.get('NAME', 'default')
+        state = self.saved_states.get(state_name)
+        if state is None:
+            raise gcmd.error("Unknown g-code state: %s" % (state_name,))
+        move = gcmd.get_int('MOVE', 0)
+        move_speed = gcmd.get_float('MOVE_SPEED', None, above=0.)
+        self.restore_gcode_state(state, move, move_speed)
     cmd_GET_POSITION_help = (
         "Return information on the current location of the toolhead")
     def cmd_GET_POSITION(self, gcmd):
@@ -4,7 +4,7 @@
 # Copyright (C) 2020  Dmitry Butyugin <dmbutyugin@google.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import collections
+import collections, logging
 import chelper
 from . import shaper_defs
 
@@ -69,6 +69,15 @@ class AxisInputShaper:
             ffi_lib.input_shaper_set_shaper_params(
                     sk, self.axis.encode(), self.n, self.A, self.T)
         return success
+    def check_shaper(self):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        return ffi_lib.input_shaper_check_shaper_params(
+                self.n, self.A, self.T) == 0
+    def schedule_shaper_kinematics(self, sk, print_time, shaper):
+        n, A, T = shaper
+        ffi_main, ffi_lib = chelper.get_ffi()
+        return ffi_lib.input_shaper_schedule_shaper_params(
+                sk, self.axis.encode(), n, A, T, print_time) == 0
     def disable_shaping(self):
         if self.saved is None and self.n:
             self.saved = (self.n, self.A, self.T)
@@ -94,6 +103,7 @@ class InputShaper:
                         AxisInputShaper('y', config)]
         self.input_shaper_stepper_kinematics = []
         self.orig_stepper_kinematics = []
+        self.have_scheduled_params = False
         # Register gcode commands
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command("SET_INPUT_SHAPER",
@@ -103,6 +113,7 @@ class InputShaper:
         return self.shapers
     def connect(self):
         self.toolhead = self.printer.lookup_object("toolhead")
+        self.toolhead.register_step_generator(self._cleanup_scheduled_params)
         # Configure initial values
         self._update_input_shaping(error=self.printer.config_error)
     def _get_input_shaper_stepper_kinematics(self, stepper):
@@ -115,7 +126,8 @@ class InputShaper:
             return sk
         self.orig_stepper_kinematics.append(sk)
         ffi_main, ffi_lib = chelper.get_ffi()
-        is_sk = ffi_main.gc(ffi_lib.input_shaper_alloc(), ffi_lib.free)
+        is_sk = ffi_main.gc(ffi_lib.input_shaper_alloc(),
+                            ffi_lib.input_shaper_free)
         stepper.set_stepper_kinematics(is_sk)
         res = ffi_lib.input_shaper_set_sk(is_sk, sk)
         if res < 0:
@@ -148,6 +160,48 @@ class InputShaper:
             error = error or self.printer.command_error
             raise error("Failed to configure shaper(s) %s with given parameters"
                         % (', '.join([s.get_name() for s in failed_shapers])))
+    def _schedule_input_shaping(self):
+        failed_shapers = [s for s in self.shapers if not s.check_shaper()]
+        for shaper in failed_shapers:
+            shaper.disable_shaping()
+        # Apply the new parameters at the end of the queued moves
+        shapers = [(shaper, shaper.get_shaper()) for shaper in self.shapers]
+        self.toolhead.register_lookahead_callback(
+            lambda print_time: self._apply_scheduled_shaping(print_time,
+                                                             shapers))
+        if failed_shapers:
+            raise self.printer.command_error(
+                "Failed to configure shaper(s) %s with given parameters"
+                % (', '.join([s.get_name() for s in failed_shapers])))
+    def _apply_scheduled_shaping(self, print_time, shapers):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        for is_sk in self.input_shaper_stepper_kinematics:
+            old_delay = ffi_lib.input_shaper_get_step_generation_window(is_sk)
+            for shaper, params in shapers:
+                if not shaper.schedule_shaper_kinematics(is_sk, print_time,
+                                                         params):
+                    logging.error("Failed to schedule %s parameters",
+                                  shaper.get_name())
+            new_delay = ffi_lib.input_shaper_get_step_generation_window(is_sk)
+            if old_delay != new_delay:
+                self.toolhead.note_step_generation_scan_time(
+                        new_delay, old_delay, flush=False)
+        self.have_scheduled_params = True
+    def _cleanup_scheduled_params(self, flush_time):
+        # Free parameter changes that no longer affect step generation
+        if not self.have_scheduled_params:
+            return
+        ffi_main, ffi_lib = chelper.get_ffi()
+        pending = False
+        for is_sk in self.input_shaper_stepper_kinematics:
+            old_delay = ffi_lib.input_shaper_get_step_generation_window(is_sk)
+            if ffi_lib.input_shaper_cleanup_params(is_sk):
+                pending = True
+            new_delay = ffi_lib.input_shaper_get_step_generation_window(is_sk)
+            if old_delay != new_delay:
+                self.toolhead.note_step_generation_scan_time(
+                        new_delay, old_delay, flush=False)
+        self.have_scheduled_params = pending
     def disable_shaping(self):
         for shaper in self.shapers:
             shaper.disable_shaping()
@@ -161,7 +215,7 @@ class InputShaper:
         if gcmd.get_command_parameters():
             for shaper in self.shapers:
                 shaper.update(gcmd)
-            self._update_input_shaping()
+            self._schedule_input_shaping()
         for shaper in self.shapers:
             shaper.report(gcmd)
 
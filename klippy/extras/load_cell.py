@@ -3,21 +3,181 @@
 # Copyright (C) 2024 Gareth Farrington <gareth@waves.ky>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
+import collections, math
 from . import hx71x
 from . import ads1220
 
+######################################################################
+# Streaming filters (operating on batches of force values)
+######################################################################
+
+# Median of the last 'window' samples (removes spikes)
+class MedianFilter:
+    def __init__(self, window, sample_rate):
+        self.history = collections.deque(maxlen=window)
+        self.latency = .5 * (window - 1) / sample_rate
+    def process(self, values):
+        history = self.history
+        out = []
+        for v in values:
+            history.append(v)
+            s = sorted(history)
+            n = len(s)
+            if n & 1:
+                out.append(s[n // 2])
+            else:
+                out.append(.5 * (s[n // 2 - 1] + s[n // 2]))
+        return out
+
+# Second order notch filter (removes eg, fan or motor vibration)
+class NotchFilter:
+    def __init__(self, frequency, q, sample_rate):
+        w0 = 2. * math.pi * frequency / sample_rate
+        alpha = math.sin(w0) / (2. * q)
+        cos_w0 = math.cos(w0)
+        a0 = 1. + alpha
+        self.b = (1. / a0, -2. * cos_w0 / a0, 1. / a0)
+        self.a = (-2. * cos_w0 / a0, (1. - alpha) / a0)
+        self.state = None
+        # Delay outside the notch band is negligible
+        self.latency = 0.
+    def process(self, values):
+        (b0, b1, b2), (a1, a2) = self.b, self.a
+        if self.state is None and values:
+            self.state = (values[0], values[0], values[0], values[0])
+        x1, x2, y1, y2 = self.state
+        out = []
+        for x in values:
+            y = b0 * x + b1 * x1 + b2 * x2 - a1 * y1 - a2 * y2
+            x1, x2, y1, y2 = x, x1, y, y1
+            out.append(y)
+        if values:
+            self.state = (x1, x2, y1, y2)
+        return out
+
+# First order low-pass filter (reduces noise)
+class LowPassFilter:
+    def __init__(self, cutoff, sample_rate):
+        rc = 1. / (2. * math.pi * cutoff)
+        dt = 1. / sample_rate
+        self.alpha = dt / (rc + dt)
+        self.last = None
+        self.latency = (1. - self.alpha) / self.alpha * dt
+    def process(self, values):
+        alpha = self.alpha
+        last = self.last
+        out = []
+        for v in values:
+            if last is None:
+                last = v
+            last += alpha * (v - last)
+            out.append(last)
+        self.last = last
+        return out
+
+# Calibration, tare and filtering of load cell samples. The result is
+# computed once per batch of samples and passed to all subscribers as a
+# list of (time, force) tuples.
+class LoadCellFilterPipeline:
+    def __init__(self, config, calibration, sample_rate):
+        self.calibration = calibration
+        self.tare_offset = 0.
+        self.filters = []
+        median_window = config.getint('filter_median_window', 1, minval=1)
+        if median_window > 1:
+            self.filters.append(MedianFilter(median_window, sample_rate))
+        notch_freq = config.getfloat('filter_notch_frequency', 0., minval=0.,
+                                     below=.5 * sample_rate)
+        if notch_freq:
+            notch_q = config.getfloat('filter_notch_q', 2., above=0.)
+            self.filters.append(NotchFilter(notch_freq, notch_q, sample_rate))
+        cutoff = config.getfloat('filter_lowpass_cutoff', 0., minval=0.,
+                                 below=.5 * sample_rate)
+        if cutoff:
+            self.filters.append(LowPassFilter(cutoff, sample_rate))
+        self.latency = sum([f.latency for f in self.filters])
+        self.clients = []
+        self.last_force = 0.
+    def set_calibration(self, calibration):
+        self.calibration = calibration
+    def set_tare(self, tare_offset):
+        self.tare_offset = tare_offset
+    def get_latency(self):
+        return self.latency
+    def add_client(self, callback):
+        self.clients.append(callback)
+    # Process a batch of (time, raw value) samples. Returns the calibrated
+    # (but not tared or filtered) forces as a list of (time, force) tuples.
+    def process(self, samples):
+        calibration = self.calibration
+        forces = [(t, v * calibration) for t, v in samples]
+        if not forces or not self.clients:
+            return forces
+        offset = self.tare_offset
+        values = [f - offset for t, f in forces]
+        for filt in self.filters:
+            values = filt.process(values)
+        self.last_force = values[-1]
+        batch = list(zip([t for t, f in forces], values))
+        for cb in self.clients:
+            cb(batch)
+        return forces
+
 # Printer class that controls a load cell
 class LoadCell:
     def __init__(self, config, sensor):
         self.printer = printer = config.get_printer()
         self.sensor = sensor   # must implement BulkAdcSensor
+        calibration = config.getfloat('force_calibration', 1.)
+        self.pipeline = LoadCellFilterPipeline(
+            config, calibration, sensor.get_samples_per_second())
+        self.is_ready = self.is_started = False
+        self.last_forces = []
+        self.tare_pending = True
+        printer.register_event_handler("klippy:ready", self._handle_ready)
+
+    def _handle_ready(self):
+        self.is_ready = True
+        if self.pipeline.clients:
+            self._start()
+
+    def _start(self):
+        if not self.is_started:
+            self.is_started = True
+            self.sensor.add_client(self._on_sample)
 
     def _on_sample(self, msg):
+        samples = [(t, value) for t, counts, value in msg['data']]
+        if self.tare_pending and samples:
+            # Use the first batch as zero offset
+            self.tare_pending = False
+            calibration = self.pipeline.calibration
+            self.pipeline.set_tare(sum([v * calibration for t, v in samples])
+                                   / len(samples))
+        self.last_forces = self.pipeline.process(samples)
         return True
 
     def get_sensor(self):
         return self.sensor
 
+    # The callback is invoked with a list of (time, force) tuples
+    def subscribe_force(self, force_callback):
+        self.pipeline.add_client(force_callback)
+        if self.is_ready:
+            self._start()
+
+    def tare(self):
+        # Use the current force (mean of the last batch) as zero offset
+        forces = self.last_forces
+        if not forces:
+            self.tare_pending = True
+            return
+        self.pipeline.set_tare(sum([f for t, f in forces]) / len(forces))
+
+    def get_status(self, eventtime):
+        return {'force': self.pipeline.last_force,
+                'filter_latency': self.pipeline.get_latency()}
+
 def load_config(config):
     # Sensor types
     sensors = {}
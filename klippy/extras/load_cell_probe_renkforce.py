@@ -10,6 +10,9 @@ import sys
 import logging
 import random
 import math
+from . import hx71x
+from . import ads1220
+from . import load_cell
 
 syspath = sys.path
 sys.path = syspath[1:]
@@ -55,6 +58,24 @@ FIT_MIN_STEP_SIZE = 0.01
 # Number of retries if fit fails (due to FIT_MIN_QUALITY)
 MAX_RETRY = 5
 
+# Continuous probing: number of data points to collect for each fit
+# (relative to FIT_POINTS)
+CONTINUOUS_FIT_POINTS_FACTOR = 2
+
+# Continuous probing: assumed delay (in ADC report intervals plus a fixed
+# time) until a sample is available to the host and the steps already sent
+# to the micro-controller are completed.  The approach speed is chosen so
+# that the tool head stops within one step after a contact.
+CONTINUOUS_LATENCY_SAMPLES = 3
+CONTINUOUS_LATENCY_TIME = 0.250
+
+# Continuous probing: maximum distance of the approach (relative to the
+# compensation lift)
+CONTINUOUS_MAX_APPROACH_FACTOR = 100
+
+# Interval at which batches of samples are received from bulk ADC sensors
+BULK_REPORT_TIME = 0.100
+
 ###########################
 
 
@@ -66,15 +87,35 @@ class LoadCellProbe:
         self._configfile = self._printer.lookup_object("configfile")
         self._results = []
 
-        pin_name = config.get("adc")
-        ppins = self._printer.lookup_object("pins")
-        self._mcu_adc = ppins.setup_pin("adc", pin_name)
+        # Load cell ADC: either an analog input pin reporting single samples
+        # or a bulk sensor chip reporting batches of samples
+        sensors = {}
+        sensors.update(hx71x.HX71X_SENSOR_TYPES)
+        sensors.update(ads1220.ADS1220_SENSOR_TYPE)
+        sensors["adc"] = None
+        sensor_class = config.getchoice("sensor_type", sensors, default="adc")
+        if sensor_class is None:
+            pin_name = config.get("adc")
+            ppins = self._printer.lookup_object("pins")
+            self._mcu_adc = ppins.setup_pin("adc", pin_name)
+            self._sensor = None
+            self._mcu = self._mcu_adc.get_mcu()
+        else:
+            self._mcu_adc = None
+            self._sensor = sensor_class(config)
+            self._mcu = self._sensor.get_mcu()
 
         # Parameters from configuration, e.g. determined by calibration commands
         # ----------------------------------------------------------------------
 
-        # ADC conversion rate to request (in SPS)
-        self._report_time = 1.0 / config.getfloat("adc_rate", above=0.0)
+        # Time between two samples and between two updates received by the host
+        if self._sensor is None:
+            # ADC conversion rate to request (in SPS)
+            self._sample_time = 1.0 / config.getfloat("adc_rate", above=0.0)
+            self._report_time = self._sample_time
+        else:
+            self._sample_time = 1.0 / self._sensor.get_samples_per_second()
+            self._report_time = BULK_REPORT_TIME
 
         # Conversion factor to convert ADC readings into physical units.
         self._force_calibration = config.getfloat("force_calibration",
@@ -106,6 +147,19 @@ class LoadCellProbe:
             "probe_speed", above=0.0, default=SPEED
         )
 
+        # Move at constant speed while sampling instead of stepwise
+        self._continuous = config.getboolean("continuous_probing", False)
+
+        # Adapt step sizes to the distance from the contact, and compensate
+        # drift by interpolation instead of a lift at each fit point
+        self._adaptive = config.getboolean("adaptive_stepping", False)
+
+        # Distance above the contact of the previous probe point, down to
+        # which the tool head is lowered in one step when adaptive_stepping
+        # is enabled
+        self._approach_margin = config.getfloat("approach_margin", 1.0,
+                                                above=0.0)
+
         # Derived parameters
         # ------------------
         target_force = self._max_abs_force / FORCE_SAFETY_MARGIN
@@ -133,6 +187,16 @@ class LoadCellProbe:
         self._compensation_z_lift = self._fit_step_size \
                                     * COMPENSATION_Z_LIFT_FACTOR
 
+        # Speeds of continuous probing: the approach must not move more than
+        # one step within the time needed to detect the contact, while the
+        # fit moves by one fit step per ADC sample
+        latency = (CONTINUOUS_LATENCY_SAMPLES * self._report_time
+                   + CONTINUOUS_LATENCY_TIME)
+        self._approach_speed = min(self._step_size / latency,
+                                   self._params["probe_speed"])
+        self._fit_speed = min(self._fit_step_size / self._sample_time,
+                              self._approach_speed)
+
         # initialise data members
         self._last_z_result = 0.0
         self._force_offset = None
@@ -140,12 +204,23 @@ class LoadCellProbe:
         self._last_force = 0.0
         self._last_time = None
         self._stiffness_points = []
-        self._force_callbacks = []
-
-        # subscribe to ADC callback
-        max_val = self._max_abs_force / self._force_calibration
-        self._mcu_adc.setup_minmax(self._report_time, 1, -max_val, max_val)
-        self._mcu_adc.setup_adc_callback(self._report_time, self._adc_callback)
+        # Tare and filtering of the forces passed to subscribers
+        self._pipeline = load_cell.LoadCellFilterPipeline(
+            config, self._force_calibration, 1.0 / self._sample_time)
+        self._capture = None
+        self._stream_completion = None
+        self._stream_stop = (0.0, None)
+        self._stream_fit_count = 0
+        self._session_z = None
+        self._move_count = 0
+        self._read_count = 0
+
+        # subscribe to ADC callback (bulk sensors are started when ready)
+        if self._sensor is None:
+            max_val = self._max_abs_force / self._force_calibration
+            self._mcu_adc.setup_minmax(self._report_time, 1, -max_val, max_val)
+            self._mcu_adc.setup_adc_callback(self._report_time,
+                                             self._adc_callback)
 
         # do some late initialisation when ready
         self._printer.register_event_handler("klippy:ready", self._handle_ready)
@@ -224,11 +299,13 @@ class LoadCellProbe:
     def get_status(self, eventtime):
         return {
             "last_force": self._last_force,
+            "filter_latency": self._pipeline.get_latency(),
             "last_z_result": self._last_z_result,
         }
 
     def start_probe_session(self, gcmd=None):
         self._results = []
+        self._session_z = None
         return self
 
     def end_probe_session(self):
@@ -237,19 +314,34 @@ class LoadCellProbe:
     def run_probe(self, gcmd):
         # wait until toolhead is in position
         self.tool.wait_moves()
+        continuous = gcmd.get_int("CONTINUOUS", self._continuous,
+                                  minval=0, maxval=1)
+        adaptive = gcmd.get_int("ADAPTIVE", self._adaptive,
+                                minval=0, maxval=1)
+        start_time = self._reactor.monotonic()
+        self._move_count = self._read_count = 0
 
         repeat_count = 0
         while True:
-            # fast, coarse approach
-            force = self._fast_approach(gcmd)
+            if continuous:
+                result = self._continuous_probe(gcmd)
+                if result is not None:
+                    break
+            else:
+                # fast, coarse approach
+                force = self._fast_approach(gcmd, adaptive)
 
-            # find start position for fit (no contact but as close to surface)
-            self._find_fit_start(gcmd, force)
+                # find start position for fit (no contact but as close to
+                # surface)
+                self._find_fit_start(gcmd, force)
 
-            # perform raster scan and fit
-            result = self._perform_fit(gcmd)
-            if result is not None:
-                break
+                # perform raster scan and fit
+                if adaptive:
+                    result = self._perform_adaptive_fit(gcmd)
+                else:
+                    result = self._perform_fit(gcmd)
+                if result is not None:
+                    break
 
             # check abort condition
             repeat_count += 1
@@ -258,41 +350,74 @@ class LoadCellProbe:
             gcmd.respond_info("Retrying...")
             self._move_z_relative(5 * self._step_size, False)
 
+        gcmd.respond_info(
+            "Probe statistics: %d moves, %d ADC reads, %.3fs"
+            % (self._move_count, self._read_count,
+               self._reactor.monotonic() - start_time)
+        )
         pos = self.tool.get_position()
         gcmd.respond_info("FINISHED toolhead Z = %f" % result)
         pos[2] = result
-        self._last_z_result = result
+        self._last_z_result = self._session_z = result
         self._results.append(pos)
         return self._results[-1]
 
     def pull_probed_results(self):
         return self._results
 
+    # The callback is invoked with a list of (time, force) tuples
     def subscribe_force(self, force_callback):
-        self._force_callbacks.append(force_callback)
+        self._pipeline.add_client(force_callback)
 
     def _handle_ready(self):
         # obtain toolhead object
         self.tool = self._printer.lookup_object("toolhead")
+        if self._sensor is not None:
+            self._sensor.add_client(self._bulk_callback)
 
-    def _adc_callback(self, time, value):
-        # convert to physical unit
-        self._last_uncompensated_force = value * self._force_calibration
+    def _process_samples(self, samples):
+        # samples is a list of (time, value) tuples with the raw ADC values
+        if not samples:
+            return
         # First value after start: use as zero offset
-        if self._force_offset == None:
-            self._force_offset = self._last_uncompensated_force
-        self._last_time = time
+        if self._force_offset is None:
+            self._force_offset = samples[0][1] * self._force_calibration
+        # Send batch of compensated and filtered values to subscribers; the
+        # probe itself uses the unfiltered forces
+        self._pipeline.set_tare(self._force_offset)
+        forces = self._pipeline.process(samples)
+        self._last_time, self._last_uncompensated_force = forces[-1]
+        # Called from the sensor thread - the capture may end concurrently
+        capture = self._capture
+        completion = self._stream_completion
+        if capture is not None:
+            capture.extend(forces)
+            if completion is not None and not completion.test():
+                self._check_stream_stop(forces, completion)
         # Store zero offset compensated value for display
         self._last_force = self._last_uncompensated_force - self._force_offset
-        # Send value to subscribers
-        for cb in self._force_callbacks:
-            cb(self._last_force)
+
+    def _adc_callback(self, time, value):
+        self._process_samples([(time, value)])
+
+    def _bulk_callback(self, msg):
+        samples = [(time, value) for time, counts, value in msg["data"]]
+        # Bulk sensors have no range check on the micro-controller
+        calibration = self._force_calibration
+        for time, value in samples:
+            if abs(value * calibration) > self._max_abs_force:
+                self._printer.invoke_shutdown(
+                    "Load cell probe: max_abs_force exceeded")
+                return False
+        self._process_samples(samples)
+        return True
 
     def _adc_wait_conversion_ready(self, gcmd):
         last_time = self._last_time
-        clocksync = self._mcu_adc.get_mcu()._clocksync
+        clocksync = self._mcu._clocksync
         clock = clocksync.print_time_to_clock(last_time)
         last_sys_time = clocksync.estimate_clock_systime(clock)
+        self._read_count += 1
         for n in range(1, 10):
             # wait shortly after the timer has called _sample_timer
             self._reactor.pause(last_sys_time + n * self._report_time + 0.0001)
@@ -304,6 +429,7 @@ class LoadCellProbe:
     def _move_z_relative(self, length, wait=True):
         pos = self.tool.get_position()
         self.tool.manual_move([pos[0], pos[1], pos[2] + length], SPEED)
+        self._move_count += 1
         if wait:
             self.tool.wait_moves()
 
@@ -317,7 +443,22 @@ class LoadCellProbe:
 
         return self._last_uncompensated_force
 
-    def _lower_to_threshold(self, gcmd):
+    def _adaptive_step(self, force):
+        # Step size for lowering the tool head, based on the distance to the
+        # expected contact
+        if abs(force) > self._fit_threshold:
+            # In contact: the stiffness predicts the distance to the threshold
+            dist = (self._threshold - abs(force)) / self._stiffness
+            return min(max(dist, 0.0) + self._fit_step_size, self._step_size)
+        if self._session_z is not None:
+            # Far above the contact of the previous probe point
+            z = self.tool.get_position()[2]
+            dist = z - self._session_z - self._approach_margin
+            if dist > self._step_size:
+                return dist
+        return self._step_size
+
+    def _lower_to_threshold(self, gcmd, adaptive=False):
         # Lower the tool head until the force threshold is exceeded
         while True:
             # Check threshold before first movement, to prevent doing an
@@ -328,9 +469,18 @@ class LoadCellProbe:
             )
             if abs(force) > self._threshold:
                 break
-            self._move_z_relative(-1 * self._step_size)
-
-    def _fast_approach(self, gcmd):
+            step = self._step_size
+            if adaptive:
+                step = self._adaptive_step(force)
+                if step > self._step_size:
+                    # Far above the expected contact: lower in one move at
+                    # a speed that stops within one step after a contact
+                    self._stream_move(gcmd, -step, self._approach_speed,
+                                      self._threshold)
+                    continue
+            self._move_z_relative(-1 * step)
+
+    def _fast_approach(self, gcmd, adaptive=False):
         # Strategy for fast approach: lower tool head until exceeding threshold,
         # then lift head a bit and compare force with original force_offset. If
         # it matches, the contact is assumed. If not, the force_offset has
@@ -341,7 +491,7 @@ class LoadCellProbe:
         attempt_start_pos = self.tool.get_position()[2]
         while True:
             # lower tool head until force threshold is exceeded
-            self._lower_to_threshold(gcmd)
+            self._lower_to_threshold(gcmd, adaptive)
 
             # confirm contact with compensated measuerment (also updating the
             # force_offset)
@@ -446,6 +596,183 @@ class LoadCellProbe:
         # return 0-force offset
         return b
 
+    def _perform_adaptive_fit(self, gcmd):
+        # Raster scan without a compensation lift at each data point. The
+        # force offset is measured before and after the scan and its drift
+        # is interpolated linearly in between.
+        gcmd.respond_info("PERFORM FIT (adaptive)")
+
+        z_start = self.tool.get_position()[2]
+        self._move_z_relative(self._compensation_z_lift)
+        offset_start = self._read_uncompensated_force(gcmd)
+        time_start = self._last_time
+        self._move_z_relative(-self._compensation_z_lift)
+
+        # take raster scan measurements to collect data for fit
+        raw_data = []
+        while True:
+            force_in = self._read_uncompensated_force(gcmd)
+            height = self.tool.get_position()[2]
+            gcmd.respond_info(
+                "pos = %f, force = %.1f" % (height, force_in - offset_start)
+            )
+            if abs(force_in - offset_start) > self._fit_threshold:
+                raw_data.append([height, force_in, self._last_time])
+                if len(raw_data) >= FIT_POINTS:
+                    break
+
+            # move to next position
+            self._move_z_relative(-1 * self._fit_step_size)
+
+            # abort if moved too far from start position
+            if z_start - self.tool.get_position()[2] \
+            > self._compensation_z_lift:
+                gcmd.respond_info("Fit failed, no contact found")
+                return None
+
+        # measure offset again and interpolate drift
+        lift = z_start + self._compensation_z_lift \
+               - self.tool.get_position()[2]
+        self._move_z_relative(lift)
+        offset_end = self._read_uncompensated_force(gcmd)
+        self._force_offset = offset_end
+        drift = (offset_end - offset_start) / (self._last_time - time_start)
+        gcmd.respond_info("Force offset drift = %f/s" % (drift,))
+        heights = [d[0] for d in raw_data]
+        forces = [d[1] - offset_start - drift * (d[2] - time_start)
+                  for d in raw_data]
+
+        # perform fit to find zero force contact position
+        m, b, r, sm, sb = mathutil.linear_regression(forces, heights)
+        gcmd.respond_info(
+            "Fit result: m = %f, b = %f, r = %f, sm = %f, sb = %f"
+            % (m, b, r, sm, sb)
+        )
+
+        # safety check: r must be big enough
+        if abs(r) < FIT_MIN_QUALITY:
+            gcmd.respond_info(
+                "Fit failed, fit quality factor r too small: %f < %f"
+                % (abs(r), FIT_MIN_QUALITY)
+            )
+            return None
+
+        # return 0-force offset
+        return b
+
+    def _check_stream_stop(self, forces, completion):
+        stop_force, stop_count = self._stream_stop
+        for time, force in forces:
+            force -= self._force_offset
+            if abs(force) > self._fit_threshold:
+                self._stream_fit_count += 1
+            if abs(force) > stop_force or (
+                    stop_count is not None
+                    and self._stream_fit_count >= stop_count):
+                self._reactor.async_complete(completion, True)
+                return
+
+    def _stream_move(self, gcmd, dist, speed, stop_force, stop_count=None):
+        # Move Z by dist at a constant speed while recording timestamped
+        # force samples.  The move is sent to the micro-controller in short
+        # pieces (the "drip" mode used for homing), so it can be stopped
+        # once stop_force is exceeded (or once stop_count samples are above
+        # the fit threshold).
+        samples = self._capture = []
+        self._stream_stop = (stop_force, stop_count)
+        self._stream_fit_count = 0
+        completion = self._stream_completion = self._reactor.completion()
+        pos = self.tool.get_position()
+        pos[2] += dist
+        try:
+            self.tool.drip_move(pos, speed, completion)
+        finally:
+            self._capture = self._stream_completion = None
+        self._move_count += 1
+        stopped = completion.test()
+        if stopped:
+            # Note the position at which the interrupted move stopped
+            kin = self.tool.get_kinematics()
+            spos = {s.get_name(): s.get_commanded_position()
+                    for s in kin.get_steppers()}
+            pos[2] = kin.calc_position(spos)[2]
+            self.tool.set_position(pos)
+        self.tool.wait_moves()
+        return samples, stopped
+
+    def _fit_samples(self, gcmd, samples, force_offset, name):
+        # Fit the zero force height from (height, force) data points of a
+        # continuous move
+        motion_report = self._printer.lookup_object("motion_report")
+        trapq = motion_report.trapqs["toolhead"]
+        data = []
+        for time, force in samples:
+            force -= force_offset
+            if abs(force) <= self._fit_threshold:
+                continue
+            pos, velocity = trapq.get_trapq_position(time)
+            if pos is not None:
+                data.append([pos[2], force])
+        if len(data) < FIT_POINTS:
+            gcmd.respond_info("Fit (%s) failed, only %d data points"
+                              % (name, len(data)))
+            return None
+        heights = [d[0] for d in data]
+        forces = [d[1] for d in data]
+        m, b, r, sm, sb = mathutil.linear_regression(forces, heights)
+        gcmd.respond_info(
+            "Fit (%s, %d points) result: m = %f, b = %f, r = %f, sm = %f,"
+            " sb = %f" % (name, len(data), m, b, r, sm, sb)
+        )
+        if abs(r) < FIT_MIN_QUALITY:
+            gcmd.respond_info(
+                "Fit failed, fit quality factor r too small: %f < %f"
+                % (abs(r), FIT_MIN_QUALITY)
+            )
+            return None
+        return b
+
+    def _continuous_probe(self, gcmd):
+        # Approach the surface at constant speed until the threshold is
+        # exceeded
+        self._force_offset = self._read_uncompensated_force(gcmd)
+        max_dist = CONTINUOUS_MAX_APPROACH_FACTOR * self._compensation_z_lift
+        samples, stopped = self._stream_move(
+            gcmd, -max_dist, self._approach_speed, self._threshold)
+        if not stopped:
+            raise gcmd.error("No contact found during continuous approach.")
+        gcmd.respond_info("Continuous approach found contact at z = %f"
+                          % (self.tool.get_position()[2],))
+
+        # Lift out of contact (the tool head may have moved up to one step
+        # after the contact was detected) and compensate
+        lift = 2.0 * self._step_size + self._compensation_z_lift
+        self._move_z_relative(lift)
+        offset_down = self._force_offset = \
+            self._read_uncompensated_force(gcmd)
+
+        # Slowly move through the contact and back up again.  Averaging the
+        # fits of both directions cancels the delay of the force readings.
+        fit_count = FIT_POINTS * CONTINUOUS_FIT_POINTS_FACTOR
+        z_start = self.tool.get_position()[2]
+        down, stopped = self._stream_move(
+            gcmd, -2.0 * lift, self._fit_speed,
+            self._threshold * THRESHOLD_DIVIDER, fit_count)
+        if not stopped:
+            gcmd.respond_info("Fit failed, no contact found")
+            return None
+        up, stopped = self._stream_move(
+            gcmd, z_start - self.tool.get_position()[2], self._fit_speed,
+            self._max_abs_force)
+        offset_up = self._read_uncompensated_force(gcmd)
+        self._force_offset = offset_up
+
+        b_down = self._fit_samples(gcmd, down, offset_down, "down")
+        b_up = self._fit_samples(gcmd, up, offset_up, "up")
+        if b_down is None or b_up is None:
+            return None
+        return 0.5 * (b_down + b_up)
+
     def _calc_mean(self, positions):
         count = float(len(positions))
         return [sum([pos[i] for pos in positions]) / count for i in range(3)]
@@ -575,6 +902,7 @@ class LoadCellProbe:
 
         correction_factor = weight / force
         self._force_calibration *= correction_factor
+        self._pipeline.set_calibration(self._force_calibration)
         gcmd.respond_info("New force_calibration = %.6f:" \
                           % self._force_calibration)
         self._noise_level *= correction_factor
@@ -642,6 +970,9 @@ class LoadCellProbe:
         gcmd.respond_info("fit_step_size = %f" % self._fit_step_size)
         gcmd.respond_info("compensation_z_lift = %f" \
                           % self._compensation_z_lift)
+        gcmd.respond_info("approach_speed = %f" % self._approach_speed)
+        gcmd.respond_info("fit_speed = %f" % self._fit_speed)
+        gcmd.respond_info("filter_latency = %f" % self._pipeline.get_latency())
 
 
 def load_config(config):
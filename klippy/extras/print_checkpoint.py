@@ -0,0 +1,333 @@
+# Periodic checkpoints of virtual_sdcard prints and resume support
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, json, logging, threading, queue
+import toolhead
+
+JOURNAL_VERSION = 1
+CHECK_TIME = 1.
+# Maximum number of checkpoints in the journal before it is compacted
+MAX_JOURNAL_ENTRIES = 100
+READ_BACK_SIZE = 64 * 1024
+
+# Append journal entries from a background thread (so that slow disk
+# writes do not stall the host)
+class JournalWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.entry_count = 0
+        self.bg_queue = queue.Queue()
+        self.bg_thread = threading.Thread(target=self._bg_thread)
+        self.bg_thread.daemon = True
+        self.bg_thread.start()
+    def _write_file(self, lines):
+        # Atomically replace the journal with the given lines
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, 'w') as f:
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpname, self.filename)
+        self.entry_count = len(lines)
+    def _append(self, line):
+        with open(self.filename, 'a') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.entry_count += 1
+    def _bg_thread(self):
+        header = None
+        while 1:
+            msg = self.bg_queue.get(True)
+            if msg is None:
+                break
+            action, line = msg
+            try:
+                if action == 'start':
+                    header = line
+                    self._write_file([header])
+                elif action == 'checkpoint':
+                    if self.entry_count >= MAX_JOURNAL_ENTRIES:
+                        self._write_file([header, line])
+                    else:
+                        self._append(line)
+                elif action == 'clear':
+                    header = None
+                    if os.path.exists(self.filename):
+                        os.remove(self.filename)
+            except OSError:
+                logging.exception("print_checkpoint: unable to write journal")
+    def start(self, header):
+        self.bg_queue.put_nowait(('start', json.dumps(header) + "\n"))
+    def checkpoint(self, entry):
+        self.bg_queue.put_nowait(('checkpoint', json.dumps(entry) + "\n"))
+    def clear(self):
+        self.bg_queue.put_nowait(('clear', None))
+    def stop(self):
+        self.bg_queue.put_nowait(None)
+        self.bg_thread.join()
+
+# Read the journal header and the last complete checkpoint
+def read_journal(filename):
+    with open(filename, 'rb') as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            return None, None
+        if header.get('version') != JOURNAL_VERSION:
+            return None, None
+        header_end = f.tell()
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        data = b""
+        while end > header_end:
+            start = max(header_end, end - READ_BACK_SIZE)
+            f.seek(start)
+            data = f.read(end - start) + data
+            end = start
+            lines = data.split(b'\n')
+            # The first line may be incomplete unless at the header
+            if end > header_end:
+                data = lines.pop(0)
+            else:
+                data = b""
+            for line in reversed(lines):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partially written entry
+                    continue
+                return header, entry
+    return header, None
+
+class PrintCheckpoint:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.filename = os.path.expanduser(config.get('filename'))
+        self.interval = config.getfloat('interval', 10., above=0.)
+        self.lift = config.getfloat('resume_lift', 2., minval=0.)
+        self.move_speed = config.getfloat('resume_speed', 50., above=0.)
+        self.sdcard = self.printer.load_object(config, 'virtual_sdcard')
+        self.print_stats = self.printer.load_object(config, 'print_stats')
+        self.gcode_move = self.printer.load_object(config, 'gcode_move')
+        self.toolhead = self.sdcard_loop = None
+        self.writer = None
+        self.next_checkpoint_time = 0.
+        # Snapshots waiting for their moves to complete
+        self.pending = []
+        self.active = False
+        self.resume_entry = None
+        self.check_timer = self.reactor.register_timer(self._check_event)
+        self.sdcard.set_checkpoint_handler(self._handle_file_position)
+        self.printer.register_event_handler("klippy:connect",
+                                            self._handle_connect)
+        self.printer.register_event_handler("klippy:ready",
+                                            self._handle_ready)
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self._handle_disconnect)
+        self.printer.register_event_handler("virtual_sdcard:load_file",
+                                            self._handle_load_file)
+        self.printer.register_event_handler("virtual_sdcard:reset_file",
+                                            self._clear)
+        # Register commands
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command("QUERY_CHECKPOINT",
+                                    self.cmd_QUERY_CHECKPOINT,
+                                    desc=self.cmd_QUERY_CHECKPOINT_help)
+        self.gcode.register_command("RESUME_CHECKPOINT",
+                                    self.cmd_RESUME_CHECKPOINT,
+                                    desc=self.cmd_RESUME_CHECKPOINT_help)
+        self.gcode.register_command("CLEAR_CHECKPOINT",
+                                    self.cmd_CLEAR_CHECKPOINT,
+                                    desc=self.cmd_CLEAR_CHECKPOINT_help)
+    def _handle_connect(self):
+        self.toolhead = self.printer.lookup_object('toolhead')
+        self.sdcard_loop = self.printer.lookup_object('sdcard_loop', None)
+        self.writer = JournalWriter(self.filename)
+    def _handle_ready(self):
+        self.reactor.update_timer(self.check_timer, self.reactor.NOW)
+    def _handle_disconnect(self):
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+    # Checkpoint creation
+    def _handle_load_file(self, filename):
+        self.pending = []
+        self.active = True
+        self.next_checkpoint_time = 0.
+        try:
+            st = os.stat(filename)
+        except OSError:
+            self.active = False
+            return
+        self.writer.start({'version': JOURNAL_VERSION, 'file': filename,
+                           'size': st.st_size, 'modified': st.st_mtime})
+        if self.resume_entry is not None:
+            # Keep the checkpoint being resumed until a new one is stored
+            self.writer.checkpoint(self.resume_entry)
+            self.resume_entry = None
+    def _clear(self):
+        self.pending = []
+        self.active = False
+        self.writer.clear()
+    def _snapshot(self, eventtime, file_position):
+        th_status = self.toolhead.get_status(eventtime)
+        ps_status = self.print_stats.get_status(eventtime)
+        pheaters = self.printer.lookup_object('heaters')
+        heaters = {}
+        for name in pheaters.get_all_heaters():
+            heater = pheaters.lookup_heater(name.split()[-1])
+            heaters[name] = heater.get_status(eventtime)['target']
+        entry = {
+            'position': file_position,
+            'gcode_state': self.gcode_move.get_gcode_state(),
+            'extruder': th_status['extruder'],
+            'velocity_limits': {
+                'VELOCITY': th_status['max_velocity'],
+                'ACCEL': th_status['max_accel'],
+                'SQUARE_CORNER_VELOCITY': th_status['square_corner_velocity'],
+                'MINIMUM_CRUISE_RATIO': th_status['minimum_cruise_ratio']},
+            'heaters': heaters,
+            'total_duration': ps_status['total_duration'],
+            'print_duration': ps_status['print_duration'],
+            'filament_used': ps_status['filament_used'],
+        }
+        fan = self.printer.lookup_object('fan', None)
+        if fan is not None:
+            entry['fan_speed'] = fan.get_status(eventtime)['speed']
+        bed_mesh = self.printer.lookup_object('bed_mesh', None)
+        if bed_mesh is not None:
+            entry['bed_mesh_profile'] = bed_mesh.get_status(eventtime)[
+                'profile_name']
+        if self.sdcard_loop is not None:
+            entry['loop_stack'] = [list(l) for l in self.sdcard_loop.loop_stack]
+        return th_status['print_time'], entry
+    def _handle_file_position(self, file_position):
+        eventtime = self.reactor.monotonic()
+        if eventtime < self.next_checkpoint_time or not self.active:
+            return
+        self.next_checkpoint_time = eventtime + self.interval
+        self.pending.append(self._snapshot(eventtime, file_position))
+    def _check_event(self, eventtime):
+        if self.active:
+            state = self.print_stats.get_status(eventtime)['state']
+            if state in ('complete', 'cancelled'):
+                # Print is no longer resumable
+                self._clear()
+                return eventtime + CHECK_TIME
+        if not self.pending:
+            return eventtime + CHECK_TIME
+        # A checkpoint is only stored after all the moves it describes
+        # have been performed
+        th_status = self.toolhead.get_status(eventtime)
+        est_print_time = th_status['estimated_print_time']
+        done = [entry for print_time, entry in self.pending
+                if print_time + toolhead.BUFFER_TIME_HIGH <= est_print_time]
+        if done:
+            del self.pending[:len(done)]
+            self.writer.checkpoint(done[-1])
+        return eventtime + CHECK_TIME
+    # Resume
+    def _read_checkpoint(self, gcmd):
+        try:
+            header, entry = read_journal(self.filename)
+        except OSError:
+            raise gcmd.error("No print checkpoint available")
+        if header is None or entry is None:
+            raise gcmd.error("No print checkpoint available")
+        return header, entry
+    cmd_QUERY_CHECKPOINT_help = "Report the last stored print checkpoint"
+    def cmd_QUERY_CHECKPOINT(self, gcmd):
+        header, entry = self._read_checkpoint(gcmd)
+        pos = entry['gcode_state']['last_position']
+        gcmd.respond_info(
+            "Checkpoint of %s at file position %d (%.1f%%)\n"
+            "Print duration: %.1fs\n"
+            "Position: X:%.3f Y:%.3f Z:%.3f E:%.3f" % (
+                header['file'], entry['position'],
+                100. * entry['position'] / max(1, header['size']),
+                entry['print_duration'], pos[0], pos[1], pos[2], pos[3]))
+    def _restore_heaters(self, entry):
+        pheaters = self.printer.lookup_object('heaters')
+        heaters = [(pheaters.lookup_heater(name.split()[-1]), target)
+                   for name, target in entry['heaters'].items()
+                   if name in pheaters.get_all_heaters()]
+        for heater, target in heaters:
+            pheaters.set_temperature(heater, target)
+        for heater, target in heaters:
+            pheaters.set_temperature(heater, target, wait=True)
+    def _restore_position(self, gcmd, entry):
+        state = entry['gcode_state']
+        lift = gcmd.get_float('LIFT', self.lift, minval=0.)
+        speed = gcmd.get_float('SPEED', self.move_speed, above=0.)
+        target = state['last_position']
+        cur_pos = self.gcode_move.get_status()['position']
+        safe_z = max(cur_pos[2], target[2] + lift)
+        # Raise, then move over the print, then descend
+        for pos in [[cur_pos[0], cur_pos[1], safe_z],
+                    [target[0], target[1], safe_z], target[:3]]:
+            move_state = dict(state)
+            move_state['last_position'] = pos + [target[3]]
+            self.gcode_move.restore_gcode_state(move_state, True, speed)
+    cmd_RESUME_CHECKPOINT_help = "Resume a print from the last checkpoint"
+    def cmd_RESUME_CHECKPOINT(self, gcmd):
+        if self.sdcard.is_active():
+            raise gcmd.error("SD busy")
+        header, entry = self._read_checkpoint(gcmd)
+        fname = header['file']
+        try:
+            st = os.stat(fname)
+        except OSError:
+            raise gcmd.error("Unable to open file %s" % (fname,))
+        if st.st_size != header['size'] or st.st_mtime != header['modified']:
+            raise gcmd.error("File %s was modified after the checkpoint"
+                             % (fname,))
+        curtime = self.reactor.monotonic()
+        homed = self.toolhead.get_status(curtime)['homed_axes']
+        if 'x' not in homed or 'y' not in homed or 'z' not in homed:
+            raise gcmd.error("Must home axes before resuming")
+        gcmd.respond_info("Resuming %s at file position %d"
+                          % (fname, entry['position']))
+        # Restore machine state
+        run_script = self.gcode.run_script_from_command
+        if entry['extruder'] != self.toolhead.get_extruder().get_name():
+            run_script("ACTIVATE_EXTRUDER EXTRUDER=%s" % (entry['extruder'],))
+        run_script("SET_VELOCITY_LIMIT " + " ".join(
+            ["%s=%.6f" % (k, v)
+             for k, v in sorted(entry['velocity_limits'].items())]))
+        profile = entry.get('bed_mesh_profile')
+        if profile:
+            bed_mesh = self.printer.lookup_object('bed_mesh')
+            if profile in bed_mesh.pmgr.get_profiles():
+                run_script("BED_MESH_PROFILE LOAD=%s" % (profile,))
+            else:
+                gcmd.respond_info("Bed mesh profile '%s' not available"
+                                  % (profile,))
+        self._restore_heaters(entry)
+        self._restore_position(gcmd, entry)
+        fan = self.printer.lookup_object('fan', None)
+        if fan is not None and 'fan_speed' in entry:
+            fan.fan.set_speed_from_command(entry['fan_speed'])
+        # Continue the print at the checkpoint
+        relpath = os.path.relpath(fname, self.sdcard.sdcard_dirname)
+        self.resume_entry = entry
+        run_script("M23 /%s" % (relpath,))
+        self.resume_entry = None
+        # Loading the file reset the print statistics
+        self.print_stats.restore_totals(
+            entry.get('total_duration', entry['print_duration']),
+            entry['print_duration'], entry.get('filament_used', 0.))
+        run_script("M26 S%d" % (entry['position'],))
+        if self.sdcard_loop is not None:
+            self.sdcard_loop.loop_stack = [
+                tuple(l) for l in entry.get('loop_stack', [])]
+        run_script("M24")
+    cmd_CLEAR_CHECKPOINT_help = "Remove the stored print checkpoint"
+    def cmd_CLEAR_CHECKPOINT(self, gcmd):
+        self._clear()
+
+def load_config(config):
+    return PrintCheckpoint(config)
@@ -0,0 +1,436 @@
+# Estimate print time by simulating the motion planner on a g-code file
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import logging, math, re, os, bisect, multiprocessing, traceback
+import toolhead
+
+SAMPLE_TIME = 1.
+POLL_TIME = 1.
+
+######################################################################
+# Motion simulation
+######################################################################
+
+# Extruder limits used by the simulated toolhead
+class SimExtruder:
+    def __init__(self, limits):
+        self.instant_corner_v = limits.get('instant_corner_v')
+        self.max_e_velocity = limits.get('max_e_velocity')
+        self.max_e_accel = limits.get('max_e_accel')
+    def check_move(self, move):
+        if self.max_e_velocity is None:
+            return
+        axis_r = move.axes_r[3]
+        if (not move.axes_d[0] and not move.axes_d[1]
+            and not move.axes_d[2]):
+            # Extrude only move
+            inv_extrude_r = 1. / abs(axis_r)
+            move.limit_speed(self.max_e_velocity * inv_extrude_r,
+                             self.max_e_accel * inv_extrude_r)
+    def calc_junction(self, prev_move, move):
+        diff_r = move.axes_r[3] - prev_move.axes_r[3]
+        if diff_r and self.instant_corner_v is not None:
+            return (self.instant_corner_v / abs(diff_r))**2
+        return move.max_cruise_v2
+
+# Minimal toolhead that feeds moves through the real look-ahead queue
+# and only tracks the resulting move timing
+class SimToolHead:
+    def __init__(self, limits):
+        self.max_velocity = limits['max_velocity']
+        self.max_accel = limits['max_accel']
+        self.min_cruise_ratio = limits['minimum_cruise_ratio']
+        self.square_corner_velocity = limits['square_corner_velocity']
+        self.max_z_velocity = limits.get('max_z_velocity')
+        self.max_z_accel = limits.get('max_z_accel')
+        self.junction_deviation = self.max_accel_to_decel = 0.
+        self._calc_junction_deviation()
+        self.extruder = SimExtruder(limits)
+        self.commanded_pos = list(limits['position'])
+        self.lookahead = toolhead.LookAheadQueue(self)
+        self.lookahead.set_flush_time(toolhead.BUFFER_TIME_HIGH)
+        self.print_time = 0.
+        # Results
+        self.sample_positions = [0]
+        self.sample_times = [0.]
+        self.layer_times = []
+    def _calc_junction_deviation(self):
+        scv2 = self.square_corner_velocity**2
+        self.junction_deviation = scv2 * (math.sqrt(2.) - 1.) / self.max_accel
+        self.max_accel_to_decel = self.max_accel * (1. - self.min_cruise_ratio)
+    def set_limits(self, max_velocity=None, max_accel=None,
+                   square_corner_velocity=None, min_cruise_ratio=None):
+        if max_velocity is not None:
+            self.max_velocity = max_velocity
+        if max_accel is not None:
+            self.max_accel = max_accel
+        if square_corner_velocity is not None:
+            self.square_corner_velocity = square_corner_velocity
+        if min_cruise_ratio is not None:
+            self.min_cruise_ratio = min_cruise_ratio
+        self._calc_junction_deviation()
+    def _note_time(self, file_pos, layer_start=False):
+        if layer_start:
+            self.layer_times.append(self.print_time)
+        if self.print_time >= self.sample_times[-1] + SAMPLE_TIME:
+            self.sample_positions.append(file_pos)
+            self.sample_times.append(self.print_time)
+    def _process_moves(self, moves):
+        for move in moves:
+            self._note_time(move.file_pos, move.layer_start)
+            self.print_time += move.accel_t + move.cruise_t + move.decel_t
+    def move(self, newpos, speed, file_pos, layer_start=False):
+        move = toolhead.Move(self, self.commanded_pos, newpos, speed)
+        if not move.move_d:
+            return
+        move.file_pos = file_pos
+        move.layer_start = layer_start
+        if move.is_kinematic_move and move.axes_d[2]:
+            if self.max_z_velocity is not None:
+                z_ratio = move.move_d / abs(move.axes_d[2])
+                move.limit_speed(self.max_z_velocity * z_ratio,
+                                 self.max_z_accel * z_ratio)
+        if move.axes_d[3]:
+            self.extruder.check_move(move)
+        self.commanded_pos[:] = move.end_pos
+        self.lookahead.add_move(move)
+    def dwell(self, delay, file_pos):
+        self.lookahead.flush()
+        self.print_time += max(0., delay)
+        self._note_time(file_pos)
+    def flush(self, file_pos):
+        self.lookahead.flush()
+        self._note_time(file_pos)
+
+# Interpret the movement commands of a g-code file
+class GCodeSimulator:
+    args_r = re.compile('([A-Z_]+|[A-Z*])')
+    def __init__(self, limits):
+        self.toolhead = SimToolHead(limits)
+        self.arc_resolution = limits.get('arc_resolution', 1.)
+        self.absolute_coord = self.absolute_extrude = True
+        self.base_position = [0., 0., 0., 0.]
+        self.last_position = list(limits['position'])
+        self.speed = 25.
+        # Layer tracking
+        self.layer_z = None
+        self.pending_layer = False
+        self.info_layers = False
+        self.info_layer_times = []
+    def _parse_line(self, line):
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        parts = self.args_r.split(line.strip().upper())
+        if ''.join(parts[:2]) == 'N':
+            parts = parts[2:]
+        cmd = ''.join(parts[:3]).strip()
+        params = { parts[i]: parts[i+1].strip()
+                   for i in range(1, len(parts), 2) }
+        return cmd, params
+    def _parse_extended(self, line):
+        params = {}
+        for part in line.split()[1:]:
+            if '=' in part:
+                name, val = part.split('=', 1)
+                params[name.upper()] = val
+        return params
+    def _get_float(self, params, name):
+        try:
+            return float(params[name])
+        except (KeyError, ValueError):
+            return None
+    def _move(self, newpos, file_pos):
+        th = self.toolhead
+        layer_start = False
+        if self.info_layers:
+            layer_start = self.pending_layer
+            self.pending_layer = False
+        elif (newpos[3] > self.last_position[3]
+              and (newpos[0] != self.last_position[0]
+                   or newpos[1] != self.last_position[1])
+              and (self.layer_z is None or newpos[2] > self.layer_z)):
+            # First extruding XY move at a new height
+            self.layer_z = newpos[2]
+            layer_start = True
+        th.move(newpos, self.speed, file_pos, layer_start)
+        self.last_position[:] = newpos
+    def _get_target(self, params):
+        pos = list(self.last_position)
+        for pos_index, axis in enumerate('XYZ'):
+            v = self._get_float(params, axis)
+            if v is not None:
+                if self.absolute_coord:
+                    pos[pos_index] = v + self.base_position[pos_index]
+                else:
+                    pos[pos_index] += v
+        v = self._get_float(params, 'E')
+        if v is not None:
+            if self.absolute_coord and self.absolute_extrude:
+                pos[3] = v + self.base_position[3]
+            else:
+                pos[3] += v
+        v = self._get_float(params, 'F')
+        if v is not None and v > 0.:
+            self.speed = v / 60.
+        return pos
+    def _arc(self, params, clockwise, file_pos):
+        start = list(self.last_position)
+        target = self._get_target(params)
+        offset_i = self._get_float(params, 'I') or 0.
+        offset_j = self._get_float(params, 'J') or 0.
+        center_x = start[0] + offset_i
+        center_y = start[1] + offset_j
+        angle_start = math.atan2(start[1] - center_y, start[0] - center_x)
+        angle_end = math.atan2(target[1] - center_y, target[0] - center_x)
+        angular_travel = angle_end - angle_start
+        if clockwise:
+            if angular_travel >= 0.:
+                angular_travel -= 2. * math.pi
+        elif angular_travel <= 0.:
+            angular_travel += 2. * math.pi
+        radius = math.hypot(offset_i, offset_j)
+        segments = max(1, int(abs(radius * angular_travel)
+                              / self.arc_resolution))
+        for i in range(1, segments):
+            r = float(i) / segments
+            angle = angle_start + angular_travel * r
+            self._move([center_x + radius * math.cos(angle),
+                        center_y + radius * math.sin(angle),
+                        start[2] + (target[2] - start[2]) * r,
+                        start[3] + (target[3] - start[3]) * r], file_pos)
+        self._move(target, file_pos)
+    def process_line(self, line, file_pos):
+        cmd, params = self._parse_line(line)
+        th = self.toolhead
+        if cmd in ('G1', 'G0'):
+            self._move(self._get_target(params), file_pos)
+        elif cmd in ('G2', 'G3'):
+            self._arc(params, cmd == 'G2', file_pos)
+        elif cmd == 'G4':
+            delay = self._get_float(params, 'P')
+            if delay is not None:
+                th.dwell(delay / 1000., file_pos)
+        elif cmd == 'G90':
+            self.absolute_coord = True
+        elif cmd == 'G91':
+            self.absolute_coord = False
+        elif cmd == 'M82':
+            self.absolute_extrude = True
+        elif cmd == 'M83':
+            self.absolute_extrude = False
+        elif cmd == 'G92':
+            for pos_index, axis in enumerate('XYZE'):
+                v = self._get_float(params, axis)
+                if v is not None:
+                    self.base_position[pos_index] = (
+                        self.last_position[pos_index] - v)
+        elif cmd == 'G28':
+            th.flush(file_pos)
+            axes = [i for i, a in enumerate('XYZ') if a in params]
+            for pos_index in axes or [0, 1, 2]:
+                self.last_position[pos_index] = 0.
+                th.commanded_pos[pos_index] = 0.
+        elif cmd in ('M400', 'M109', 'M190'):
+            th.flush(file_pos)
+        elif cmd == 'M204':
+            accel = self._get_float(params, 'S')
+            if accel is None:
+                p = self._get_float(params, 'P')
+                t = self._get_float(params, 'T')
+                if p is not None and t is not None:
+                    accel = min(p, t)
+            if accel is not None and accel > 0.:
+                th.set_limits(max_accel=accel)
+        elif cmd.startswith('SET_VELOCITY_LIMIT'):
+            params = self._parse_extended(line)
+            max_accel = self._get_float(params, 'ACCEL')
+            min_cruise_ratio = self._get_float(params, 'MINIMUM_CRUISE_RATIO')
+            accel_to_decel = self._get_float(params, 'ACCEL_TO_DECEL')
+            if min_cruise_ratio is None and accel_to_decel is not None:
+                min_cruise_ratio = 1. - min(1., accel_to_decel / (
+                    max_accel or th.max_accel))
+            th.set_limits(self._get_float(params, 'VELOCITY'), max_accel,
+                          self._get_float(params, 'SQUARE_CORNER_VELOCITY'),
+                          min_cruise_ratio)
+        elif cmd.startswith('SET_PRINT_STATS_INFO'):
+            params = self._parse_extended(line)
+            if 'CURRENT_LAYER' in params:
+                self.info_layers = self.pending_layer = True
+    def finish(self, file_pos):
+        th = self.toolhead
+        th.flush(file_pos)
+        th.sample_positions.append(file_pos)
+        th.sample_times.append(th.print_time)
+        total_time = th.print_time
+        starts = th.layer_times
+        layer_times = [e - s for s, e in zip(starts, starts[1:] + [total_time])]
+        return {'total_time': total_time,
+                'positions': th.sample_positions, 'times': th.sample_times,
+                'layer_starts': starts, 'layer_times': layer_times}
+
+def simulate_file(filename, limits):
+    sim = GCodeSimulator(limits)
+    file_pos = 0
+    with open(filename, 'rb') as f:
+        for line in f:
+            sim.process_line(line.decode(errors='replace'), file_pos)
+            file_pos += len(line)
+    return sim.finish(file_pos)
+
+
+######################################################################
+# Background estimation
+######################################################################
+
+class PrintEstimator:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.toolhead = self.sdcard = None
+        self.calc_proc = self.parent_conn = None
+        self.poll_timer = None
+        self.results = None
+        self.state = "none"
+        self.layer_times = []
+        self.print_stats = self.printer.load_object(config, 'print_stats')
+        self.print_stats.set_estimator(self)
+        self.printer.register_event_handler("klippy:connect",
+                                            self._handle_connect)
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self._stop_process)
+        self.printer.register_event_handler("virtual_sdcard:load_file",
+                                            self._handle_load_file)
+        self.printer.register_event_handler("virtual_sdcard:reset_file",
+                                            self._handle_reset_file)
+    def _handle_connect(self):
+        self.toolhead = self.printer.lookup_object('toolhead')
+        self.sdcard = self.printer.lookup_object('virtual_sdcard', None)
+    def _get_limits(self):
+        eventtime = self.reactor.monotonic()
+        status = self.toolhead.get_status(eventtime)
+        limits = {name: status[name]
+                  for name in ['max_velocity', 'max_accel',
+                               'minimum_cruise_ratio',
+                               'square_corner_velocity']}
+        limits['position'] = list(status['position'])
+        kin = self.toolhead.get_kinematics()
+        for name in ['max_z_velocity', 'max_z_accel']:
+            if hasattr(kin, name):
+                limits[name] = getattr(kin, name)
+        extruder = self.toolhead.get_extruder()
+        for name in ['instant_corner_v', 'max_e_velocity', 'max_e_accel']:
+            if hasattr(extruder, name):
+                limits[name] = getattr(extruder, name)
+        gcode_arcs = self.printer.lookup_object('gcode_arcs', None)
+        if gcode_arcs is not None:
+            limits['arc_resolution'] = gcode_arcs.mm_per_arc_segment
+        return limits
+    def _stop_process(self):
+        if self.poll_timer is not None:
+            self.reactor.unregister_timer(self.poll_timer)
+            self.poll_timer = None
+        if self.calc_proc is not None:
+            self.calc_proc.terminate()
+            self.calc_proc.join()
+            self.parent_conn.close()
+            self.calc_proc = self.parent_conn = None
+    def _handle_load_file(self, filename):
+        self._stop_process()
+        self.results = None
+        self.state = "analyzing"
+        self.layer_times = []
+        limits = self._get_limits()
+        parent_conn, child_conn = multiprocessing.Pipe()
+        def wrapper():
+            import queuelogger
+            queuelogger.clear_bg_logging()
+            try:
+                os.nice(10)
+            except OSError:
+                pass
+            try:
+                res = simulate_file(filename, limits)
+            except:
+                child_conn.send((True, traceback.format_exc()))
+                child_conn.close()
+                return
+            child_conn.send((False, res))
+            child_conn.close()
+        self.calc_proc = multiprocessing.Process(target=wrapper)
+        self.calc_proc.daemon = True
+        self.calc_proc.start()
+        self.parent_conn = parent_conn
+        self.poll_timer = self.reactor.register_timer(
+            self._poll_process, self.reactor.monotonic() + POLL_TIME)
+    def _handle_reset_file(self):
+        self._stop_process()
+        self.results = None
+        self.state = "none"
+        self.layer_times = []
+    def _poll_process(self, eventtime):
+        if self.parent_conn.poll():
+            try:
+                is_err, res = self.parent_conn.recv()
+            except EOFError:
+                is_err, res = True, "estimation process exited unexpectedly"
+            self.poll_timer = None
+            self._stop_process()
+            if is_err:
+                logging.error("Print time estimation failed: %s", res)
+                self.state = "error"
+                return self.reactor.NEVER
+            self.results = res
+            self.state = "ready"
+            self.layer_times = res['layer_times']
+            logging.info("Estimated print time: %.1f seconds (%d layers)",
+                         res['total_time'], len(res['layer_times']))
+            return self.reactor.NEVER
+        if not self.calc_proc.is_alive():
+            self.poll_timer = None
+            self._stop_process()
+            self.state = "error"
+            return self.reactor.NEVER
+        return eventtime + POLL_TIME
+    def _lookup_time(self, file_pos):
+        res = self.results
+        positions, times = res['positions'], res['times']
+        i = bisect.bisect_right(positions, file_pos)
+        if i >= len(positions):
+            return res['total_time']
+        prev_pos, next_pos = positions[i-1], positions[i]
+        prev_time, next_time = times[i-1], times[i]
+        if next_pos <= prev_pos:
+            return prev_time
+        r = float(file_pos - prev_pos) / (next_pos - prev_pos)
+        return prev_time + (next_time - prev_time) * r
+    def get_estimate(self, eventtime):
+        res = self.results
+        if res is None:
+            return {'state': self.state}
+        file_pos = 0
+        if self.sdcard is not None:
+            file_pos = self.sdcard.file_position
+        total_time = res['total_time']
+        # Time of moves already queued in the toolhead (but not yet
+        # performed) is still remaining
+        est_time = self._lookup_time(file_pos)
+        status = self.toolhead.get_status(eventtime)
+        if file_pos:
+            est_time -= max(0., status['print_time']
+                            - status['estimated_print_time'])
+        est_time = min(max(0., est_time), total_time)
+        layer = bisect.bisect_right(res['layer_starts'], est_time)
+        return {'state': self.state, 'total_time': total_time,
+                'remaining_time': total_time - est_time,
+                'progress': est_time / total_time if total_time else 0.,
+                'current_layer': layer}
+    def get_status(self, eventtime):
+        # The layer durations only change when an analysis completes, so
+        # they are reported separately from the frequently updated estimate
+        return {'layer_times': self.layer_times}
+
+def load_config(config):
+    return PrintEstimator(config)
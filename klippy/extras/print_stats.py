@@ -9,6 +9,7 @@ class PrintStats:
         printer = config.get_printer()
         self.gcode_move = printer.load_object(config, 'gcode_move')
         self.reactor = printer.get_reactor()
+        self.estimator = None
         self.reset()
         # Register commands
         self.gcode = printer.lookup_object('gcode')
@@ -21,9 +22,16 @@ class PrintStats:
         self.filament_used += (cur_epos - self.last_epos) \
             / gc_status['extrude_factor']
         self.last_epos = cur_epos
+    def set_estimator(self, estimator):
+        self.estimator = estimator
     def set_current_file(self, filename):
         self.reset()
         self.filename = filename
+    def restore_totals(self, total_duration, print_duration, filament_used):
+        # Continue the totals of a print resumed from an earlier session
+        self.prev_total_duration = total_duration
+        self.prev_print_duration = print_duration
+        self.filament_used = filament_used
     def note_start(self):
         curtime = self.reactor.monotonic()
         if self.print_start_time is None:
@@ -89,6 +97,7 @@ class PrintStats:
         self.filament_used = self.total_duration = 0.
         self.print_start_time = self.last_pause_time = None
         self.init_duration = 0.
+        self.prev_total_duration = self.prev_print_duration = 0.
         self.info_total_layer = None
         self.info_current_layer = None
     def get_status(self, eventtime):
@@ -105,16 +114,19 @@ class PrintStats:
                 # Track duration prior to extrusion
                 self.init_duration = self.total_duration - time_paused
         print_duration = self.total_duration - self.init_duration - time_paused
-        return {
+        status = {
             'filename': self.filename,
-            'total_duration': self.total_duration,
-            'print_duration': print_duration,
+            'total_duration': self.prev_total_duration + self.total_duration,
+            'print_duration': self.prev_print_duration + print_duration,
             'filament_used': self.filament_used,
             'state': self.state,
             'message': self.error_message,
             'info': {'total_layer': self.info_total_layer,
                      'current_layer': self.info_current_layer}
         }
+        if self.estimator is not None:
+            status['estimate'] = self.estimator.get_estimate(eventtime)
+        return status
 
 def load_config(config):
     return PrintStats(config)
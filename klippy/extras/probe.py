@@ -3,7 +3,7 @@
 # Copyright (C) 2017-2024  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
+import logging, time
 import pins
 from . import manual_probe
 
@@ -393,10 +393,17 @@ class ProbePointsHelper:
         self.default_horizontal_move_z = def_move_z
         self.speed = config.getfloat('speed', 50., above=0.)
         self.use_offsets = False
+        # Pipelined probing (travel at a reduced height between points)
+        self.pipeline = config.getboolean('pipeline_probing', False)
+        self.pipeline_clearance = config.getfloat('pipeline_clearance', 1.,
+                                                  above=0.)
         # Internal probing state
         self.lift_speed = self.speed
         self.probe_offsets = (0., 0., 0.)
         self.manual_results = []
+        self.measured = []
+        self.point_times = []
+        self.point_info = []
     def minimum_points(self,n):
         if len(self.probe_points) < n:
             raise self.printer.config_error(
@@ -408,14 +415,19 @@ class ProbePointsHelper:
         self.use_offsets = use_offsets
     def get_lift_speed(self):
         return self.lift_speed
+    def get_point_info(self):
+        # Time and temperatures at each point of the reported results
+        return list(self.point_info)
     def _move(self, coord, speed):
         self.printer.lookup_object('toolhead').manual_move(coord, speed)
-    def _raise_tool(self, is_first=False):
+    def _raise_tool(self, is_first=False, move_z=None):
         speed = self.lift_speed
         if is_first:
             # Use full speed to first probe position
             speed = self.speed
-        self._move([None, None, self.horizontal_move_z], speed)
+        if move_z is None:
+            move_z = self.horizontal_move_z
+        self._move([None, None, move_z], speed)
     def _invoke_callback(self, results):
         # Flush lookahead queue
         toolhead = self.printer.lookup_object('toolhead')
@@ -423,13 +435,37 @@ class ProbePointsHelper:
         # Invoke callback
         res = self.finalize_callback(self.probe_offsets, results)
         return res != "retry"
-    def _move_next(self, probe_num):
-        # Move to next XY probe point
+    def _get_next_pos(self, probe_num):
         nextpos = list(self.probe_points[probe_num])
         if self.use_offsets:
             nextpos[0] -= self.probe_offsets[0]
             nextpos[1] -= self.probe_offsets[1]
-        self._move(nextpos, self.speed)
+        return nextpos
+    def _move_next(self, probe_num):
+        # Move to next XY probe point
+        self._move(self._get_next_pos(probe_num), self.speed)
+    def _get_pipeline_move_z(self, probe_num):
+        # Travel just above the highest nearby probe result
+        if probe_num >= len(self.probe_points) or not self.measured:
+            return self.horizontal_move_z
+        next_x, next_y = self._get_next_pos(probe_num)
+        nearest = sorted(self.measured, key=(lambda m: (m[0] - next_x)**2
+                                             + (m[1] - next_y)**2))[:3]
+        toolhead = self.printer.lookup_object('toolhead')
+        max_z = max([toolhead.get_position()[2]] + [m[2] for m in nearest])
+        return min(max_z + self.pipeline_clearance, self.horizontal_move_z)
+    def _report_times(self, gcmd):
+        count = len(self.point_times)
+        if not count:
+            return
+        travel_time = sum([t for t, p in self.point_times])
+        probe_time = sum([p for t, p in self.point_times])
+        gcmd.respond_info(
+            "Probed %d points in %.3fs (%.3fs per point,"
+            " travel %.3fs, probing %.3fs)" % (
+                count, travel_time + probe_time,
+                (travel_time + probe_time) / count,
+                travel_time / count, probe_time / count))
     def start_probe(self, gcmd):
         manual_probe.verify_no_manual_probe(self.printer)
         # Lookup objects
@@ -443,6 +479,7 @@ class ProbePointsHelper:
             self.lift_speed = self.speed
             self.probe_offsets = (0., 0., 0.)
             self.manual_results = []
+            self.point_info = []
             self._manual_probe_start()
             return
         # Perform automatic probing
@@ -451,10 +488,23 @@ class ProbePointsHelper:
         if self.horizontal_move_z < self.probe_offsets[2]:
             raise gcmd.error("horizontal_move_z can't be less than"
                              " probe's z_offset")
+        pipeline = gcmd.get_int('PIPELINE', self.pipeline,
+                                minval=0, maxval=1)
+        toolhead = self.printer.lookup_object('toolhead')
+        reactor = self.printer.get_reactor()
         probe_session = probe.start_probe_session(gcmd)
+        self.measured = []
+        self.point_times = []
+        self.point_info = []
         probe_num = 0
         while 1:
-            self._raise_tool(not probe_num)
+            move_z = None
+            if pipeline:
+                move_z = self._get_pipeline_move_z(probe_num)
+            if probe_num < len(self.probe_points):
+                start_time = reactor.monotonic()
+                start_print_time = toolhead.get_last_move_time()
+            self._raise_tool(not probe_num, move_z)
             if probe_num >= len(self.probe_points):
                 results = probe_session.pull_probed_results()
                 done = self._invoke_callback(results)
@@ -462,10 +512,22 @@ class ProbePointsHelper:
                     break
                 # Caller wants a "retry" - restart probing
                 probe_num = 0
+                self.measured = []
+                self.point_info = []
+                start_time = reactor.monotonic()
+                start_print_time = toolhead.get_last_move_time()
             self._move_next(probe_num)
+            travel_time = toolhead.get_last_move_time() - start_print_time
             probe_session.run_probe(gcmd)
+            # Note timing and the height at which the probe triggered
+            probe_time = reactor.monotonic() - start_time - travel_time
+            self.point_times.append((travel_time, max(0., probe_time)))
+            self.point_info.append(get_point_info(self.printer))
+            self.measured.append(toolhead.get_position()[:3])
             probe_num += 1
         probe_session.end_probe_session()
+        if pipeline:
+            self._report_times(gcmd)
     def _manual_probe_start(self):
         self._raise_tool(not self.manual_results)
         if len(self.manual_results) >= len(self.probe_points):
@@ -474,6 +536,7 @@ class ProbePointsHelper:
                 return
             # Caller wants a "retry" - clear results and restart probing
             self.manual_results = []
+            self.point_info = []
         self._move_next(len(self.manual_results))
         gcmd = self.gcode.create_gcode_command("", "", {})
         manual_probe.ManualProbeHelper(self.printer, gcmd,
@@ -482,8 +545,21 @@ class ProbePointsHelper:
         if kin_pos is None:
             return
         self.manual_results.append(kin_pos)
+        self.point_info.append(get_point_info(self.printer))
         self._manual_probe_start()
 
+# Wall clock time and bed and extruder temperatures for a probed point
+def get_point_info(printer):
+    eventtime = printer.get_reactor().monotonic()
+    info = [time.time()]
+    for name in ['heater_bed', 'extruder']:
+        heater = printer.lookup_object(name, None)
+        if heater is None:
+            info.append(0.)
+        else:
+            info.append(heater.get_status(eventtime)['temperature'])
+    return tuple(info)
+
 # Helper to obtain a single probe measurement
 def run_single_probe(probe, gcmd):
     probe_session = probe.start_probe_session(gcmd)
@@ -16,6 +16,16 @@ position can be negative).
 
 direction_types = {'x+': [0, +1], 'x-': [0, -1], 'y+': [1, +1], 'y-': [1, -1]}
 
+# Two-sided 95% quantiles of the student t distribution (by degrees of
+# freedom) used for the confidence interval of adaptive sampling
+T_QUANTILES = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306,
+               2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131]
+T_QUANTILE_LIMIT = 1.960
+
+# Minimum number of touches allowed in adaptive sampling (unless a
+# SAMPLES parameter is given)
+ADAPTIVE_MIN_MAX_SAMPLES = 5
+
 
 class PrinterProbeXY:
     def __init__(self, config, mcu_probe_x, mcu_probe_y):
@@ -47,6 +57,10 @@ class PrinterProbeXY:
                                                  minval=0.)
         self.samples_retries = config.getint('samples_tolerance_retries', 0,
                                              minval=0)
+        # Adaptive sampling: stop once the confidence interval is small enough
+        self.samples_adaptive = config.getboolean('samples_adaptive', False)
+        self.samples_approach_margin = config.getfloat(
+            'samples_approach_margin', 0.5, minval=0.)
         # Register xy_virtual_endstop pin
         self.printer.lookup_object('pins').register_chip('probe_xy', self)
         # Register homing event handlers
@@ -134,9 +148,11 @@ class PrinterProbeXY:
         # even number of samples
         return self._calc_mean(axis_sorted[middle-1:middle+1])
 
-    def run_probe(self, gcmd):
+    def run_probe(self, gcmd, direction=None):
         speed = gcmd.get_float("PROBE_SPEED", self.speed, above=0.)
-        direction = gcmd.get("DIRECTION").lower()
+        if direction is None:
+            direction = gcmd.get("DIRECTION")
+        direction = direction.lower()
         if direction not in direction_types:
             raise self.printer.command_error("Wrong value for DIRECTION.")
 
@@ -155,6 +171,16 @@ class PrinterProbeXY:
         samples_retries = gcmd.get_int("SAMPLES_TOLERANCE_RETRIES",
                                        self.samples_retries, minval=0)
         samples_result = gcmd.get("SAMPLES_RESULT", self.samples_result)
+        if gcmd.get_int("SAMPLES_ADAPTIVE", self.samples_adaptive,
+                        minval=0, maxval=1):
+            if gcmd.get("SAMPLES", None) is None:
+                sample_count = max(sample_count, ADAPTIVE_MIN_MAX_SAMPLES)
+            positions = self._run_adaptive_samples(
+                gcmd, speed, axis, sense, lift_speed, sample_count,
+                sample_retract_dist, samples_tolerance, samples_retries)
+            if samples_result == 'median':
+                return self._calc_median(positions, axis)
+            return self._calc_mean(positions)
         probe_start = self.printer.lookup_object('toolhead').get_position()
         retries = 0
         positions = []
@@ -180,6 +206,60 @@ class PrinterProbeXY:
         if samples_result == 'median':
             return self._calc_median(positions, axis)
         return self._calc_mean(positions)
+    def _run_adaptive_samples(self, gcmd, speed, axis, sense, lift_speed,
+                              max_samples, retract_dist, tolerance,
+                              max_outliers):
+        # Probe until the 95% confidence interval of the mean is within the
+        # tolerance (an error is raised if it isn't after max_samples
+        # touches). Samples farther than the tolerance from the median are
+        # discarded as outliers (instead of restarting all samples).
+        toolhead = self.printer.lookup_object('toolhead')
+        positions = []
+        outliers = 0
+        while 1:
+            pos = self._probe(speed, axis, sense)
+            positions.append(pos)
+            if len(positions) >= 3:
+                median = self._calc_median(positions, axis)[axis]
+                worst = max(positions, key=(lambda p: abs(p[axis] - median)))
+                if abs(worst[axis] - median) > tolerance:
+                    positions.remove(worst)
+                    outliers += 1
+                    gcmd.respond_info("Discarded outlier sample at %.6f"
+                                      % (worst[axis],))
+                    if outliers > max_outliers:
+                        raise gcmd.error("Probe samples exceed "
+                                         "samples_tolerance")
+            count = len(positions)
+            if count >= 2:
+                values = [p[axis] for p in positions]
+                mean = sum(values) / count
+                sigma = (sum([(v - mean)**2 for v in values])
+                         / (count - 1)) ** .5
+                quantile = T_QUANTILE_LIMIT
+                if count - 1 <= len(T_QUANTILES):
+                    quantile = T_QUANTILES[count - 2]
+                interval = quantile * sigma / count**.5
+                if 2. * interval <= tolerance:
+                    gcmd.respond_info(
+                        "Probe used %d samples (%d outliers discarded),"
+                        " confidence interval +/-%.6f"
+                        % (count + outliers, outliers, interval))
+                    return positions
+                if count + outliers >= max_samples:
+                    gcmd.respond_info(
+                        "Probe used the maximum of %d samples (%d outliers"
+                        " discarded), confidence interval +/-%.6f"
+                        % (count + outliers, outliers, interval))
+            if count + outliers >= max_samples:
+                raise gcmd.error("Probe samples exceed samples_tolerance")
+            # Retract, then quickly return close to the previous trigger point
+            liftpos = toolhead.get_position()
+            liftpos[axis] = pos[axis] - sense*retract_dist
+            self._move(liftpos, lift_speed)
+            margin = min(self.samples_approach_margin, retract_dist)
+            liftpos[axis] = pos[axis] - sense*margin
+            self._move(liftpos, lift_speed)
     cmd_PROBE_help = "Probe Z-height at current XY position"
 
     def cmd_PROBE(self, gcmd):
@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math, os, time
-from . import shaper_calibrate
+from . import adxl345, shaper_calibrate
 
 class TestAxis:
     def __init__(self, axis=None, vib_dir=None):
@@ -229,7 +229,7 @@ class ResonanceTester:
                 for chip_axis, chip_name in self.accel_chip_names]
 
     def _run_test(self, gcmd, axes, helper, raw_name_suffix=None,
-                  accel_chips=None, test_point=None):
+                  accel_chips=None, test_point=None, raw_format='csv'):
         toolhead = self.printer.lookup_object('toolhead')
         calibration_data = {axis: None for axis in axes}
 
@@ -258,6 +258,15 @@ class ResonanceTester:
                     for chip in accel_chips:
                         aclient = chip.start_internal_client()
                         raw_values.append((axis, aclient, chip.name))
+                # Calculate frequency responses while the test is running
+                psd_accumulators = {}
+                if helper is not None:
+                    for chip_axis, aclient, chip_name in raw_values:
+                        psd = shaper_calibrate.PSDAccumulator(helper)
+                        aclient.add_stream_handler(
+                                psd.add_samples,
+                                keep_samples=raw_name_suffix is not None)
+                        psd_accumulators[aclient] = psd
 
                 # Generate moves
                 test_seq = self.generator.gen_test()
@@ -268,8 +277,10 @@ class ResonanceTester:
                         raw_name = self.get_filename(
                                 'raw_data', raw_name_suffix, axis,
                                 point if len(test_points) > 1 else None,
-                                chip_name if accel_chips is not None else None,)
-                        aclient.write_to_file(raw_name)
+                                chip_name if accel_chips is not None else None,
+                                ext=adxl345.RAW_DATA_EXTENSIONS[raw_format])
+                        aclient.write_to_file(
+                                raw_name, binary=(raw_format == 'binary'))
                         gcmd.respond_info(
                                 "Writing raw accelerometer data to "
                                 "%s file" % (raw_name,))
@@ -280,7 +291,8 @@ class ResonanceTester:
                         raise gcmd.error(
                             "accelerometer '%s' measured no data" % (
                                 chip_name,))
-                    new_data = helper.process_accelerometer_data(aclient)
+                    new_data = helper.process_accelerometer_data(
+                            psd_accumulators[aclient])
                     if calibration_data[axis] is None:
                         calibration_data[axis] = new_data
                     else:
@@ -326,6 +338,10 @@ class ResonanceTester:
             raise gcmd.error("Invalid NAME parameter")
         csv_output = 'resonances' in outputs
         raw_output = 'raw_data' in outputs
+        raw_format = gcmd.get("RAW_FORMAT", "csv").lower()
+        if raw_format not in adxl345.RAW_DATA_EXTENSIONS:
+            raise gcmd.error("Unsupported RAW_FORMAT '%s', only 'csv' and"
+                             " 'binary' are supported" % (raw_format,))
 
         # Setup calculation of resonances
         if csv_output:
@@ -336,7 +352,8 @@ class ResonanceTester:
         data = self._run_test(
                 gcmd, [axis], helper,
                 raw_name_suffix=name_suffix if raw_output else None,
-                accel_chips=accel_chips, test_point=test_point)[axis]
+                accel_chips=accel_chips, test_point=test_point,
+                raw_format=raw_format)[axis]
         if csv_output:
             csv_name = self.save_calibration_data(
                     'resonances', name_suffix, helper, axis, data,
@@ -408,18 +425,22 @@ class ResonanceTester:
         "Measures noise of all enabled accelerometer chips")
     def cmd_MEASURE_AXES_NOISE(self, gcmd):
         meas_time = gcmd.get_float("MEAS_TIME", 2.)
-        raw_values = [(chip_axis, chip.start_internal_client())
-                      for chip_axis, chip in self.accel_chips]
+        helper = shaper_calibrate.ShaperCalibrate(self.printer)
+        raw_values = []
+        for chip_axis, chip in self.accel_chips:
+            aclient = chip.start_internal_client()
+            psd = shaper_calibrate.PSDAccumulator(helper)
+            aclient.add_stream_handler(psd.add_samples, keep_samples=False)
+            raw_values.append((chip_axis, aclient, psd))
         self.printer.lookup_object('toolhead').dwell(meas_time)
-        for chip_axis, aclient in raw_values:
+        for chip_axis, aclient, psd in raw_values:
             aclient.finish_measurements()
-        helper = shaper_calibrate.ShaperCalibrate(self.printer)
-        for chip_axis, aclient in raw_values:
+        for chip_axis, aclient, psd in raw_values:
             if not aclient.has_valid_samples():
                 raise gcmd.error(
                         "%s-axis accelerometer measured no data" % (
                             chip_axis,))
-            data = helper.process_accelerometer_data(aclient)
+            data = helper.process_accelerometer_data(psd)
             vx = data.psd_x.mean()
             vy = data.psd_y.mean()
             vz = data.psd_z.mean()
@@ -431,7 +452,7 @@ class ResonanceTester:
         return name_suffix.replace('-', '').replace('_', '').isalnum()
 
     def get_filename(self, base, name_suffix, axis=None,
-                     point=None, chip_name=None):
+                     point=None, chip_name=None, ext='csv'):
         name = base
         if axis:
             name += '_' + axis.get_name()
@@ -440,7 +461,7 @@ class ResonanceTester:
         if point:
             name += "_%.3f_%.3f_%.3f" % (point[0], point[1], point[2])
         name += '_' + name_suffix
-        return os.path.join("/tmp", name + ".csv")
+        return os.path.join("/tmp", name + "." + ext)
 
     def save_calibration_data(self, base_name, name_suffix, shaper_calibrate,
                               axis, calibration_data,
@@ -4,17 +4,36 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import collections, importlib, logging, math, multiprocessing, traceback
+import multiprocessing.connection
 shaper_defs = importlib.import_module('.shaper_defs', 'extras')
 
 MIN_FREQ = 5.
 MAX_FREQ = 200.
 WINDOW_T_SEC = 0.5
 MAX_SHAPER_FREQ = 150.
+# Time span of streamed samples used to estimate the sampling rate
+RATE_ESTIMATE_T_SEC = 1.
 
 TEST_DAMPING_RATIOS=[0.075, 0.1, 0.15]
 
+# Limit on the number of elements of the arrays used while fitting shapers
+FIT_CHUNK_SIZE = 1 << 20
+
 AUTOTUNE_SHAPERS = ['zv', 'mzv', 'ei', '2hump_ei', '3hump_ei']
 
+# Binary raw accelerometer data files start with this header, followed by
+# little-endian float64 (time, accel_x, accel_y, accel_z) records
+RAW_DATA_MAGIC = b'KLPACC\x00\x01'
+
+def is_binary_raw_data(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(RAW_DATA_MAGIC)) == RAW_DATA_MAGIC
+
+def load_binary_raw_data(numpy, filename):
+    # Memory map the samples instead of reading them into memory
+    return numpy.memmap(filename, dtype='<f8', mode='r',
+                        offset=len(RAW_DATA_MAGIC)).reshape(-1, 4)
+
 ######################################################################
 # Frequency response calculation and shaper auto-tuning
 ######################################################################
@@ -55,6 +74,79 @@ class CalibrationData:
         return self._psd_map[axis]
 
 
+# Welch's PSD calculated incrementally from streamed accelerometer samples,
+# so that only the samples of a single window need to be kept in memory
+class PSDAccumulator:
+    def __init__(self, helper):
+        self.helper = helper
+        self.numpy = helper.numpy
+        self.nfft = 0
+        self.window = None
+        self.pending = []
+        self.pending_count = 0
+        self.psd_sums = None
+        self.num_windows = 0
+        self.num_samples = 0
+        self.first_time = self.last_time = None
+    def _setup_window(self):
+        # Round up to the nearest power of 2 for faster FFT
+        sampling_freq = self.num_samples / (self.last_time - self.first_time)
+        self.nfft = 1 << int(sampling_freq * WINDOW_T_SEC - 1).bit_length()
+        self.window = self.numpy.kaiser(self.nfft, 6.)
+        self.psd_sums = [0., 0., 0.]
+    def _process_windows(self):
+        np = self.numpy
+        nfft = self.nfft
+        overlap = nfft // 2
+        if self.pending_count < nfft:
+            return
+        data = np.concatenate(self.pending)
+        step_between_windows = nfft - overlap
+        n_windows = (data.shape[0] - overlap) // step_between_windows
+        for i in range(3):
+            x = self.helper._split_into_windows(data[:,i+1], nfft, overlap)
+            self.psd_sums[i] = self.psd_sums[i] + self.helper._calc_windows_psd(
+                    x, self.window)
+        self.num_windows += n_windows
+        # Keep the samples not yet covered by a complete window
+        remaining = np.array(data[n_windows * step_between_windows:])
+        self.pending = [remaining]
+        self.pending_count = remaining.shape[0]
+    def add_samples(self, samples):
+        np = self.numpy
+        data = np.asarray(samples, dtype=np.float64).reshape(-1, 4)
+        if not data.shape[0]:
+            return
+        if self.first_time is None:
+            self.first_time = data[0,0]
+        self.last_time = data[-1,0]
+        self.num_samples += data.shape[0]
+        self.pending.append(data)
+        self.pending_count += data.shape[0]
+        if not self.nfft:
+            if self.last_time - self.first_time < RATE_ESTIMATE_T_SEC:
+                return
+            self._setup_window()
+        self._process_windows()
+    def get_calibration_data(self):
+        np = self.numpy
+        if not self.num_samples or self.last_time <= self.first_time:
+            return None
+        if not self.nfft:
+            self._setup_window()
+        if self.num_samples <= self.nfft:
+            return None
+        self._process_windows()
+        if not self.num_windows:
+            return None
+        # Normalize the PSD by the sampling rate of all streamed samples
+        sampling_freq = self.num_samples / (self.last_time - self.first_time)
+        scale = 1.0 / (self.window**2).sum()
+        px, py, pz = [psd * (scale / sampling_freq / self.num_windows)
+                      for psd in self.psd_sums]
+        freqs = np.fft.rfftfreq(self.nfft, 1. / sampling_freq)
+        return CalibrationData(freqs, px+py+pz, px, py, pz)
+
 CalibrationResult = collections.namedtuple(
         'CalibrationResult',
         ('name', 'freq', 'vals', 'vibrs', 'smoothing', 'score', 'max_accel'))
@@ -71,13 +163,12 @@ class ShaperCalibrate:
                     "installed via `~/klippy-env/bin/pip install` (refer to "
                     "docs/Measuring_Resonances.md for more details).")
 
-    def background_process_exec(self, method, args):
-        if self.printer is None:
-            return method(*args)
-        import queuelogger
+    def _start_background_process(self, method, args):
         parent_conn, child_conn = multiprocessing.Pipe()
         def wrapper():
-            queuelogger.clear_bg_logging()
+            if self.printer is not None:
+                import queuelogger
+                queuelogger.clear_bg_logging()
             try:
                 res = method(*args)
             except:
@@ -90,22 +181,58 @@ class ShaperCalibrate:
         calc_proc = multiprocessing.Process(target=wrapper)
         calc_proc.daemon = True
         calc_proc.start()
-        # Wait for the process to finish
-        reactor = self.printer.get_reactor()
-        gcode = self.printer.lookup_object("gcode")
-        eventtime = last_report_time = reactor.monotonic()
-        while calc_proc.is_alive():
+        return calc_proc, parent_conn
+
+    def _finish_background_process(self, calc_proc, parent_conn):
+        try:
+            is_err, res = parent_conn.recv()
+        except EOFError:
+            is_err, res = True, "calculation process exited unexpectedly"
+        calc_proc.join()
+        parent_conn.close()
+        if is_err:
+            raise self.error("Error in remote calculation: %s" % (res,))
+        return res
+
+    def background_process_map(self, method, args_list):
+        # Run the calculations in parallel processes (at most one per CPU)
+        # and return the results in the order of args_list
+        if self.printer is None and len(args_list) <= 1:
+            return [method(*args) for args in args_list]
+        max_procs = max(1, multiprocessing.cpu_count())
+        results = [None] * len(args_list)
+        pending = list(enumerate(args_list))
+        running = []
+        if self.printer is not None:
+            reactor = self.printer.get_reactor()
+            gcode = self.printer.lookup_object("gcode")
+            eventtime = last_report_time = reactor.monotonic()
+        while pending or running:
+            while pending and len(running) < max_procs:
+                idx, args = pending.pop(0)
+                calc_proc, conn = self._start_background_process(method, args)
+                running.append((idx, calc_proc, conn))
+            # Collect results of the finished processes
+            finished = [r for r in running
+                        if r[2].poll() or not r[1].is_alive()]
+            for idx, calc_proc, conn in finished:
+                running.remove((idx, calc_proc, conn))
+                results[idx] = self._finish_background_process(calc_proc,
+                                                               conn)
+            if finished or not running:
+                continue
+            # Wait for the calculations
+            if self.printer is None:
+                multiprocessing.connection.wait([r[2] for r in running])
+                continue
             if eventtime > last_report_time + 5.:
                 last_report_time = eventtime
                 gcode.respond_info("Wait for calculations..", log=False)
             eventtime = reactor.pause(eventtime + .1)
-        # Return results
-        is_err, res = parent_conn.recv()
-        if is_err:
-            raise self.error("Error in remote calculation: %s" % (res,))
-        calc_proc.join()
-        parent_conn.close()
-        return res
+        return results
+
+    def background_process_exec(self, method, args):
+        return self.background_process_map(method, [args])[0]
 
     def _split_into_windows(self, x, window_size, overlap):
         # Memory-efficient algorithm to split an input 'x' into a series
@@ -117,16 +244,11 @@ class ShaperCalibrate:
         return self.numpy.lib.stride_tricks.as_strided(
                 x, shape=shape, strides=strides, writeable=False)
 
-    def _psd(self, x, fs, nfft):
-        # Calculate power spectral density (PSD) using Welch's algorithm
+    def _calc_windows_psd(self, x, window):
+        # Calculate the sum of the frequency responses of the windows
+        # (stored in columns of 'x') as a part of Welch's algorithm
         np = self.numpy
-        window = np.kaiser(nfft, 6.)
-        # Compensation for windowing loss
-        scale = 1.0 / (window**2).sum()
-
-        # Split into overlapping windows of size nfft
-        overlap = nfft // 2
-        x = self._split_into_windows(x, nfft, overlap)
+        nfft = window.shape[0]
 
         # First detrend, then apply windowing function
         x = window[:, None] * (x - np.mean(x, axis=0))
@@ -134,14 +256,25 @@ class ShaperCalibrate:
         # Calculate frequency response for each window using FFT
         result = np.fft.rfft(x, n=nfft, axis=0)
         result = np.conjugate(result) * result
-        result *= scale / fs
         # For one-sided FFT output the response must be doubled, except
         # the last point for unpaired Nyquist frequency (assuming even nfft)
         # and the 'DC' term (0 Hz)
         result[1:-1,:] *= 2.
+        return result.real.sum(axis=-1)
+
+    def _psd(self, x, fs, nfft):
+        # Calculate power spectral density (PSD) using Welch's algorithm
+        np = self.numpy
+        window = np.kaiser(nfft, 6.)
+        # Compensation for windowing loss
+        scale = 1.0 / (window**2).sum()
+
+        # Split into overlapping windows of size nfft
+        overlap = nfft // 2
+        x = self._split_into_windows(x, nfft, overlap)
 
         # Welch's algorithm: average response over windows
-        psd = result.real.mean(axis=-1)
+        psd = self._calc_windows_psd(x, window) * (scale / fs / x.shape[-1])
 
         # Calculate the frequency bins
         freqs = np.fft.rfftfreq(nfft, 1. / fs)
@@ -175,8 +308,12 @@ class ShaperCalibrate:
         return CalibrationData(fx, px+py+pz, px, py, pz)
 
     def process_accelerometer_data(self, data):
-        calibration_data = self.background_process_exec(
-                self.calc_freq_response, (data,))
+        if isinstance(data, PSDAccumulator):
+            # The frequency response was already computed while streaming
+            calibration_data = data.get_calibration_data()
+        else:
+            calibration_data = self.background_process_exec(
+                    self.calc_freq_response, (data,))
         if calibration_data is None:
             raise self.error(
                     "Internal error processing accelerometer data %s" % (data,))
@@ -184,18 +321,24 @@ class ShaperCalibrate:
         return calibration_data
 
     def _estimate_shaper(self, shaper, test_damping_ratio, test_freqs):
+        # The shaper (A, T) may also be a stack of shapers with A and T of
+        # shape (num_shapers, n), estimated at once via broadcasting
         np = self.numpy
 
-        A, T = np.array(shaper[0]), np.array(shaper[1])
-        inv_D = 1. / A.sum()
+        A, T = np.asarray(shaper[0]), np.asarray(shaper[1])
+        inv_D = 1. / A.sum(axis=-1)
 
         omega = 2. * math.pi * test_freqs
         damping = test_damping_ratio * omega
         omega_d = omega * math.sqrt(1. - test_damping_ratio**2)
-        W = A * np.exp(np.outer(-damping, (T[-1] - T)))
-        S = W * np.sin(np.outer(omega_d, T))
-        C = W * np.cos(np.outer(omega_d, T))
-        return np.sqrt(S.sum(axis=1)**2 + C.sum(axis=1)**2) * inv_D
+        A = A[..., None, :]
+        T_end = (T[..., -1:] - T)[..., None, :]
+        T = T[..., None, :]
+        W = A * np.exp(-damping[:, None] * T_end)
+        S = W * np.sin(omega_d[:, None] * T)
+        C = W * np.cos(omega_d[:, None] * T)
+        return (np.sqrt(S.sum(axis=-1)**2 + C.sum(axis=-1)**2)
+                * np.asarray(inv_D)[..., None])
 
     def _estimate_remaining_vibrations(self, shaper, test_damping_ratio,
                                        freq_bins, psd):
@@ -205,7 +348,7 @@ class ShaperCalibrate:
         # threshold can be igonred
         vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
         remaining_vibrations = self.numpy.maximum(
-                vals * psd - vibr_threshold, 0).sum()
+                vals * psd - vibr_threshold, 0).sum(axis=-1)
         all_vibrations = self.numpy.maximum(psd - vibr_threshold, 0).sum()
         return (remaining_vibrations / all_vibrations, vals)
 
@@ -254,44 +397,64 @@ class ShaperCalibrate:
         psd = calibration_data.psd_sum[freq_bins <= max_freq]
         freq_bins = freq_bins[freq_bins <= max_freq]
 
-        best_res = None
-        results = []
-        for test_freq in test_freqs[::-1]:
-            shaper_vibrations = 0.
-            shaper_vals = np.zeros(shape=freq_bins.shape)
-            shaper = shaper_cfg.init_func(test_freq, damping_ratio)
-            shaper_smoothing = self._get_shaper_smoothing(shaper, scv=scv)
-            if max_smoothing and shaper_smoothing > max_smoothing and best_res:
-                return best_res
-            # Exact damping ratio of the printer is unknown, pessimizing
-            # remaining vibrations over possible damping values
+        test_freqs = test_freqs[::-1]
+        shapers = [shaper_cfg.init_func(test_freq, damping_ratio)
+                   for test_freq in test_freqs]
+        smoothings = [self._get_shaper_smoothing(shaper, scv=scv)
+                      for shaper in shapers]
+        num_freqs = len(shapers)
+        if max_smoothing:
+            # Frequencies are tested in decreasing order, stop at the first
+            # one (after the first) that results in too much smoothing
+            for i in range(1, num_freqs):
+                if smoothings[i] > max_smoothing:
+                    num_freqs = i
+                    break
+
+        # Exact damping ratio of the printer is unknown, pessimizing
+        # remaining vibrations over possible damping values
+        shaper_vals = np.zeros(shape=(num_freqs, freq_bins.shape[0]))
+        shaper_vibrations = np.zeros(shape=(num_freqs,))
+        chunk = max(1, FIT_CHUNK_SIZE // (freq_bins.shape[0]
+                                          * len(shapers[0][0])))
+        for start in range(0, num_freqs, chunk):
+            end = min(start + chunk, num_freqs)
+            A = np.array([shaper[0] for shaper in shapers[start:end]])
+            T = np.array([shaper[1] for shaper in shapers[start:end]])
             for dr in test_damping_ratios:
                 vibrations, vals = self._estimate_remaining_vibrations(
-                        shaper, dr, freq_bins, psd)
-                shaper_vals = np.maximum(shaper_vals, vals)
-                if vibrations > shaper_vibrations:
-                    shaper_vibrations = vibrations
-            max_accel = self.find_shaper_max_accel(shaper, scv)
+                        (A, T), dr, freq_bins, psd)
+                shaper_vals[start:end] = np.maximum(shaper_vals[start:end],
+                                                    vals)
+                shaper_vibrations[start:end] = np.maximum(
+                        shaper_vibrations[start:end], vibrations)
+
+        best_idx = None
+        scores = []
+        for i in range(num_freqs):
             # The score trying to minimize vibrations, but also accounting
             # the growth of smoothing. The formula itself does not have any
             # special meaning, it simply shows good results on real user data
-            shaper_score = shaper_smoothing * (shaper_vibrations**1.5 +
-                                               shaper_vibrations * .2 + .01)
-            results.append(
-                    CalibrationResult(
-                        name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
-                        vibrs=shaper_vibrations, smoothing=shaper_smoothing,
-                        score=shaper_score, max_accel=max_accel))
-            if best_res is None or best_res.vibrs > results[-1].vibrs:
+            vibrs = shaper_vibrations[i]
+            scores.append(smoothings[i] * (vibrs**1.5 + vibrs * .2 + .01))
+            if best_idx is None or shaper_vibrations[best_idx] > vibrs:
                 # The current frequency is better for the shaper.
-                best_res = results[-1]
-        # Try to find an 'optimal' shapper configuration: the one that is not
-        # much worse than the 'best' one, but gives much less smoothing
-        selected = best_res
-        for res in results[::-1]:
-            if res.vibrs < best_res.vibrs * 1.1 and res.score < selected.score:
-                selected = res
-        return selected
+                best_idx = i
+        selected = best_idx
+        if num_freqs == len(shapers):
+            # Try to find an 'optimal' shapper configuration: the one that is
+            # not much worse than the 'best' one, but gives much less smoothing
+            best_vibrs = shaper_vibrations[best_idx]
+            for i in range(num_freqs-1, -1, -1):
+                if (shaper_vibrations[i] < best_vibrs * 1.1
+                        and scores[i] < scores[selected]):
+                    selected = i
+        return CalibrationResult(
+                name=shaper_cfg.name, freq=test_freqs[selected],
+                vals=shaper_vals[selected].copy(),
+                vibrs=shaper_vibrations[selected],
+                smoothing=smoothings[selected], score=scores[selected],
+                max_accel=self.find_shaper_max_accel(shapers[selected], scv))
 
     def _bisect(self, func):
         left = right = 1.
@@ -326,12 +489,13 @@ class ShaperCalibrate:
         best_shaper = None
         all_shapers = []
         shapers = shapers or AUTOTUNE_SHAPERS
-        for shaper_cfg in shaper_defs.INPUT_SHAPERS:
-            if shaper_cfg.name not in shapers:
-                continue
-            shaper = self.background_process_exec(self.fit_shaper, (
-                shaper_cfg, calibration_data, shaper_freqs, damping_ratio,
-                scv, max_smoothing, test_damping_ratios, max_freq))
+        # Fit all shaper types in parallel
+        fitted_shapers = self.background_process_map(self.fit_shaper, [
+            (shaper_cfg, calibration_data, shaper_freqs, damping_ratio,
+             scv, max_smoothing, test_damping_ratios, max_freq)
+            for shaper_cfg in shaper_defs.INPUT_SHAPERS
+            if shaper_cfg.name in shapers])
+        for shaper in fitted_shapers:
             if logger is not None:
                 logger("Fitted shaper '%s' frequency = %.1f Hz "
                        "(vibrations = %.1f%%, smoothing ~= %.3f)" % (
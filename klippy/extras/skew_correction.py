@@ -28,7 +28,7 @@ class PrinterSkew:
         self._load_storage(config)
         self.printer.register_event_handler("klippy:connect",
                                             self._handle_connect)
-        self.next_transform = None
+        self.gcode_move = None
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command('GET_CURRENT_SKEW', self.cmd_GET_CURRENT_SKEW,
                                desc=self.cmd_GET_CURRENT_SKEW_help)
@@ -40,8 +40,8 @@ class PrinterSkew:
         gcode.register_command('SKEW_PROFILE', self.cmd_SKEW_PROFILE,
                                desc=self.cmd_SKEW_PROFILE_help)
     def _handle_connect(self):
-        gcode_move = self.printer.lookup_object('gcode_move')
-        self.next_transform = gcode_move.set_move_transform(self, force=True)
+        self.gcode_move = self.printer.lookup_object('gcode_move')
+        self.gcode_move.set_move_transform(self, force=True)
     def _load_storage(self, config):
         stored_profs = config.get_prefix_sections(self.name)
         # Remove primary skew_correction section, as it is not a stored profile
@@ -54,27 +54,18 @@ class PrinterSkew:
                 'xz_skew': profile.getfloat("xz_skew"),
                 'yz_skew': profile.getfloat("yz_skew"),
             }
-    def calc_skew(self, pos):
-        skewed_x = pos[0] - pos[1] * self.xy_factor \
-            - pos[2] * (self.xz_factor - (self.xy_factor * self.yz_factor))
-        skewed_y = pos[1] - pos[2] * self.yz_factor
-        return [skewed_x, skewed_y, pos[2], pos[3]]
-    def calc_unskew(self, pos):
-        skewed_x = pos[0] + pos[1] * self.xy_factor \
-            + pos[2] * self.xz_factor
-        skewed_y = pos[1] + pos[2] * self.yz_factor
-        return [skewed_x, skewed_y, pos[2], pos[3]]
-    def get_position(self):
-        return self.calc_unskew(self.next_transform.get_position())
-    def move(self, newpos, speed):
-        corrected_pos = self.calc_skew(newpos)
-        self.next_transform.move(corrected_pos, speed)
+    def get_affine_transform(self):
+        # Skew is applied by gcode_move as part of the fused move pipeline
+        xy, xz, yz = self.xy_factor, self.xz_factor, self.yz_factor
+        return ((1., -xy, -(xz - xy * yz), 0.),
+                (0., 1., -yz, 0.),
+                (0., 0., 1., 0.))
     def _update_skew(self, xy_factor, xz_factor, yz_factor):
         self.xy_factor = xy_factor
         self.xz_factor = xz_factor
         self.yz_factor = yz_factor
-        gcode_move = self.printer.lookup_object('gcode_move')
-        gcode_move.reset_last_position()
+        self.gcode_move.update_move_transform()
+        self.gcode_move.reset_last_position()
     cmd_GET_CURRENT_SKEW_help = "Report current printer skew"
     def cmd_GET_CURRENT_SKEW(self, gcmd):
         out = "Current Printer Skew:"
@@ -113,6 +104,7 @@ class PrinterSkew:
                         "plane [%s]\n%s" % (plane, gcmd.get_commandline()))
                 factor = plane.lower() + '_factor'
                 setattr(self, factor, calc_skew_factor(*lengths))
+        self.gcode_move.update_move_transform()
     cmd_SKEW_PROFILE_help = "Profile management for skew_correction"
     def cmd_SKEW_PROFILE(self, gcmd):
         if gcmd.get('LOAD', None) is not None:
@@ -66,7 +66,7 @@ class PrinterStats:
         stats = [cb(eventtime) for cb in self.stats_cb]
         if max([s[0] for s in stats]):
             logging.info("Stats %.1f: %s", eventtime,
-                         ' '.join([s[1] for s in stats]))
+                         ' '.join([s[1] for s in stats if s[1]]))
         return eventtime + 1.
 
 def load_config(config):
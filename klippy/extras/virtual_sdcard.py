@@ -30,6 +30,7 @@ class VirtualSD:
         self.must_pause_work = self.cmd_from_sd = False
         self.next_file_position = 0
         self.work_timer = None
+        self.checkpoint_handler = None
         # Error handling
         gcode_macro = self.printer.load_object(config, 'gcode_macro')
         self.on_error_gcode = gcode_macro.load_template(
@@ -196,6 +197,7 @@ class VirtualSD:
         self.file_position = 0
         self.file_size = fsize
         self.print_stats.set_current_file(filename)
+        self.printer.send_event("virtual_sdcard:load_file", fname)
     def cmd_M24(self, gcmd):
         # Start/resume SD print
         self.do_resume()
@@ -221,6 +223,8 @@ class VirtualSD:
         self.next_file_position = pos
     def is_cmd_from_sd(self):
         return self.cmd_from_sd
+    def set_checkpoint_handler(self, handler):
+        self.checkpoint_handler = handler
     # Background work timer
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
@@ -283,6 +287,8 @@ class VirtualSD:
                 break
             self.cmd_from_sd = False
             self.file_position = self.next_file_position
+            if self.checkpoint_handler is not None:
+                self.checkpoint_handler(self.file_position)
             # Do we need to skip around?
             if self.next_file_position != next_file_position:
                 try:
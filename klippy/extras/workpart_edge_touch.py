@@ -8,7 +8,6 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
 import logging, time, math
-from mathutil import linear_regression
 
 
 DIRECTION_CHOICE_LIST={
@@ -23,6 +22,47 @@ DIRECTION_CHOICE_LIST={
 }
 
 
+# Joint least-squares fit of the workpart edges. The touch points scanned
+# in X direction lie on the workpart Y axis edge, the points scanned in Y
+# direction on the X axis edge. After rotating the latter by 90 degrees,
+# both groups lie on parallel lines, so the common direction is the main
+# axis of the combined scatter matrix of both (separately centered) groups.
+# Returns the rotation angle, the offset of the workpart origin and the
+# residuals (signed distance of each point from its fitted edge).
+def fit_workpart(x_scans, y_scans, tool_radius):
+    if not x_scans or not y_scans or len(x_scans) + len(y_scans) < 3 :
+      raise ValueError("Too few touch points, cannot determine rotation "
+        "angle! At least one touch point per axis and three touch points "
+        "in total are required.")
+    groups = [ [(s['pos'][0], s['pos'][1]) for s in x_scans],
+               [(-s['pos'][1], s['pos'][0]) for s in y_scans] ]
+    sxx = syy = sxy = 0.
+    for points in groups :
+      mx = sum([p[0] for p in points]) / len(points)
+      my = sum([p[1] for p in points]) / len(points)
+      for px, py in points :
+        sxx += (px - mx)**2
+        syy += (py - my)**2
+        sxy += (px - mx)*(py - my)
+    # Direction of workpart Y axis (angle of main axis), converted into the
+    # rotation of the workpart X axis in the range -45..45 degrees
+    angle = 0.5*math.atan2(2.*sxy, sxx - syy) - math.pi/2
+    angle = (angle + math.pi/4) % (math.pi/2) - math.pi/4
+    ax = (math.cos(angle), math.sin(angle))
+    ay = (-math.sin(angle), math.cos(angle))
+    # Position of the edges along the normal of each edge, corrected for the
+    # tool radius (the tool stops before the edge in direction of the scan)
+    def edge_pos(scans, normal):
+      dists = [s['pos'][0]*normal[0] + s['pos'][1]*normal[1] for s in scans]
+      mean = sum(dists) / len(dists)
+      edge = mean + scans[0]['direction']*tool_radius
+      return edge, [d - mean for d in dists]
+    cx, res_x = edge_pos(x_scans, ax)
+    cy, res_y = edge_pos(y_scans, ay)
+    offset = [cx*ax[0] + cy*ay[0], cx*ax[1] + cy*ay[1]]
+    return angle, offset, {'x': res_x, 'y': res_y}
+
+
 class WorkpartEdgeTouch:
     def __init__(self, config):
         self.name = config.get_name()
@@ -30,6 +70,10 @@ class WorkpartEdgeTouch:
 
         self.speed = config.getfloat('speed', 5., above=0.)
         self.tool_radius = config.getfloat('tool_radius', above=0.)
+        self.approach_distance = config.getfloat('approach_distance', 3.,
+            above=0.)
+        self.travel_lift = config.getfloat('travel_lift', 5., minval=0.)
+        self.travel_speed = config.getfloat('travel_speed', 50., above=0.)
 
         self.gcode = self.printer.lookup_object('gcode')
 
@@ -45,6 +89,10 @@ class WorkpartEdgeTouch:
             self.cmd_COMPUTE_WORKPART,
             desc=self.cmd_COMPUTE_WORKPART_help)
 
+        self.gcode.register_command('WORKPART_TOUCH',
+            self.cmd_WORKPART_TOUCH,
+            desc=self.cmd_WORKPART_TOUCH_help)
+
         self.gcode.register_command('CLEAR_WORKPART_TRANSFORM',
             self.cmd_CLEAR_WORKPART_TRANSFORM,
             desc=self.cmd_CLEAR_WORKPART_TRANSFORM_help)
@@ -53,12 +101,14 @@ class WorkpartEdgeTouch:
         self.scans['x'] = eval(config.get('x_scans', "[]"))
         self.scans['y'] = eval(config.get('y_scans', "[]"))
 
-        self.rot_mat = [ [1,0], [0,1] ]
-        self.offset = [0,0]
-
-        # Register transform
-        gcode_move = self.printer.load_object(config, 'gcode_move')
-        self.normal_transform = gcode_move.set_move_transform(self, force=True)
+        # Register transform (as affine transform, so it is merged with other
+        # affine transforms in the move chain)
+        self.gcode_move = self.printer.load_object(config, 'gcode_move')
+        self._set_transform(0., [0., 0.])
+        transform = config.getfloatlist('transform', None, count=3)
+        if transform is not None :
+          self._set_transform(transform[0]*math.pi/180, transform[1:])
+        self.gcode_move.set_move_transform(self, force=True)
 
 
     cmd_EDGE_TOUCH_help = "Add current position (e.g. after running a probe) " \
@@ -70,6 +120,10 @@ class WorkpartEdgeTouch:
             + "the previously recorded edge touch positions."
 
 
+    cmd_WORKPART_TOUCH_help = "Touch all recorded edge touch points again, " \
+            + "record the new positions and compute the coordinate transform."
+
+
     cmd_CLEAR_WORKPART_help = "Clear all recorded edge touch positions and "   \
             + "reset the coordinate transform."
 
@@ -105,137 +159,158 @@ class WorkpartEdgeTouch:
         configfile = self.printer.lookup_object('configfile')
         self.scans['x'] = []
         self.scans['y'] = []
-        self.rot_mat = [ [1,0], [0,1] ]
-        self.offset = [0,0]
+        self._set_transform(0., [0., 0.])
         configfile.set(self.name, 'x_scans', self.scans['x'])
         configfile.set(self.name, 'y_scans', self.scans['y'])
+        configfile.set(self.name, 'transform', "0, 0, 0")
         gcmd.respond_info("The SAVE_CONFIG command will update the printer\n"
                   "config file and restart the printer.")
 
 
     def cmd_CLEAR_WORKPART_TRANSFORM(self, gcmd):
-        self.rot_mat = [ [1,0], [0,1] ]
-        self.offset = [0,0]
-
+        configfile = self.printer.lookup_object('configfile')
+        self._set_transform(0., [0., 0.])
+        configfile.set(self.name, 'transform', "0, 0, 0")
 
-    def cmd_COMPUTE_WORKPART(self, gcmd):
 
+    def _check_directions(self, gcmd):
         # consistency check: each axis must have all touch points in the same
         # direction
-        x_direction = self.scans['x'][0]['direction']
-        y_direction = self.scans['y'][0]['direction']
-        for scan in self.scans['x'] :
-          if scan['direction'] != x_direction :
-            raise gcmd.error("All touch points for the x axis must have the " +
-              "same direction!")
-        for scan in self.scans['y'] :
-          if scan['direction'] != y_direction :
-            raise gcmd.error("All touch points for the y axis must have the " +
-              "same direction!")
-
-        # Fit new Y axis if possible (points scanned in X direction)
-        angle_y = None
-        intersect_y = None
-        if len(self.scans['x']) > 1 :
-          x = []
-          y = []
-          for scan in self.scans['x'] :
-            x.append(scan['pos'][0])
-            y.append(scan['pos'][1])
-          # Perform fit with x and y swapped, to prevent slope to be close to
-          # infinity. Since the swap mirrors the angle, it needs to be mirrored
-          # back (switch sign).
-          m,b,r,sm,sb = linear_regression(y, x, 0.01)
-          gcmd.respond_info("Y axis fit: "+str(m)+"*y + " + str(b))
-          gcmd.respond_info("r = "+str(r)+" sm = "+str(sm)+" sb = "+str(sb))
-          angle_y = -math.atan(m)
-          err_angle_y = abs(-math.atan(m+sm) - angle_y) / angle_y
-          gcmd.respond_info("angle_y = "+str(angle_y*180/math.pi))
-          intersect_y = b
-
-        # Fit new X axis if possible (points scanned in Y direction)
-        angle_x = None
-        intersect_x = None
-        if len(self.scans['y']) > 1 :
-          x = []
-          y = []
-          for scan in self.scans['y'] :
-            x.append(scan['pos'][0])
-            y.append(scan['pos'][1])
-          m,b,r,sm,sb = linear_regression(x, y, 0.01)
-          gcmd.respond_info("X axis fit: "+str(m)+"*x + " + str(b))
-          gcmd.respond_info("r = "+str(r)+" sm = "+str(sm)+" sb = "+str(sb))
-          angle_x = math.atan(m)
-          err_angle_x = abs(-math.atan(m+sm) - angle_x) / angle_x
-          gcmd.respond_info("angle_x = "+str(angle_x*180/math.pi))
-          intersect_x = b
-
-        # Make sure angle is defined at least through one axis
-        if angle_y == None and angle_x == None :
-          raise gcmd.error("Too few touch points, cannot determine rotation "
-            + "angle!")
-        elif angle_y == None :
-          angle = angle_x
-        elif angle_x == None :
-          angle = angle_y
-        else :
-          # Average angle, weighted with error
-          angle = (angle_y/err_angle_y+angle_x/err_angle_x)/                   \
-                  (1/err_angle_x+1/err_angle_y)
+        for axis in ['x', 'y'] :
+          for scan in self.scans[axis] :
+            if scan['direction'] != self.scans[axis][0]['direction'] :
+              raise gcmd.error("All touch points for the %s axis must have "
+                "the same direction!" % (axis,))
 
-        gcmd.respond_info("angle = "+str(angle*180/math.pi))
 
-        # Determine X axis intersection with machine Y axis based on new angle
-        intersect_x = 0
-        for scan in self.scans['y'] :
-          b = scan['pos'][1] - math.tan(angle)*scan['pos'][0]
-          intersect_x = intersect_x + b/len(self.scans['y'])
-
-        # Determine Y axis intersection with machine X axis based on new angle
-        intersect_y = 0
-        for scan in self.scans['x'] :
-          b = scan['pos'][0] + math.tan(angle)*scan['pos'][1]
-          intersect_y = intersect_y + b/len(self.scans['x'])
-
-        # correct for tool radius (x_direction and y_direction are the signed
-        # of the scan movement along the x resp. y axis, not the directions for
-        # the scans used to define the respective axis!)
-        intersect_x = intersect_x + y_direction*math.cos(angle)*self.tool_radius
-        intersect_y = intersect_y + x_direction*math.cos(angle)*self.tool_radius
-
-        # compute coordinate transform offsets
-        self.offset[0] = (intersect_y - intersect_x * math.tan(angle)) /       \
-                         (1 + pow(math.tan(angle), 2))
-        self.offset[1] = self.offset[0]*math.tan(angle) + intersect_x
-
-        # compute coordinate transform rotation matrix
+    def _set_transform(self, angle, offset):
+        self.angle = angle
+        self.offset = [offset[0], offset[1]]
         self.rot_mat = [ [ math.cos(angle), -math.sin(angle)],
                          [+math.sin(angle),  math.cos(angle)] ]
-
+        self.affine = ((self.rot_mat[0][0], self.rot_mat[0][1], 0.,
+                        self.offset[0]),
+                       (self.rot_mat[1][0], self.rot_mat[1][1], 0.,
+                        self.offset[1]),
+                       (0., 0., 1., 0.))
+        self.gcode_move.update_move_transform()
+
+
+    def _compute_workpart(self, gcmd):
+        self._check_directions(gcmd)
+        try :
+          angle, offset, residuals = fit_workpart(self.scans['x'],
+            self.scans['y'], self.tool_radius)
+        except ValueError as e :
+          raise gcmd.error(str(e))
+
+        # Report residuals (distance of each touch point from fitted edge)
+        for axis in ['x', 'y'] :
+          for scan, res in zip(self.scans[axis], residuals[axis]) :
+            gcmd.respond_info("%s touch at %.3f,%.3f: residual %.4f"
+              % (axis, scan['pos'][0], scan['pos'][1], res))
+        all_res = residuals['x'] + residuals['y']
+        rms = math.sqrt(sum([r*r for r in all_res]) / len(all_res))
+        gcmd.respond_info("Residuals: rms %.4f, max %.4f"
+          % (rms, max([abs(r) for r in all_res])))
+
+        self._set_transform(angle, offset)
+        gcmd.respond_info("angle = "+str(angle*180/math.pi))
         gcmd.respond_info("Offsets: "+str(self.offset))
         gcmd.respond_info("Rotation matrix: "+str(self.rot_mat))
 
-        gcmd.respond_info("New workpart transform computed. This will not be "
-            + "saved into the config file. Re-issue COMPUTE_WORKPART command "
-            + "after restart to restore the workpart transform!")
+        # Store transform in config file
+        configfile = self.printer.lookup_object('configfile')
+        configfile.set(self.name, 'transform', "%.6f, %.6f, %.6f"
+          % (angle*180/math.pi, self.offset[0], self.offset[1]))
 
 
-    def get_position(self):
-        x, y, z, e = self.normal_transform.get_position()
-        x = x - self.offset[0]
-        y = y - self.offset[1]
-        xn = x*self.rot_mat[0][0] + y*self.rot_mat[1][0]
-        yn = x*self.rot_mat[0][1] + y*self.rot_mat[1][1]
-        return [xn, yn, z, e]
+    def cmd_COMPUTE_WORKPART(self, gcmd):
+        self._compute_workpart(gcmd)
+        gcmd.respond_info("New workpart transform computed. The SAVE_CONFIG "
+            + "command will store it in the printer config file, so it is "
+            + "restored after restart.")
+
+
+    def _plan_touches(self, pos):
+        # Order the touch points of each edge along the edge and choose the
+        # edge order and the direction of travel along each edge such that
+        # the travel distance between the edges is short
+        def dist(a, b):
+          return math.hypot(a[0] - b[0], a[1] - b[1])
+        edges = []
+        for axis, other in [('x', 1), ('y', 0)] :
+          if self.scans[axis] :
+            edges.append((axis, sorted(self.scans[axis],
+              key=lambda scan: scan['pos'][other])))
+        plan = []
+        while edges :
+          candidates = []
+          for i, (axis, scans) in enumerate(edges) :
+            candidates.append((dist(pos, scans[0]['pos']), i, False))
+            candidates.append((dist(pos, scans[-1]['pos']), i, True))
+          d, i, reverse = min(candidates)
+          axis, scans = edges.pop(i)
+          if reverse :
+            scans = scans[::-1]
+          plan.append((axis, scans))
+          pos = scans[-1]['pos']
+        return plan
+
+
+    def cmd_WORKPART_TOUCH(self, gcmd):
+        toolhead = self.printer.lookup_object('toolhead')
+        probe_xy = self.printer.lookup_object('probe_xy')
+        approach = gcmd.get_float('APPROACH', self.approach_distance,
+          above=0.)
+        lift = gcmd.get_float('LIFT', self.travel_lift, minval=0.)
+        speed = gcmd.get_float('SPEED', self.travel_speed, above=0.)
+        if not self.scans['x'] or not self.scans['y'] :
+          raise gcmd.error("Touch points for both axes must be recorded "
+            "(with EDGE_TOUCH) before running WORKPART_TOUCH.")
+        self._check_directions(gcmd)
+
+        new_scans = {'x': [], 'y': []}
+        for axis, scans in self._plan_touches(toolhead.get_position()) :
+          idx = 0 if axis == 'x' else 1
+          for i, scan in enumerate(scans) :
+            sense = scan['direction']
+            start = list(toolhead.get_position())
+            start[0:3] = scan['pos'][0:3]
+            start[idx] -= sense*approach
+            if i == 0 :
+              # Travel to the first point of the edge above the workpart
+              cur = toolhead.get_position()
+              safe_z = max(cur[2], start[2] + lift)
+              toolhead.manual_move([None, None, safe_z], speed)
+              toolhead.manual_move([start[0], start[1], None], speed)
+            # Further points are reached along the edge at touch depth
+            toolhead.manual_move(start, speed)
+            result = probe_xy.run_probe(gcmd,
+              "%s%s" % (axis, '+' if sense > 0 else '-'))
+            pos = list(toolhead.get_position())
+            pos[0:3] = result
+            new_scans[axis].append({'direction': sense, 'pos': pos})
+            # Retract from the edge
+            retract = list(pos)
+            retract[idx] -= sense*approach
+            toolhead.manual_move(retract, speed)
+          toolhead.manual_move([None, None, safe_z], speed)
+        toolhead.wait_moves()
+
+        # record touch points and compute transform
+        self.scans = new_scans
+        configfile = self.printer.lookup_object('configfile')
+        configfile.set(self.name, 'x_scans', self.scans['x'])
+        configfile.set(self.name, 'y_scans', self.scans['y'])
+        self._compute_workpart(gcmd)
+        gcmd.respond_info("Touched %d points. The SAVE_CONFIG command will "
+            "store the touch points and the transform in the printer config "
+            "file." % (len(new_scans['x']) + len(new_scans['y']),))
 
 
-    def move(self, newpos, speed):
-        x, y, z, e = newpos
-        xn = x*self.rot_mat[0][0] + y*self.rot_mat[0][1]
-        yn = x*self.rot_mat[1][0] + y*self.rot_mat[1][1]
-        xn = xn + self.offset[0]
-        yn = yn + self.offset[1]
-        self.normal_transform.move([xn, yn, z, e], speed)
+    def get_affine_transform(self):
+        return self.affine
 
 
 def load_config(config):
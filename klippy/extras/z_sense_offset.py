@@ -9,13 +9,19 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
-import logging, time
+import logging, time, collections
+
+# Number of control loop evaluations kept in the trace
+TRACE_SIZE = 1000
 
 class SensingZOffset:
     def __init__(self, config):
         self.name = config.get_name()
         self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
         self.printer.register_event_handler("klippy:ready", self._handle_ready)
+        self.printer.register_event_handler("klippy:shutdown",
+                                            self._handle_shutdown)
 
         self.force_threshold = config.getint('force_threshold', minval=1.)
         self.force_threshold_default = self.force_threshold
@@ -46,9 +52,24 @@ class SensingZOffset:
         self.i_average = 0
         self.enable = False
 
+        # Z offset of the moves currently being executed, and the print time
+        # from which on it is active (changes only take effect for moves
+        # queued after the change - until the lookahead reports that time
+        # the latest change is pending and active_time is NEVER)
+        self.active_z_offset = 0.
+        self.active_time = 0.
+        self.change_count = 0
+        self.latency = 0.
+
+        # Trace of the control loop for tuning
+        self.trace = collections.deque(maxlen=TRACE_SIZE)
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("z_sense_offset/dump_trace",
+                                   self._handle_dump_trace)
+
         # Register transform
-        gcode_move = self.printer.load_object(config, 'gcode_move')
-        self.normal_transform = gcode_move.set_move_transform(self, force=True)
+        self.gcode_move = self.printer.load_object(config, 'gcode_move')
+        self.gcode_move.set_move_transform(self, force=True)
 
         # Reset z offset and force offset when homing Z axis
         self.printer.register_event_handler("homing:home_rails_end",
@@ -63,33 +84,96 @@ class SensingZOffset:
             self.max_z_offset_default, minval=0.)
         self.force_threshold = gcmd.get_int("FORCE_THRESHOLD",
             self.force_threshold_default, minval=0)
-        self.z_offset = 0.
+        self._set_z_offset(0.)
         self.enable = True
 
     def _handle_ready(self):
         self.tool = self.printer.lookup_object('toolhead')
+        self.motion_report = self.printer.lookup_object('motion_report')
         self.enable = False
 
     def _handle_home_rails_end(self, homing_state, rails):
         self.enable = False
 
-    def get_position(self):
-        x, y, z, e = self.normal_transform.get_position()
-        return [x, y, z-self.z_offset, e]
-
-    def move(self, newpos, speed):
-        x, y, z, e = newpos
-        self.normal_transform.move([x, y, z+self.z_offset, e], speed)
+    def _handle_shutdown(self):
+        # The lookahead queue (and with it the timing callbacks of pending
+        # changes) is discarded - Z_SENSE_OFFSET must be issued again
+        self.enable = False
 
-    def force_callback(self, force) :
+    def get_affine_transform(self):
+        return ((1., 0., 0., 0.),
+                (0., 1., 0., 0.),
+                (0., 0., 1., self.z_offset))
+
+    def _set_z_offset(self, z_offset, sample_time=None):
+        self.z_offset = z_offset
+        self.gcode_move.update_move_transform()
+        # The new offset applies to the moves queued from now on - note the
+        # print time at which these moves start
+        self.change_count += 1
+        self.active_time = self.reactor.NEVER
+        change_id = self.change_count
+        self.tool.register_lookahead_callback(
+            lambda print_time: self._note_offset_active(
+                change_id, z_offset, sample_time, print_time))
+
+    def _note_offset_active(self, change_id, z_offset, sample_time,
+                            print_time):
+        self.active_z_offset = z_offset
+        if sample_time is not None:
+          self.latency = print_time - sample_time
+        # A later change may already be waiting for its moves
+        if change_id == self.change_count:
+          self.active_time = print_time
+
+    def get_status(self, eventtime):
+        return {'enabled': self.enable,
+                'z_offset': self.z_offset,
+                'active_z_offset': self.active_z_offset,
+                'latency': self.latency,
+                'force': self.last_force}
+
+    def _handle_dump_trace(self, web_request):
+        web_request.send({'header': ('time', 'force', 'smoothed_force',
+                                     'z_offset', 'active_z_offset',
+                                     'latency'),
+                          'data': list(self.trace)})
+
+    def force_callback(self, samples) :
         # check if enabled
         if not self.enable :
           return
+        # Called from the sensor thread - the controller changes toolhead
+        # and gcode_move state, so it must run in the reactor
+        self.reactor.register_async_callback(
+            (lambda e, s=samples: self._process_samples(s)))
 
-        # check if still in first layer
-        if self.tool.get_position()[2] > self.max_z_height:
+    def _process_samples(self, samples):
+        if not self.enable :
           return
-
+        trapqs = self.motion_report.trapqs
+        toolhead_trapq = trapqs['toolhead']
+        extruder_trapq = trapqs.get(self.tool.get_extruder().get_name())
+        for print_time, force in samples:
+          # only use forces measured with the current offset, i.e. after the
+          # last change reached the moves being executed
+          if print_time < self.active_time:
+            continue
+
+          # check if still in first layer (at the time of the measurement)
+          pos, velocity = toolhead_trapq.get_trapq_position(print_time)
+          if pos is None or pos[2] > self.max_z_height:
+            continue
+
+          # only extrusion moves cause extrusion force
+          if extruder_trapq is not None:
+            epos, evelocity = extruder_trapq.get_trapq_position(print_time)
+            if not evelocity:
+              continue
+
+          self._process_force(print_time, force)
+
+    def _process_force(self, print_time, force) :
         # perform averaging with some smoothing
         self.averaged_force += force
         self.i_average += 1
@@ -99,6 +183,8 @@ class SensingZOffset:
         logging.info("smoothed_force = %d" % smoothed_force)
         self.averaged_force *= self.smoothing
         self.i_average *= self.smoothing
+        self.trace.append((print_time, force, smoothed_force, self.z_offset,
+                           self.active_z_offset, self.latency))
 
         # no action required if below threshold
         if smoothed_force < self.force_threshold:
@@ -129,8 +215,10 @@ class SensingZOffset:
           n_steps = 0
 
         # apply offset
-        self.z_offset = min(self.z_offset + n_steps*self.step_size,
+        z_offset = min(self.z_offset + n_steps*self.step_size,
             self.max_z_offset)
+        if z_offset != self.z_offset:
+          self._set_z_offset(z_offset, print_time)
 
         logging.info("n_steps = %d  z_offset = %f" % (n_steps, self.z_offset) )
 
@@ -188,7 +188,7 @@ class GCodeDispatch:
         self._respond_state("Ready")
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*])')
-    def _process_commands(self, commands, need_ack=True):
+    def _parse_commands(self, commands):
         for line in commands:
             # Ignore comments and leading/trailing spaces
             line = origline = line.strip()
@@ -205,6 +205,11 @@ class GCodeDispatch:
             # Build gcode "params" dictionary
             params = { parts[i]: parts[i+1].strip()
                        for i in range(1, len(parts), 2) }
+            yield cmd, origline, params
+    def _process_commands(self, commands, need_ack=True):
+        self._process_parsed_commands(self._parse_commands(commands), need_ack)
+    def _process_parsed_commands(self, parsed_commands, need_ack):
+        for cmd, origline, params in parsed_commands:
             gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
             # Invoke handler for command
             handler = self.gcode_handlers.get(cmd, self.cmd_default)
@@ -225,6 +230,14 @@ class GCodeDispatch:
             gcmd.ack()
     def run_script_from_command(self, script):
         self._process_commands(script.split('\n'), need_ack=False)
+    def parse_script(self, script):
+        # Parse a script for later use with run_parsed_script_from_command()
+        return list(self._parse_commands(script.split('\n')))
+    def run_parsed_script_from_command(self, parsed_commands):
+        # Commands may alter their params, so each run gets a fresh copy
+        self._process_parsed_commands(
+            [(cmd, origline, dict(params))
+             for cmd, origline, params in parsed_commands], need_ack=False)
     def run_script(self, script):
         with self.mutex:
             self._process_commands(script.split('\n'), need_ack=False)
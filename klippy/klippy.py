@@ -267,6 +267,8 @@ def main():
                     help="api server unix domain socket filename")
     opts.add_option("-l", "--logfile", dest="logfile",
                     help="write log to file instead of stderr")
+    opts.add_option("--structured-log", dest="structured_log",
+                    help="also write stats and events to a JSON lines file")
     opts.add_option("-v", action="store_true", dest="verbose",
                     help="enable debug messages")
     opts.add_option("-o", "--debugoutput", dest="debugoutput",
@@ -299,7 +301,8 @@ def main():
     bglogger = None
     if options.logfile:
         start_args['log_file'] = options.logfile
-        bglogger = queuelogger.setup_bg_logging(options.logfile, debuglevel)
+        bglogger = queuelogger.setup_bg_logging(options.logfile, debuglevel,
+                                                options.structured_log)
     else:
         logging.getLogger().setLevel(debuglevel)
     logging.info("Starting Klippy...")
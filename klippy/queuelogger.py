@@ -3,28 +3,123 @@
 # Copyright (C) 2016-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, logging.handlers, threading, queue, time
+import logging, logging.handlers, threading, queue, time, json
+
+# Message arguments that can be safely formatted from another thread
+SIMPLE_ARG_TYPES = (str, bytes, int, float, bool, type(None))
+
+# Identical messages logged within this time are collapsed
+REPEAT_SUPPRESS_TIME = 2.
 
 # Class to forward all messages through a queue to a background thread
 class QueueHandler(logging.Handler):
     def __init__(self, queue):
         logging.Handler.__init__(self)
         self.queue = queue
+        self.last_key = None
+        self.last_time = 0.
+        self.repeat_count = 0
+    def _get_record_key(self, record):
+        args = record.args
+        if args is None:
+            args = ()
+        elif (type(args) is not tuple
+              or not all([type(a) in SIMPLE_ARG_TYPES for a in args])):
+            return None
+        return (record.levelno, record.name, record.msg, args)
+    def _flush_repeats(self):
+        if self.repeat_count:
+            self.queue.put_nowait(logging.makeLogRecord({
+                'msg': "Last message repeated %d times" % (self.repeat_count,),
+                'levelno': logging.INFO, 'levelname': 'INFO'}))
+            self.repeat_count = 0
     def emit(self, record):
         try:
-            self.format(record)
-            record.msg = record.message
-            record.args = None
-            record.exc_info = None
+            key = None
+            if not record.exc_info:
+                key = self._get_record_key(record)
+            if (key is not None and key == self.last_key
+                and record.created < self.last_time + REPEAT_SUPPRESS_TIME):
+                self.repeat_count += 1
+                return
+            self._flush_repeats()
+            self.last_key = key
+            self.last_time = record.created
+            if key is None:
+                # Arguments may change - format message now
+                self.format(record)
+                record.msg = record.message
+                record.args = None
+                record.exc_info = None
             self.queue.put_nowait(record)
         except Exception:
             self.handleError(record)
+    def flush(self):
+        self.acquire()
+        try:
+            self._flush_repeats()
+        finally:
+            self.release()
+
+# Parse a "Stats" message into {section: {name: value}}
+def parse_stats(stats):
+    section = ""
+    out = {section: {}}
+    for p in stats.split():
+        if '=' not in p:
+            section = p.rstrip(':')
+            out.setdefault(section, {})
+            continue
+        name, val = p.split('=', 1)
+        out[section][name] = val
+    return out
+
+# Message prefixes that are recorded as events in the structured log
+EVENT_PREFIXES = [
+    ("Args: ", "versions"), ("Start printer at", "start"),
+    ("===== Config file =====", "config"), ("Dumping ", "dump"),
+]
+
+# Optional log of stats and events in JSON lines format.  Each entry
+# notes the offset of the corresponding message in the main log file.
+class StructuredLog(logging.handlers.TimedRotatingFileHandler):
+    def __init__(self, filename):
+        logging.handlers.TimedRotatingFileHandler.__init__(
+            self, filename, when='midnight', backupCount=5)
+    def shouldRollover(self, record):
+        # Rollover is performed together with the main log
+        return False
+    def get_entry(self, record):
+        msg = record.msg
+        if not isinstance(msg, str):
+            return None
+        if msg.startswith("Stats ") and record.args:
+            eventtime, stats = record.args
+            return {'type': 'stats', 'eventtime': eventtime,
+                    'stats': parse_stats(stats)}
+        for prefix, event in EVENT_PREFIXES:
+            if msg.startswith(prefix):
+                return {'type': event}
+        first_line = msg.split('\n', 1)[0]
+        if 'shutdown: ' in first_line:
+            return {'type': 'shutdown'}
+        return None
+    def add_entry(self, entry, record, offset):
+        entry['systime'] = round(record.created, 3)
+        entry['offset'] = offset
+        if self.stream is None:
+            self.stream = self._open()
+        self.stream.write(json.dumps(entry, separators=(',', ':')) + "\n")
+        self.flush()
 
 # Class to poll a queue in a background thread and log each message
 class QueueListener(logging.handlers.TimedRotatingFileHandler):
-    def __init__(self, filename):
+    def __init__(self, filename, structured_filename=None):
         logging.handlers.TimedRotatingFileHandler.__init__(
             self, filename, when='midnight', backupCount=5)
+        self.structured_log = None
+        if structured_filename is not None:
+            self.structured_log = StructuredLog(structured_filename)
         self.bg_queue = queue.Queue()
         self.bg_thread = threading.Thread(target=self._bg_thread)
         self.bg_thread.start()
@@ -36,8 +131,29 @@ class QueueListener(logging.handlers.TimedRotatingFileHandler):
                 break
             self.handle(record)
     def stop(self):
+        if MainQueueHandler is not None:
+            MainQueueHandler.flush()
         self.bg_queue.put_nowait(None)
         self.bg_thread.join()
+        if self.structured_log is not None:
+            self.structured_log.close()
+    def emit(self, record):
+        entry = None
+        if self.structured_log is not None:
+            entry = self.structured_log.get_entry(record)
+        if entry is None:
+            logging.handlers.TimedRotatingFileHandler.emit(self, record)
+            return
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            offset = self.stream.tell()
+            logging.FileHandler.emit(self, record)
+            self.structured_log.add_entry(entry, record, offset)
+        except Exception:
+            self.handleError(record)
     def set_rollover_info(self, name, info):
         if info is None:
             self.rollover_info.pop(name, None)
@@ -47,6 +163,8 @@ class QueueListener(logging.handlers.TimedRotatingFileHandler):
         self.rollover_info.clear()
     def doRollover(self):
         logging.handlers.TimedRotatingFileHandler.doRollover(self)
+        if self.structured_log is not None:
+            self.structured_log.doRollover()
         lines = [self.rollover_info[name]
                  for name in sorted(self.rollover_info)]
         lines.append(
@@ -57,9 +175,9 @@ class QueueListener(logging.handlers.TimedRotatingFileHandler):
 
 MainQueueHandler = None
 
-def setup_bg_logging(filename, debuglevel):
+def setup_bg_logging(filename, debuglevel, structured_filename=None):
     global MainQueueHandler
-    ql = QueueListener(filename)
+    ql = QueueListener(filename, structured_filename)
     MainQueueHandler = QueueHandler(ql.bg_queue)
     root = logging.getLogger()
     root.addHandler(MainQueueHandler)
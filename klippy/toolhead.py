@@ -253,6 +253,7 @@ class ToolHead:
         self.flush_timer = self.reactor.register_timer(self._flush_handler)
         self.do_kick_flush_timer = True
         self.last_flush_time = self.min_restart_time = 0.
+        self.last_sg_flush_time = 0.
         self.need_flush_time = self.step_gen_time = self.clear_history_time = 0.
         # Kinematic step generation scan window time tracking
         self.kin_flush_delay = SDS_CHECK_TIME
@@ -299,9 +300,10 @@ class ToolHead:
         # Generate steps via itersolve
         sg_flush_want = min(flush_time + STEPCOMPRESS_FLUSH_TIME,
                             self.print_time - self.kin_flush_delay)
-        sg_flush_time = max(sg_flush_want, flush_time)
+        sg_flush_time = max(sg_flush_want, flush_time, self.last_sg_flush_time)
         for sg in self.step_generators:
             sg(sg_flush_time)
+        self.last_sg_flush_time = sg_flush_time
         self.min_restart_time = max(self.min_restart_time, sg_flush_time)
         # Free trapq entries that are no longer needed
         clear_history_time = self.clear_history_time
@@ -589,8 +591,11 @@ class ToolHead:
         return self.trapq
     def register_step_generator(self, handler):
         self.step_generators.append(handler)
-    def note_step_generation_scan_time(self, delay, old_delay=0.):
-        self.flush_step_generation()
+    def note_step_generation_scan_time(self, delay, old_delay=0., flush=True):
+        # Without a flush the caller must ensure that steps not yet
+        # generated remain valid with the new scan window
+        if flush:
+            self.flush_step_generation()
         if old_delay:
             self.kin_flush_times.pop(self.kin_flush_times.index(old_delay))
         if delay:
@@ -16,6 +16,9 @@ shaper_calibrate = importlib.import_module('.shaper_calibrate', 'extras')
 MAX_TITLE_LENGTH=65
 
 def parse_log(logname):
+    if shaper_calibrate.is_binary_raw_data(logname):
+        # Raw accelerometer data in binary format
+        return shaper_calibrate.load_binary_raw_data(np, logname)
     with open(logname) as f:
         for header in f:
             if not header.startswith('#'):
@@ -4,8 +4,9 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import optparse, datetime
+import optparse, datetime, json, multiprocessing
 import matplotlib
+import logindex
 
 MAXBANDWIDTH=25000.
 MAXBUFFER=2.
@@ -18,38 +19,90 @@ APPLY_PREFIX = [
     'target', 'temp', 'pwm'
 ]
 
-def parse_log(logname, mcu):
-    if mcu is None:
-        mcu = "mcu"
-    mcu_prefix = mcu + ":"
+# Read stats from a structured log (klippy --structured-log)
+def parse_structured_log(logname, mcu):
     apply_prefix = { p: 1 for p in APPLY_PREFIX }
-    f = open(logname, 'r')
-    out = []
-    for line in f:
-        parts = line.split()
-        if not parts or parts[0] not in ('Stats', 'INFO:root:Stats'):
-            #if parts and parts[0] == 'INFO:root:shutdown:':
-            #    break
-            continue
-        prefix = ""
-        keyparts = {}
-        for p in parts[2:]:
-            if '=' not in p:
-                prefix = p
-                if prefix == mcu_prefix:
-                    prefix = ''
+    events = []
+    with open(logname, 'r') as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry['type'] == 'start':
+                events.append((None, None, 'start', None))
+            if entry['type'] != 'stats':
+                continue
+            keyparts = {}
+            for section, vals in entry['stats'].items():
+                prefix = ""
+                if section and section != mcu:
+                    prefix = section + ":"
+                for name, val in vals.items():
+                    if name in apply_prefix:
+                        name = prefix + name
+                    keyparts[name] = val
+            if 'print_time' not in keyparts:
                 continue
-            name, val = p.split('=', 1)
-            if name in apply_prefix:
-                name = prefix + name
-            keyparts[name] = val
-        if 'print_time' not in keyparts:
+            sampletime = float("%.1f" % (entry['eventtime'],))
+            keyparts['#sampletime'] = sampletime
+            events.append((None, keyparts, 'stats', sampletime))
+    return events
+
+def parse_stats_line(line, mcu_prefix, apply_prefix):
+    parts = line.split()
+    if not parts or parts[0] not in ('Stats', 'INFO:root:Stats'):
+        return None
+    prefix = ""
+    keyparts = {}
+    for p in parts[2:]:
+        if '=' not in p:
+            prefix = p
+            if prefix == mcu_prefix:
+                prefix = ''
             continue
-        keyparts['#sampletime'] = float(parts[1][:-1])
-        out.append(keyparts)
-    f.close()
+        name, val = p.split('=', 1)
+        if name in apply_prefix:
+            name = prefix + name
+        keyparts[name] = val
+    if 'print_time' not in keyparts:
+        return None
+    keyparts['#sampletime'] = float(parts[1][:-1])
+    return keyparts
+
+# Parse the stats lines at the given offsets (may run in a worker process)
+def parse_stats_lines(job):
+    logname, mcu, offsets = job
+    mcu_prefix = mcu + ":"
+    apply_prefix = { p: 1 for p in APPLY_PREFIX }
+    out = []
+    with open(logname, 'rb') as f:
+        for offset in offsets:
+            line = logindex.read_line(f, offset)
+            keyparts = parse_stats_line(line, mcu_prefix, apply_prefix)
+            if keyparts is not None:
+                out.append(keyparts)
     return out
 
+def parse_log(logname, mcu, session=None, start=None, end=None, jobs=1):
+    if mcu is None:
+        mcu = "mcu"
+    if logname.endswith('.jsonl'):
+        events = parse_structured_log(logname, mcu)
+        sessions = logindex.select_events(events, ['stats'],
+                                          session, start, end)
+        return [ev[1] for s in sessions for ev in s]
+    # Only parse the stats lines found in the requested sessions
+    index = logindex.LogIndex(logname)
+    sessions = logindex.select_events(index.events, ['stats', 'rootstats'],
+                                      session, start, end)
+    offsets = [ev[1] for s in sessions for ev in s]
+    if jobs <= 1:
+        return parse_stats_lines((logname, mcu, offsets))
+    chunk = (len(offsets) + jobs - 1) // jobs
+    work = [(logname, mcu, offsets[i:i+chunk])
+            for i in range(0, len(offsets), chunk)]
+    with multiprocessing.Pool(jobs) as pool:
+        results = pool.map(parse_stats_lines, work)
+    return [keyparts for out in results for keyparts in out]
+
 def setup_matplotlib(output_to_file):
     global matplotlib
     if output_to_file:
@@ -302,13 +355,23 @@ def main():
                     default=None, help="graph heater temperature")
     opts.add_option("-m", "--mcu", type="string", dest="mcu", default=None,
                     help="limit stats to the given mcu")
+    opts.add_option("-S", "--session", type="int", dest="session",
+                    default=None, help="only graph the given printer session"
+                    " (1 is the first, -1 the last)")
+    opts.add_option("--start", type="float", dest="start", default=None,
+                    help="only graph stats at or after the given time")
+    opts.add_option("--end", type="float", dest="end", default=None,
+                    help="only graph stats at or before the given time")
+    opts.add_option("-j", "--jobs", type="int", dest="jobs", default=1,
+                    help="number of processes used to parse the log")
     options, args = opts.parse_args()
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
     logname = args[0]
 
     # Parse data
-    data = parse_log(logname, options.mcu)
+    data = parse_log(logname, options.mcu, options.session,
+                     options.start, options.end, options.jobs)
     if not data:
         return
 
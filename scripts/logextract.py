@@ -4,7 +4,8 @@
 # Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, re, collections, ast, itertools
+import optparse, re, ast, itertools, bisect, multiprocessing
+import logindex
 
 def format_comment(line_num, line):
     return "# %6d: %s" % (line_num, line)
@@ -519,14 +520,9 @@ class StatsStream:
 
 # Main handler for creating shutdown diagnostics file
 class GatherShutdown:
-    def __init__(self, configs, line_num, recent_lines, logname):
+    def __init__(self, line_num, recent_lines, logname):
         self.filename = "%s.shutdown%05d" % (logname, line_num)
         self.comments = []
-        if configs:
-            configs_by_id = {c.config_num: c for c in configs.values()}
-            config = configs_by_id[max(configs_by_id.keys())]
-            config.add_comment(format_comment(line_num, recent_lines[-1][1]))
-            self.comments.append("# config %s" % (config.filename,))
         self.stats_stream = StatsStream(line_num, logname)
         self.active_streams = [self.stats_stream]
         self.all_streams = list(self.active_streams)
@@ -572,44 +568,167 @@ class GatherShutdown:
             f.writelines(lines)
 
 
+# Note a shutdown in the most recent config file and return a comment
+def note_shutdown_config(configs, line_num, line):
+    if not configs:
+        return None
+    configs_by_id = {c.config_num: c for c in configs.values()}
+    config = configs_by_id[max(configs_by_id.keys())]
+    config.add_comment(format_comment(line_num, line))
+    return "# config %s" % (config.filename,)
+
+# Extract a shutdown dump (may be run in a worker process)
+def extract_shutdown(job):
+    logname, line_num, recent_offset, recent_line_num, comments = job
+    with open(logname, 'rb') as f:
+        lines = logindex.read_lines(f, recent_offset, recent_line_num)
+        recent_lines = list(itertools.islice(
+            lines, line_num - recent_line_num + 1))
+        handler = GatherShutdown(line_num, recent_lines, logname)
+        for comment in comments:
+            handler.add_comment(comment)
+        for line_num, line in lines:
+            if not handler.add_line(line_num, line):
+                return
+        handler.finalize()
+
+
+######################################################################
+# Log index scanning
+######################################################################
+
+RECENT_LINES = 200
+INDEX_KINDS = ('git', 'start', 'config', 'config_end', 'shutdown')
+
+# Stats line numbers and times from the index (used to find the end
+# of a shutdown dump)
+class IndexStats:
+    def __init__(self, index):
+        stats = index.get_events(['stats'])
+        self.line_nums = [e[0] for e in stats]
+        self.times = [e[3] for e in stats]
+    def get_last(self, first_line_num, line_num):
+        i = bisect.bisect_right(self.line_nums, line_num) - 1
+        if i < 0 or self.line_nums[i] < first_line_num:
+            return None
+        return self.times[i]
+    def find_time_advance(self, line_num, first_ts, end_line_num):
+        for i in range(bisect.bisect_right(self.line_nums, line_num),
+                       len(self.line_nums)):
+            stat_line_num = self.line_nums[i]
+            if end_line_num is not None and stat_line_num >= end_line_num:
+                break
+            ts = self.times[i]
+            if first_ts is None:
+                first_ts = ts
+            elif ts > first_ts + 5.:
+                return stat_line_num
+        return end_line_num
+
+# Find the line that completes a config dump started at events[pos-1]
+def find_config_end(events, pos):
+    for i in range(pos, len(events)):
+        if events[i][2] == 'config_end':
+            return events[i][0]
+    return None
+
+# Find the line that completes a shutdown dump started at events[pos-1]
+def find_shutdown_end(events, pos, recent_line_num, stats):
+    end_line_num = None
+    for i in range(pos, len(events)):
+        if events[i][2] in ('git', 'start', 'config'):
+            end_line_num = events[i][0]
+            break
+    line_num = events[pos-1][0]
+    first_ts = stats.get_last(recent_line_num, line_num)
+    return stats.find_time_advance(line_num, first_ts, end_line_num)
+
+# Locate config and shutdown dumps using the log index.  This follows
+# the same rules as a line by line scan of the log, but only the
+# indexed lines need to be examined.
+def find_handlers(index, f):
+    events = index.get_events(INDEX_KINDS)
+    event_line_nums = [e[0] for e in events]
+    stats = IndexStats(index)
+    handlers = []
+    last_git = last_start = None
+    recent_line_num = 1
+    pos = 0
+    while pos < len(events):
+        line_num, offset, kind, ts = events[pos]
+        pos += 1
+        if kind == 'git':
+            last_git = format_comment(line_num, logindex.read_line(f, offset))
+            continue
+        elif kind == 'start':
+            last_start = format_comment(line_num,
+                                        logindex.read_line(f, offset))
+            continue
+        elif kind == 'config':
+            end_line_num = find_config_end(events, pos)
+        elif kind == 'shutdown':
+            recent_line_num = max(recent_line_num,
+                                  line_num - RECENT_LINES + 1)
+            end_line_num = find_shutdown_end(events, pos, recent_line_num,
+                                             stats)
+        else:
+            continue
+        handlers.append((kind, line_num, offset, recent_line_num,
+                         last_git, last_start))
+        if end_line_num is None:
+            break
+        # The final line of a dump may itself start a new dump
+        recent_line_num = end_line_num + 1
+        pos = bisect.bisect_left(event_line_nums, end_line_num)
+    return handlers
+
+
 ######################################################################
 # Startup
 ######################################################################
 
 def main():
-    logname = sys.argv[1]
-    last_git = last_start = None
+    usage = "%prog [options] <logfile>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-j", "--jobs", type="int", dest="jobs", default=1,
+                    help="number of processes used to extract shutdowns")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    logname = args[0]
     configs = {}
-    handler = None
-    recent_lines = collections.deque([], 200)
-    # Parse log file
-    with open(logname, 'rt') as f:
-        for line_num, line in enumerate(f):
-            line = line.rstrip()
-            line_num += 1
-            recent_lines.append((line_num, line))
-            if handler is not None:
-                ret = handler.add_line(line_num, line)
-                if ret:
-                    continue
-                recent_lines.clear()
-                handler = None
-            if line.startswith('Git version'):
-                last_git = format_comment(line_num, line)
-            elif line.startswith('Start printer at'):
-                last_start = format_comment(line_num, line)
-            elif line == '===== Config file =====':
-                handler = GatherConfig(configs, line_num,
-                                       recent_lines, logname)
+    shutdowns = []
+    # Find dumps using the log index and extract config files
+    index = logindex.LogIndex(logname)
+    with open(logname, 'rb') as f:
+        for info in find_handlers(index, f):
+            kind, line_num, offset, recent_line_num, last_git, last_start = info
+            if kind == 'config':
+                handler = GatherConfig(configs, line_num, None, logname)
                 handler.add_comment(last_git)
                 handler.add_comment(last_start)
-            elif 'shutdown: ' in line or line.startswith('Dumping '):
-                handler = GatherShutdown(configs, line_num,
-                                         recent_lines, logname)
-                handler.add_comment(last_git)
-                handler.add_comment(last_start)
-    if handler is not None:
-        handler.finalize()
+                lines = logindex.read_lines(f, offset, line_num)
+                next(lines)
+                for line_num, line in lines:
+                    if not handler.add_line(line_num, line):
+                        break
+                else:
+                    handler.finalize()
+                continue
+            line = logindex.read_line(f, offset)
+            comments = [note_shutdown_config(configs, line_num, line),
+                        last_git, last_start]
+            recent_offset = logindex.seek_back_lines(
+                f, offset, line_num - recent_line_num)
+            shutdowns.append((logname, line_num, recent_offset,
+                              recent_line_num, comments))
+    # Extract shutdown information
+    if options.jobs > 1 and len(shutdowns) > 1:
+        with multiprocessing.Pool(options.jobs) as pool:
+            pool.map(extract_shutdown, shutdowns)
+    else:
+        for job in shutdowns:
+            extract_shutdown(job)
     # Write found config files
     for cfg in configs.values():
         cfg.write_file()
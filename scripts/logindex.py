@@ -0,0 +1,219 @@
+# Index of notable lines in a klippy.log file
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, re, json, hashlib
+
+INDEX_VERSION = 1
+CHUNK_SIZE = 4 * 1024 * 1024
+CHECK_SIZE = 4096
+SEEK_BACK_SIZE = 64 * 1024
+
+# Quick (bytes level) search for lines that may need to be indexed
+line_prefix_s = (rb"(?:Stats (?P<time>[0-9]+[.][0-9]+): |Git version"
+                 rb"|Start printer at|=====|Dumping |INFO:root:Stats )")
+first_line_r = re.compile(line_prefix_s)
+next_line_r = re.compile(rb"\n" + line_prefix_s)
+stats_r = re.compile(r"^Stats (?P<time>[0-9]+[.][0-9]+): ")
+root_stats_r = re.compile(r"^INFO:root:Stats (?P<time>[0-9]+[.][0-9]+): ")
+
+# Determine the kind of a (decoded and right stripped) log line
+def classify_line(line):
+    if line.startswith('Git version'):
+        return 'git', None
+    if line.startswith('Start printer at'):
+        return 'start', None
+    if line == '===== Config file =====':
+        return 'config', None
+    if line == '=======================':
+        return 'config_end', None
+    m = stats_r.match(line)
+    if m is not None:
+        return 'stats', float(m.group('time'))
+    if 'shutdown: ' in line or line.startswith('Dumping '):
+        return 'shutdown', None
+    m = root_stats_r.match(line)
+    if m is not None:
+        return 'rootstats', float(m.group('time'))
+    return None, None
+
+def decode_line(data):
+    return data.decode(errors='replace').rstrip()
+
+# Index of the byte offset and line number of notable log lines.  The
+# index is stored next to the log and is extended if the log grows.
+class LogIndex:
+    def __init__(self, logname, save=True):
+        self.logname = logname
+        self.index_name = logname + ".index"
+        # Each event is a (line_num, offset, kind, time) tuple
+        self.events = []
+        # Position of the end of the last complete line indexed
+        self.scanned = self.scanned_lines = 0
+        self.check = ""
+        with open(logname, 'rb') as f:
+            loaded = self._load(f)
+            updated = self._update(f)
+        if save and (updated or not loaded):
+            self._save()
+    def _get_check(self, f, pos):
+        f.seek(max(0, pos - CHECK_SIZE))
+        return hashlib.sha1(f.read(min(pos, CHECK_SIZE))).hexdigest()
+    def _load(self, f):
+        try:
+            with open(self.index_name, 'r') as idx:
+                data = json.load(idx)
+        except (OSError, ValueError):
+            return False
+        if data.get('version') != INDEX_VERSION:
+            return False
+        scanned = data['scanned']
+        f.seek(0, os.SEEK_END)
+        if f.tell() < scanned or self._get_check(f, scanned) != data['check']:
+            # Log was replaced or rewritten
+            return False
+        self.scanned = scanned
+        self.scanned_lines = data['scanned_lines']
+        self.check = data['check']
+        # Events after the last complete line are rescanned
+        events = zip(data['lines'], data['offsets'], data['kinds'],
+                     data['times'])
+        self.events = [e for e in events if e[1] < scanned]
+        return True
+    def _save(self):
+        data = {'version': INDEX_VERSION, 'scanned': self.scanned,
+                'scanned_lines': self.scanned_lines, 'check': self.check}
+        columns = list(zip(*self.events)) or [[], [], [], []]
+        for name, column in zip(['lines', 'offsets', 'kinds', 'times'],
+                                columns):
+            data[name] = column
+        try:
+            with open(self.index_name, 'w') as idx:
+                idx.write(json.dumps(data, separators=(',', ':')))
+        except OSError:
+            # Index is only an optimization
+            pass
+    def _find_candidates(self, buf, end):
+        # Find start of lines with a notable prefix
+        out = []
+        m = first_line_r.match(buf, 0, end)
+        if m is not None:
+            out.append((0, m.group('time')))
+        for m in next_line_r.finditer(buf, 0, end):
+            out.append((m.start() + 1, m.group('time')))
+        # Find lines containing a shutdown message
+        pos = buf.find(b"shutdown: ", 0, end)
+        if pos >= 0:
+            while pos >= 0:
+                out.append((buf.rfind(b'\n', 0, pos) + 1, None))
+                pos = buf.find(b"shutdown: ", pos + 1, end)
+            out.sort(key=lambda c: c[0])
+        return out
+    def _scan_buffer(self, buf, base, line_num, end):
+        events = self.events
+        last_start = -1
+        last_pos = 0
+        for start, ts in self._find_candidates(buf, end):
+            if start == last_start:
+                continue
+            last_start = start
+            line_num += buf.count(b'\n', last_pos, start)
+            last_pos = start
+            if ts is not None:
+                # Common case of a "Stats" line
+                events.append((line_num + 1, base + start, 'stats',
+                               float(ts)))
+                continue
+            stop = buf.find(b'\n', start, end)
+            if stop < 0:
+                stop = end
+            kind, ts = classify_line(decode_line(buf[start:stop]))
+            if kind is not None:
+                events.append((line_num + 1, base + start, kind, ts))
+        return line_num + buf.count(b'\n', last_pos, end)
+    def _update(self, f):
+        f.seek(self.scanned)
+        base = self.scanned
+        line_num = self.scanned_lines
+        buf = b""
+        while 1:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            buf += data
+            end = buf.rfind(b'\n') + 1
+            if not end:
+                continue
+            line_num = self._scan_buffer(buf, base, line_num, end)
+            base += end
+            buf = buf[end:]
+        updated = base != self.scanned
+        if updated:
+            self.scanned = base
+            self.scanned_lines = line_num
+            self.check = self._get_check(f, base)
+        if buf:
+            # Final line without a newline (not stored as scanned)
+            self._scan_buffer(buf, base, line_num, len(buf))
+        return updated
+    def get_events(self, kinds=None):
+        if kinds is None:
+            return list(self.events)
+        return [e for e in self.events if e[2] in kinds]
+
+# Helpers for reading lines at indexed positions
+def read_line(f, offset):
+    f.seek(offset)
+    return decode_line(f.readline())
+
+def read_lines(f, offset, line_num):
+    f.seek(offset)
+    for data in f:
+        yield line_num, decode_line(data)
+        line_num += 1
+
+# Return the offset of the line 'count' lines prior to 'offset'
+def seek_back_lines(f, offset, count):
+    need = count + 1
+    end = offset
+    while end > 0:
+        start = max(0, end - SEEK_BACK_SIZE)
+        f.seek(start)
+        data = f.read(end - start)
+        pos = len(data)
+        while 1:
+            pos = data.rfind(b'\n', 0, pos)
+            if pos < 0:
+                break
+            need -= 1
+            if not need:
+                return start + pos + 1
+        end = start
+    return 0
+
+# Group events of the given kinds by printer session and select the
+# requested session (negative values count from the last session) and
+# time range.  Sessions without matching events are not counted.
+def select_events(events, kinds, session=None, start=None, end=None):
+    sessions = [[]]
+    for ev in events:
+        if ev[2] == 'start':
+            if sessions[-1]:
+                sessions.append([])
+        elif ev[2] in kinds:
+            sessions[-1].append(ev)
+    sessions = [s for s in sessions if s]
+    if session is not None:
+        if session > 0:
+            session -= 1
+        if session >= len(sessions) or session < -len(sessions):
+            return []
+        sessions = [sessions[session]]
+    if start is not None or end is not None:
+        sessions = [[ev for ev in s
+                     if ((start is None or ev[3] >= start)
+                         and (end is None or ev[3] <= end))]
+                    for s in sessions]
+        sessions = [s for s in sessions if s]
+    return sessions
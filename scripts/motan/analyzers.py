@@ -3,7 +3,7 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, collections
+import math, collections, array
 import readlog
 
 
@@ -38,12 +38,15 @@ class GenDerivative:
             lname = lname.replace(old, new).replace(old.lower(), new.lower())
             units = units.replace(old, new).replace(old.lower(), new.lower())
         return {'label': lname, 'units': units}
+    def get_margin(self):
+        return self.amanager.get_segment_time()
     def generate_data(self):
         inv_seg_time = 1. / self.amanager.get_segment_time()
         data = self.amanager.get_datasets()[self.source]
-        deriv = [(data[i+1] - data[i]) * inv_seg_time
-                 for i in range(len(data)-1)]
-        return [deriv[0]] + deriv
+        deriv = array.array('d', [(data[i+1] - data[i]) * inv_seg_time
+                                  for i in range(len(data)-1)])
+        deriv.insert(0, deriv[0])
+        return deriv
 AHandlers["derivative"] = GenDerivative
 
 # Calculate an integral (accel to velocity, or velocity to position)
@@ -63,6 +66,8 @@ class GenIntegral:
         amanager.setup_dataset(self.source)
         self.ref = None
         self.half_life = 0.015
+        self.last_total = None
+        self.last_tail = array.array('d')
         if len(name_parts) >= 3:
             self.ref = name_parts[2]
             amanager.setup_dataset(self.ref)
@@ -83,25 +88,37 @@ class GenIntegral:
             units = units.replace(old, new).replace(old.lower(), new.lower())
         return {'label': lname, 'units': units}
     def generate_data(self):
+        # The offset is estimated per window and the running total is
+        # carried from the end of the previous window.  The margin before
+        # the window repeats the end of the previous window's results.
         seg_time = self.amanager.get_segment_time()
+        start, end = self.amanager.get_window()
         src = self.amanager.get_datasets()[self.source]
-        offset = sum(src) / len(src)
-        total = 0.
+        offset = sum(src[start:end]) / (end - start)
+        total = self.last_total
         ref = None
         if self.ref is not None:
             ref = self.amanager.get_datasets()[self.ref]
-            offset -= (ref[-1] - ref[0]) / (len(src) * seg_time)
-            total = ref[0]
+            offset -= (ref[end-1] - ref[start]) / ((end - start) * seg_time)
+            if total is None:
+                total = ref[start]
             src_weight = 1.
             if self.half_life:
                 src_weight = math.exp(math.log(.5) * seg_time / self.half_life)
             ref_weight = 1. - src_weight
-        data = [0.] * len(src)
-        for i, v in enumerate(src):
-            total += (v - offset) * seg_time
+        if total is None:
+            total = 0.
+        data = array.array('d', [total]) * len(src)
+        data[:start] = self.last_tail[len(self.last_tail)-start:]
+        for i in range(start, len(src)):
+            total += (src[i] - offset) * seg_time
             if ref is not None:
                 total = src_weight * total + ref_weight * ref[i]
             data[i] = total
+            if i == end - 1:
+                self.last_total = total
+        margin = self.amanager.get_window_margin()
+        self.last_tail = data[max(0, end - margin):end]
         return data
 AHandlers["integral"] = GenIntegral
 
@@ -149,7 +166,7 @@ class GenNorm2:
         data = []
         for dataset in self.datasets:
             data.append(self.amanager.get_datasets()[dataset])
-        res = [0.] * len(data[0])
+        res = array.array('d', [0.]) * len(data[0])
         for i in range(len(data[0])):
             norm2 = 0.
             for dataset in data:
@@ -177,11 +194,13 @@ class GenSmoothed:
     def get_label(self):
         label = self.amanager.get_label(self.source)
         return {'label': 'Smoothed ' + label['label'], 'units': label['units']}
+    def get_margin(self):
+        return .5 * self.smooth_time
     def generate_data(self):
         seg_time = self.amanager.get_segment_time()
         src = self.amanager.get_datasets()[self.source]
         n = len(src)
-        data = [0.] * n
+        data = array.array('d', [0.]) * n
         hst = 0.5 * self.smooth_time
         seg_half_len = round(hst / seg_time)
         inv_norm = 1. / sum([min(k + 1, seg_half_len + seg_half_len - k)
@@ -231,12 +250,12 @@ class GenKinematicPosition:
         datasets = self.amanager.get_datasets()
         data1 = datasets[self.source1]
         data2 = datasets[self.source2]
-        return [d1 + d2 for d1, d2 in zip(data1, data2)]
+        return array.array('d', [d1 + d2 for d1, d2 in zip(data1, data2)])
     def generate_data_corexy_minus(self):
         datasets = self.amanager.get_datasets()
         data1 = datasets[self.source1]
         data2 = datasets[self.source2]
-        return [d1 - d2 for d1, d2 in zip(data1, data2)]
+        return array.array('d', [d1 - d2 for d1, d2 in zip(data1, data2)])
     def generate_data_passthrough(self):
         return self.amanager.get_datasets()[self.source1]
 AHandlers["kin"] = GenKinematicPosition
@@ -265,8 +284,10 @@ class GenCorexyPosition:
         data1 = datasets[self.source1]
         data2 = datasets[self.source2]
         if self.is_plus:
-            return [.5 * (d1 + d2) for d1, d2 in zip(data1, data2)]
-        return [.5 * (d1 - d2) for d1, d2 in zip(data1, data2)]
+            return array.array('d', [.5 * (d1 + d2)
+                                     for d1, d2 in zip(data1, data2)])
+        return array.array('d', [.5 * (d1 - d2)
+                                 for d1, d2 in zip(data1, data2)])
 AHandlers["corexy"] = GenCorexyPosition
 
 # Calculate a position deviation
@@ -292,7 +313,7 @@ class GenDeviation:
         datasets = self.amanager.get_datasets()
         data1 = datasets[self.source1]
         data2 = datasets[self.source2]
-        return [d1 - d2 for d1, d2 in zip(data1, data2)]
+        return array.array('d', [d1 - d2 for d1, d2 in zip(data1, data2)])
 AHandlers["deviation"] = GenDeviation
 
 
@@ -317,12 +338,22 @@ class AnalyzerManager:
         self.raw_datasets = collections.OrderedDict()
         self.gen_datasets = collections.OrderedDict()
         self.datasets = {}
-        self.dataset_times = []
+        self.dataset_times = array.array('d')
         self.duration = 5.
+        self.window_time = 60.
+        self.window_start = self.window_end = self.window_margin = 0
     def set_duration(self, duration):
         self.duration = duration
+    def get_duration(self):
+        return self.duration
+    def set_window_time(self, window_time):
+        self.window_time = window_time
     def get_segment_time(self):
         return self.segment_time
+    def get_window(self):
+        return self.window_start, self.window_end
+    def get_window_margin(self):
+        return self.window_margin
     def get_datasets(self):
         return self.datasets
     def get_dataset_times(self):
@@ -348,7 +379,7 @@ class AnalyzerManager:
                 raise self.error("Invalid parameters to dataset '%s'" % (name,))
             hdl = cls(self, name_parts)
             self.gen_datasets[name] = hdl
-        self.datasets[name] = []
+        self.datasets[name] = array.array('d')
         return hdl
     def get_label(self, dataset):
         hdl = self.raw_datasets.get(dataset)
@@ -357,18 +388,60 @@ class AnalyzerManager:
             if hdl is None:
                 raise self.error("Unknown dataset '%s'" % (dataset,))
         return hdl.get_label()
-    def generate_datasets(self):
-        # Generate raw data
-        list_hdls = [(self.datasets[name], hdl)
-                     for name, hdl in self.raw_datasets.items()]
+    def _get_margin_segments(self):
+        # Upper bound on the neighboring samples any analyzer chain may need
+        margin = sum([hdl.get_margin() for hdl in self.gen_datasets.values()
+                      if hasattr(hdl, 'get_margin')])
+        return int(math.ceil(margin / self.segment_time - .000001))
+    def generate_windows(self):
+        # Yield (times, datasets) for consecutive windows of the capture.
+        # Only the current window (plus a margin of neighboring samples
+        # needed by analyzers) is held in memory.
+        margin = self.window_margin = self._get_margin_segments()
+        window_segs = max(1, int(self.window_time / self.segment_time + .5))
+        raw_data = [(array.array('d'), hdl)
+                    for name, hdl in self.raw_datasets.items()]
+        times = array.array('d')
         initial_start_time = self.lmanager.get_initial_start_time()
         start_time = t = self.lmanager.get_start_time()
         end_time = start_time + self.duration
-        while t < end_time:
-            t += self.segment_time
-            self.dataset_times.append(t - initial_start_time)
-            for dl, hdl in list_hdls:
-                dl.append(hdl.pull_data(t))
-        # Generate analyzer data
-        for name, hdl in self.gen_datasets.items():
-            self.datasets[name] = hdl.generate_data()
+        core_start = 0
+        while 1:
+            # Generate raw data
+            max_segs = core_start + window_segs + margin
+            while t < end_time and len(times) < max_segs:
+                t += self.segment_time
+                times.append(t - initial_start_time)
+                for dl, hdl in raw_data:
+                    dl.append(hdl.pull_data(t))
+            is_last = t >= end_time
+            core_end = min(core_start + window_segs, len(times))
+            if is_last:
+                core_end = len(times)
+            if core_start >= core_end:
+                break
+            self.window_start, self.window_end = core_start, core_end
+            datasets = self.datasets = {}
+            for name, (dl, hdl) in zip(self.raw_datasets.keys(), raw_data):
+                datasets[name] = dl
+            # Generate analyzer data
+            for name, hdl in self.gen_datasets.items():
+                datasets[name] = hdl.generate_data()
+            yield (times[core_start:core_end],
+                   {name: data[core_start:core_end]
+                    for name, data in datasets.items()})
+            if is_last:
+                break
+            # Keep a margin of samples before the next window
+            discard = max(0, core_end - margin)
+            del times[:discard]
+            for dl, hdl in raw_data:
+                del dl[:discard]
+            core_start = core_end - discard
+    def generate_datasets(self):
+        datasets = {name: array.array('d') for name in self.datasets}
+        for times, window_datasets in self.generate_windows():
+            self.dataset_times.extend(times)
+            for name, data in window_datasets.items():
+                datasets[name].extend(data)
+        self.datasets = datasets
@@ -4,7 +4,7 @@
 # Copyright (C) 2019-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, optparse, ast
+import sys, optparse, ast, math
 import matplotlib
 import readlog, analyzers
 try:
@@ -17,14 +17,45 @@ except:
 # Graphing
 ######################################################################
 
+MAX_PLOT_POINTS = 100000
+
+# Generate data one window at a time, reducing long captures to the
+# min/max envelope of each bucket so the plot stays bounded in size
+def generate_plot_data(amanager):
+    total_segs = amanager.get_duration() / amanager.get_segment_time()
+    bucket = int(math.ceil(2. * total_segs / MAX_PLOT_POINTS))
+    times = []
+    datasets = {}
+    for wtimes, wdatasets in amanager.generate_windows():
+        if bucket <= 1:
+            times.extend(wtimes)
+            for name, data in wdatasets.items():
+                datasets.setdefault(name, []).extend(data)
+            continue
+        count = len(wtimes)
+        for i in range(0, count, bucket):
+            times.append(wtimes[i])
+            times.append(wtimes[min(i + bucket, count) - 1])
+        for name, data in wdatasets.items():
+            out = datasets.setdefault(name, [])
+            for i in range(0, count, bucket):
+                seg = data[i:i+bucket]
+                low = min(seg)
+                high = max(seg)
+                if seg.index(low) <= seg.index(high):
+                    out.append(low)
+                    out.append(high)
+                else:
+                    out.append(high)
+                    out.append(low)
+    return times, datasets
+
 def plot_motion(amanager, graphs, log_prefix):
     # Generate data
     for graph in graphs:
         for dataset, plot_params in graph:
             amanager.setup_dataset(dataset)
-    amanager.generate_datasets()
-    datasets = amanager.get_datasets()
-    times = amanager.get_dataset_times()
+    times, datasets = generate_plot_data(amanager)
     # Build plot
     fontP = matplotlib.font_manager.FontProperties()
     fontP.set_size('x-small')
@@ -106,6 +137,8 @@ def main():
                     help="Number of seconds to graph")
     opts.add_option("--segment-time", type="float", default=0.000100,
                     help="Analysis segment time (default 0.000100 seconds)")
+    opts.add_option("--window-time", type="float", default=60.,
+                    help="Seconds of data to analyze at a time (default 60)")
     opts.add_option("-g", "--graph", help="Graph to generate (python literal)")
     opts.add_option("-l", "--list-datasets", action="store_true",
                     help="List available datasets")
@@ -122,6 +155,7 @@ def main():
     lmanager.seek_time(options.skip)
     amanager = analyzers.AnalyzerManager(lmanager, options.segment_time)
     amanager.set_duration(options.duration)
+    amanager.set_window_time(options.window_time)
 
     # Default graphs to draw
     graph_descs = [
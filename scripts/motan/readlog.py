@@ -3,7 +3,7 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import json, zlib
+import json, zlib, logging, collections
 
 class error(Exception):
     pass
@@ -518,6 +518,9 @@ class JsonLogReader:
     def seek(self, pos):
         self.file.seek(pos)
         self.comp = zlib.decompressobj(-15)
+        self.msgs = [b""]
+    def close(self):
+        self.file.close()
     def pull_msg(self):
         msgs = self.msgs
         while 1:
@@ -548,13 +551,13 @@ class JsonDispatcher:
     def check_end_of_data(self):
         return self.is_eof and not any(self.queues.values())
     def add_handler(self, name, subscription_id):
-        self.names[name] = q = []
+        self.names[name] = q = collections.deque()
         self.queues.setdefault(subscription_id, []).append(q)
     def pull_msg(self, req_time, name):
         q = self.names[name]
         while 1:
             if q:
-                return q.pop(0)
+                return q.popleft()
             if req_time + 1. < self.last_read_time:
                 return None
             json_msg = self.log_reader.pull_msg()
@@ -638,6 +641,7 @@ class LogManager:
         self.initial_status = {}
         self.start_status = {}
         self.log_subscriptions = {}
+        self.index = []
         self.status_tracker = None
     def setup_index(self):
         fmsg = self.index_reader.pull_msg()
@@ -646,6 +650,15 @@ class LogManager:
         start_time = status['toolhead']['estimated_print_time']
         self.initial_start_time = self.start_time = start_time
         self.log_subscriptions = fmsg.get('subscriptions', {})
+        # Index the dump once: [(print_time, file_position, status), ...]
+        while 1:
+            fmsg = self.index_reader.pull_msg()
+            if fmsg is None:
+                break
+            th = fmsg['status']['toolhead']
+            ptime = max(th['estimated_print_time'], th.get('print_time', 0.))
+            self.index.append((ptime, fmsg['file_position'], fmsg['status']))
+        self.index_reader.close()
     def get_initial_status(self):
         return self.initial_status
     def available_dataset_types(self):
@@ -657,17 +670,12 @@ class LogManager:
         start_status = self.start_status
         seek_time = max(self.initial_start_time, req_start_time - 1.)
         file_position = 0
-        while 1:
-            fmsg = self.index_reader.pull_msg()
-            if fmsg is None:
-                break
-            th = fmsg['status']['toolhead']
-            ptime = max(th['estimated_print_time'], th.get('print_time', 0.))
+        for ptime, index_position, status in self.index:
             if ptime > seek_time:
                 break
-            for k, v in fmsg["status"].items():
+            for k, v in status.items():
                 start_status.setdefault(k, {}).update(v)
-            file_position = fmsg['file_position']
+            file_position = index_position
         if file_position:
             self.jdispatch.log_reader.seek(file_position)
     def get_initial_start_time(self):
@@ -3,7 +3,7 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, os, optparse, logging, subprocess
+import sys, os, optparse, logging, subprocess, shutil
 
 TEMP_GCODE_FILE = "_test_.gcode"
 TEMP_LOG_FILE = "_test_.log"
@@ -109,7 +109,10 @@ class TestCase:
             return
         for fname in os.listdir(self.tempdir):
             if fname.startswith(TEMP_OUTPUT_FILE):
-                os.unlink(fname)
+                if os.path.isdir(fname):
+                    shutil.rmtree(fname)
+                else:
+                    os.unlink(fname)
         if not self.verbose:
             os.unlink(TEMP_LOG_FILE)
         else: